@@ -0,0 +1,278 @@
+'''
+Runs collectstatic over a generated tree of assets and records what it cost
+
+    $ python -m convoy.benchmarks.collectstatic [--storage local|s3] [--css 200] [--js 200]
+          [--images 400] [--median-kb 20] [--urls-per-kb 0.5] [--seed 0]
+          [--output results.json] [--compare previous.json]
+
+Each run collects the same tree twice, cold then again with nothing changed, and records
+the seconds, each stage's throughput, the peak memory of the process and how many times
+each storage method was called (and, for s3, each request the bucket got).  The tree is
+generated from --seed, so results from different commits can be compared with --compare.
+
+s3 runs against the in memory bucket of convoy.benchmarks.s3stub, so they count requests
+without paying for the network.  Run one configuration per process, peak memory is the
+process's high water mark.
+'''
+from django.conf import settings
+
+import json
+import optparse
+import os
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+STORAGES = {
+    "local": "convoy.stores.ConvoyStorage",
+    "s3": "convoy.stores.S3ConvoyStorage",
+}
+# the storage methods whose calls are counted
+COUNTED_METHODS = ("open", "_save", "exists", "delete", "size", "modified_time", "stored_digest")
+
+
+def file_size(rng, median_kb):
+    # asset sizes have a long tail: lots of small files, a few big bundles
+    return max(64, int(rng.lognormvariate(0, 1) * median_kb * 1024))
+
+
+def css_file(rng, size, urls_per_kb, images):
+    rules = []
+    length = 0
+    urls = int(size / 1024.0 * urls_per_kb)
+    while length < size:
+        if urls and images:
+            urls -= 1
+            rule = ".r%d{background:url(\"../img/%s\") no-repeat 0 0;margin:0 %dpx}\n" % (
+                length, rng.choice(images), rng.randint(0, 40))
+        else:
+            rule = ".r%d > a:hover,\n.r%d .b { color: #%06x; padding: %dpx 0.5em; }\n" % (
+                length, length, rng.randint(0, 0xffffff), rng.randint(0, 40))
+        rules.append(rule)
+        length += len(rule)
+    return "".join(rules)
+
+
+def js_file(rng, size):
+    lines = []
+    length = 0
+    while length < size:
+        line = "function f%d(value) {\n    // adds %d\n    return value + %d;\n}\n" % (
+            length, length, rng.randint(0, 1000))
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)
+
+
+def generate_tree(root, css=200, js=200, images=400, median_kb=20, urls_per_kb=0.5, seed=0):
+    '''
+    Writes a static tree to root/app/{css,js,img}, the same tree for the same arguments
+    Returns the number of files and their total bytes
+    '''
+    rng = random.Random(seed)
+    for directory in ("css", "js", "img"):
+        os.makedirs(os.path.join(root, "app", directory))
+    files, total = 0, 0
+    names = []
+    for i in range(images):
+        name = "image%d.png" % i
+        contents = "".join(chr(rng.randint(0, 255)) for n in range(rng.randint(200, 4000)))
+        names.append(name)
+        with open(os.path.join(root, "app", "img", name), "wb") as f:
+            f.write(contents)
+        files, total = files + 1, total + len(contents)
+    for i in range(css):
+        contents = css_file(rng, file_size(rng, median_kb), urls_per_kb, names)
+        with open(os.path.join(root, "app", "css", "style%d.css" % i), "wb") as f:
+            f.write(contents)
+        files, total = files + 1, total + len(contents)
+    for i in range(js):
+        contents = js_file(rng, file_size(rng, median_kb))
+        with open(os.path.join(root, "app", "js", "script%d.js" % i), "wb") as f:
+            f.write(contents)
+        files, total = files + 1, total + len(contents)
+    return files, total
+
+
+def count_calls(storage):
+    '''
+    Wraps storage's COUNTED_METHODS, returns the dict they count their calls in
+    '''
+    counts = dict((name, 0) for name in COUNTED_METHODS)
+    lock = threading.Lock()
+
+    def counting(name, method):
+        def counted(*args, **kwargs):
+            with lock:
+                counts[name] += 1
+            return method(*args, **kwargs)
+        return counted
+
+    for name in COUNTED_METHODS:
+        method = getattr(storage, name, None)
+        if method is not None:
+            setattr(storage, name, counting(name, method))
+    return counts
+
+
+def collect(storage):
+    from django.contrib.staticfiles.management.commands.collectstatic import Command
+    command = Command()
+    command.storage = storage
+    command.local = storage_is_local(storage)
+    command.set_options(interactive=False, verbosity=0, link=False, clear=False, dry_run=False,
+                        ignore_patterns=[], use_default_ignore_patterns=True, post_process=True)
+    started = time.time()
+    collected = command.collect()
+    return time.time() - started, collected
+
+
+def storage_is_local(storage):
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+def build_storage(kind, static_root):
+    from django.utils.module_loading import import_string
+    storage_class = import_string(STORAGES[kind])
+    if kind == "s3":
+        from convoy.benchmarks.s3stub import MemoryS3Connection
+        storage_class = type("MemoryS3ConvoyStorage", (storage_class,), {"connection_class": MemoryS3Connection})
+        return storage_class(bucket="convoy-benchmark", access_key="a", secret_key="s")
+    return storage_class(location=static_root)
+
+
+def run_once(kind, static_root):
+    storage = build_storage(kind, static_root)
+    counts = count_calls(storage)
+    seconds, collected = collect(storage)
+    stages = []
+    for (stage, ext), (files, reused, stage_seconds, save_seconds, bytes_in, bytes_out) in storage.report.totals():
+        stages.append({
+            "stage": stage, "type": ext, "files": files, "reused": reused,
+            "seconds": stage_seconds, "save_seconds": save_seconds, "bytes_in": bytes_in, "bytes_out": bytes_out,
+            "mb_per_second": bytes_in / stage_seconds / 1024 / 1024 if stage_seconds else None,
+        })
+    result = {
+        "seconds": seconds,
+        "post_processed": len(collected["post_processed"]),
+        "phases": storage.report.phases,
+        "stages": stages,
+        "storage_calls": counts,
+    }
+    bucket = getattr(storage, "bucket", None)
+    if bucket is not None and hasattr(bucket, "requests"):
+        requests = {}
+        for method, name in bucket.requests:
+            requests[method] = requests.get(method, 0) + 1
+        result["s3_requests"] = requests
+        del bucket.requests[:]
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(__file__), stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    work = tempfile.mkdtemp(prefix="convoy-benchmark-")
+    try:
+        source, static_root = os.path.join(work, "source"), os.path.join(work, "static")
+        files, total = generate_tree(source, options.css, options.js, options.images,
+                                     options.median_kb, options.urls_per_kb, options.seed)
+        settings.configure(
+            DEBUG=False,
+            STATIC_URL="/static/",
+            STATIC_ROOT=static_root,
+            STATICFILES_DIRS=[source],
+            # collectstatic's Command sets up this one before we hand it ours
+            STATICFILES_STORAGE=STORAGES["local"],
+            INSTALLED_APPS=["django.contrib.staticfiles", "convoy"],
+            CONVOY_LOCAL_CACHE_ROOT=static_root,
+        )
+        import django
+        django.setup()
+        if options.storage == "s3":
+            from convoy.benchmarks.s3stub import MemoryS3Connection
+            MemoryS3Connection.reset()
+        cold = run_once(options.storage, static_root)
+        warm = run_once(options.storage, static_root)
+        return {
+            "revision": git_revision(),
+            "config": {
+                "storage": options.storage, "css": options.css, "js": options.js, "images": options.images,
+                "median_kb": options.median_kb, "urls_per_kb": options.urls_per_kb, "seed": options.seed,
+                "files": files, "bytes": total,
+            },
+            "cold": cold,
+            "warm": warm,
+            # kilobytes on linux, bytes on os x
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def print_results(results, previous=None):
+    def change(new, old):
+        if not old:
+            return ""
+        return " (%+.1f%%)" % (100.0 * (new - old) / old)
+
+    config = results["config"]
+    print "%(storage)s storage, %(files)d files, %(bytes)d bytes" % config, "at", results["revision"] or "?"
+    for run_name in ("cold", "warm"):
+        result = results[run_name]
+        old = previous[run_name] if previous else {}
+        print "%s: %.3f seconds%s" % (run_name, result["seconds"], change(result["seconds"], old.get("seconds")))
+        old_stages = dict(((s["stage"], s["type"]), s) for s in old.get("stages", ()))
+        for stage in result["stages"]:
+            old_stage = old_stages.get((stage["stage"], stage["type"]), {})
+            print "  %-8s %-5s %5d files %5d reused %8.3f s%s" % (
+                stage["stage"], stage["type"], stage["files"], stage["reused"], stage["seconds"],
+                change(stage["seconds"], old_stage.get("seconds")))
+        for name, calls in sorted(result["storage_calls"].items()):
+            if calls:
+                print "  %-14s %6d calls%s" % (name, calls, change(calls, old.get("storage_calls", {}).get(name)))
+        for method, requests in sorted(result.get("s3_requests", {}).items()):
+            print "  s3 %-11s %6d requests%s" % (method, requests, change(requests, old.get("s3_requests", {}).get(method)))
+    print "peak rss %d%s" % (results["peak_rss"], change(results["peak_rss"], previous and previous.get("peak_rss")))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--storage", choices=sorted(STORAGES), default="local")
+    parser.add_option("--css", type="int", default=200)
+    parser.add_option("--js", type="int", default=200)
+    parser.add_option("--images", type="int", default=400)
+    parser.add_option("--median-kb", type="float", default=20)
+    parser.add_option("--urls-per-kb", type="float", default=0.5)
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--output", help="write the results to this json file")
+    parser.add_option("--compare", help="a json file from an earlier run to compare against")
+    options, args = parser.parse_args(argv)
+
+    results = run(options)
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
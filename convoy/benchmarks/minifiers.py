@@ -0,0 +1,52 @@
+'''
+Times every registered minifier and sums its output, to pick CONVOY_MINIFIERS
+
+    $ python -m convoy.benchmarks.minifiers [files or directories]
+
+Without arguments it minifies django admin's css and js
+'''
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+import os
+import sys
+
+import django
+
+
+def read_samples(paths):
+    '''
+    The contents of the css and js files under paths, by file type
+    '''
+    samples = {"css": [], "js": []}
+    for path in paths:
+        if os.path.isdir(path):
+            names = [os.path.join(directory, filename)
+                     for directory, dirnames, filenames in os.walk(path) for filename in filenames]
+        else:
+            names = [path]
+        for name in sorted(names):
+            file_type = name.split(".")[-1]
+            if file_type in samples and ".min." not in name:
+                with open(name, 'rb') as f:
+                    samples[file_type].append(f.read())
+    return samples
+
+
+def main(paths=None):
+    from convoy.minifiers import compare
+    if not paths:
+        paths = [os.path.join(os.path.dirname(django.__file__), "contrib", "admin", "static")]
+    for file_type, samples in sorted(read_samples(paths).items()):
+        if not samples:
+            continue
+        size = sum(len(sample) for sample in samples)
+        print "%d %s files, %d bytes" % (len(samples), file_type, size)
+        for name, seconds, output in compare(file_type, samples):
+            print "  %-10s %8.2f ms %10d bytes (%.1f%%)" % (name, seconds * 1e3, output, 100.0 * output / size)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,151 @@
+'''
+An in-memory stand-in for the parts of boto's S3 the convoy storages use
+Set connection_class = MemoryS3Connection on an S3 storage to use it
+'''
+from boto.exception import S3ResponseError
+
+import hashlib
+import threading
+import time
+
+
+class MemoryKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.data = None
+        self.etag = None
+        self.size = 0
+        self.headers = {}
+        self.metadata = {}
+        self.content_encoding = None
+        self.last_modified = "Thu, 01 Jan 1970 00:00:00 GMT"
+
+    def _store(self, data, headers, etag):
+        self.data = data
+        self.size = len(data)
+        self.etag = '"%s"' % etag
+        self.headers = dict(headers or {})
+        self.content_encoding = self.headers.get('Content-Encoding')
+        self.last_modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+        for header, value in self.headers.items():
+            if header.lower().startswith('x-amz-meta-'):
+                self.metadata[header[len('x-amz-meta-'):]] = value
+        self.bucket._put(self)
+
+    def exists(self):
+        return self.bucket.get_key(self.name) is not None
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_file(self, fp, headers=None, rewind=False, **options):
+        self.bucket._request('PUT', self.name)
+        if rewind:
+            fp.seek(0)
+        data = fp.read()
+        self._store(data, headers, hashlib.md5(data).hexdigest())
+
+    def get_contents_to_file(self, fp, headers=None):
+        fp.write(self.data)
+
+    def read(self, size=None):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class MemoryMultipartUpload(object):
+    def __init__(self, bucket, key_name, headers):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.headers = headers
+        self.parts = {}
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num):
+        self.bucket._request('PUT', self.key_name)
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        self.bucket._request('POST', self.key_name)
+        parts = [self.parts[num] for num in sorted(self.parts)]
+        etag = "%s-%d" % (hashlib.md5("".join(hashlib.md5(p).digest() for p in parts)).hexdigest(), len(parts))
+        data = "".join(parts)
+        MemoryKey(self.bucket, self.key_name)._store(data, self.headers, etag)
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class MemoryBucket(object):
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.keys = {}
+        self.requests = []
+        # set to a number of uploads that should fail with a 500
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def _request(self, method, name):
+        with self._lock:
+            self.requests.append((method, name))
+            if self.failures and method in ('PUT', 'POST'):
+                self.failures -= 1
+                raise S3ResponseError(500, "Internal Server Error")
+
+    def _put(self, key):
+        with self._lock:
+            self.keys[key.name] = key
+
+    def get_key(self, name, headers=None):
+        self._request('HEAD', name)
+        return self.keys.get(name)
+
+    def new_key(self, name):
+        return MemoryKey(self, name)
+
+    def delete_key(self, name):
+        self._request('DELETE', name)
+        with self._lock:
+            self.keys.pop(name, None)
+
+    def list(self, prefix=""):
+        self._request('GET', prefix)
+        return [key for name, key in sorted(self.keys.items()) if name.startswith(prefix)]
+
+    def initiate_multipart_upload(self, key_name, headers=None, **options):
+        self._request('POST', key_name)
+        return MemoryMultipartUpload(self, key_name, headers)
+
+
+class MemoryS3Connection(object):
+    # every connection sees the same buckets, like S3
+    buckets = {}
+    connections = []
+    _lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        with self._lock:
+            self.connections.append(self)
+
+    @classmethod
+    def reset(cls):
+        cls.buckets.clear()
+        del cls.connections[:]
+
+    def get_bucket(self, name, validate=True):
+        with self._lock:
+            if name not in self.buckets:
+                self.buckets[name] = MemoryBucket(self, name)
+            return self.buckets[name]
+
+    create_bucket = get_bucket
+
+    def generate_url(self, expires_in, method, bucket='', key='', **kwargs):
+        return "https://%s.s3.amazonaws.com/%s" % (bucket, key)
@@ -0,0 +1,190 @@
+'''
+Times the request time cost of the template tags
+
+    $ python -m convoy.benchmarks.tags [--assets 40] [--tags 40] [--carpools 4] [--renders 100]
+
+First the per tag cost of resolving an asset's url, the way {% convoy %} does, against a
+manifest shaped like collectstatic's, built in memory.  Then whole renders of a template
+with --tags {% convoy %} tags and --carpools {% carpool %} blocks, against a tree collected
+for real: renders per second, per tag latency percentiles and how many objects each render
+leaves allocated, without a request (no negotiation) and for clients accepting gzip or br.
+
+Python 2 has no tracemalloc, so allocations are the net count of objects the garbage
+collector tracks, with collection turned off while rendering.
+'''
+from django.conf import settings
+
+SOURCE_ROOT = "/tmp/convoy-benchmark-source/"
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=False,
+        STATIC_URL="/static/",
+        STATIC_ROOT="/tmp/convoy-benchmark-static/",
+        STATICFILES_DIRS=[SOURCE_ROOT],
+        STATICFILES_STORAGE="convoy.stores.ConvoyStorage",
+        INSTALLED_APPS=["django.contrib.staticfiles", "convoy"],
+    )
+
+from collections import OrderedDict
+import gc
+import optparse
+import shutil
+import time
+import timeit
+
+import django
+
+
+def build_storage(assets):
+    '''
+    A ConvoyStorage whose manifest chains each asset like the default pipeline:
+        base > base.hash > base.hash.cmin > base.hash.cmin.gz, with a .br sibling
+    '''
+    from convoy.stores import ConvoyStorage
+    storage = ConvoyStorage()
+    storage.hashed_files = OrderedDict()
+    storage.encoded_files = {}
+    for i in range(assets):
+        source = "app/css/file%d.css" % i
+        hashed = "app/css/file%d.0123456789ab.css" % i
+        minified = "app/css/file%d.0123456789ab.cmin.css" % i
+        storage.hashed_files[source] = hashed
+        storage.hashed_files[hashed] = minified
+        storage.hashed_files[minified] = minified + ".gz"
+        storage.encoded_files[minified] = {"gzip": minified + ".gz", "br": minified + ".br"}
+    return storage
+
+
+def time_per_call(func, names, repeat=5):
+    def run():
+        for name in names:
+            func(name)
+    number = max(1, 20000 // len(names))
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return best / (number * len(names))
+
+
+def resolve_urls(assets=40):
+    from convoy.utils import convoy_terminus
+
+    storage = build_storage(assets)
+    names = list(storage.hashed_files)[::3]
+    encodings = ["br", "gzip"]
+    lookup = lambda name: convoy_terminus(name, storage=storage, encodings=encodings)
+    unmemoized = lambda name: storage._resolve_terminal_url(name, False, encodings)
+
+    storage.terminals = {}
+    walked = time_per_call(unmemoized, names)
+    storage.terminals = storage.build_terminals()
+    table = time_per_call(unmemoized, names)
+    memoized = time_per_call(lookup, names)
+
+    print "%d assets, accepting %s" % (assets, ", ".join(encodings))
+    print "walking the chain:   %8.2f us per tag" % (walked * 1e6)
+    print "terminal table:      %8.2f us per tag" % (table * 1e6)
+    print "memoized:            %8.2f us per tag (hit rate %.1f%%)" % (
+        memoized * 1e6, storage.resolution_cache.stats()["hit_rate"] * 100)
+    print "%d tags per page:     %8.2f ms -> %.2f ms -> %.2f ms" % (
+        len(names), walked * len(names) * 1e3, table * len(names) * 1e3, memoized * len(names) * 1e3)
+
+
+def page_template(tags, carpools, css, js):
+    '''
+    The source of a page with tags {% convoy %} tags and carpools {% carpool %} blocks
+    of three files each, alternately css and js
+    '''
+    lines = ["{% load convoytags %}"]
+    for i in range(carpools):
+        file_type, names = ("css", css) if i % 2 == 0 else ("js", js)
+        lines.append("{%% carpool %s %%}" % file_type)
+        for n in range(3):
+            lines.append('"%s"' % names[(i * 3 + n) % len(names)])
+        lines.append("{% endcarpool %}")
+    assets = css + js
+    for i in range(tags):
+        lines.append('<link href="{%% convoy "%s" %%}">' % assets[i % len(assets)])
+    return "\n".join(lines)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def render_page(template, context, renders):
+    '''
+    Renders template renders times, returns renders per second, the latency of each
+    tag by kind and the objects each render left allocated
+    '''
+    from convoy.templatetags.convoytags import CarpoolNode, ConvoyStaticNode
+    nodes = [(node, "carpool" if isinstance(node, CarpoolNode) else "convoy")
+             for node in template.nodelist if isinstance(node, (CarpoolNode, ConvoyStaticNode))]
+    latencies = {"convoy": [], "carpool": []}
+    template.render(context)  # warm up: carpool combines its files on the first render
+    gc.collect()
+    gc.disable()
+    try:
+        allocated = gc.get_count()[0]
+        started = time.time()
+        for i in range(renders):
+            template.render(context)
+        seconds = time.time() - started
+        allocated = gc.get_count()[0] - allocated
+    finally:
+        gc.enable()
+    for i in range(renders):
+        for node, kind in nodes:
+            node_started = time.time()
+            node.render(context)
+            latencies[kind].append(time.time() - node_started)
+    return renders / seconds, latencies, float(allocated) / renders
+
+
+def render_pages(tags=40, carpools=4, renders=100, css=20, js=20):
+    from django.contrib.staticfiles.storage import staticfiles_storage
+    from django.template import Context, Template
+    from django.test.client import RequestFactory
+    from convoy.benchmarks.collectstatic import collect, generate_tree
+
+    shutil.rmtree(SOURCE_ROOT, ignore_errors=True)
+    shutil.rmtree(settings.STATIC_ROOT, ignore_errors=True)
+    generate_tree(SOURCE_ROOT, css=css, js=js, images=css, median_kb=4)
+    collect(staticfiles_storage)
+    template = Template(page_template(tags, carpools,
+                                      ["app/css/style%d.css" % i for i in range(css)],
+                                      ["app/js/script%d.js" % i for i in range(js)]))
+    print
+    print "%d convoy tags and %d carpool blocks per page, %d renders" % (tags, carpools, renders)
+    print "%-14s %10s %8s %8s %8s %8s %8s %8s %8s" % (
+        "accepting", "renders/s", "objects", "convoy", "p50", "p99", "carpool", "p50", "p99")
+    factory = RequestFactory()
+    for accepting in (None, "gzip", "br, gzip"):
+        context = Context({})
+        if accepting is not None:
+            context["request"] = factory.get("/", HTTP_ACCEPT_ENCODING=accepting)
+        per_second, latencies, allocated = render_page(template, context, renders)
+        row = [accepting or "no request", per_second, allocated]
+        for kind in ("convoy", "carpool"):
+            samples = latencies[kind] or [0.0]
+            row += ["", percentile(samples, 0.5) * 1e6, percentile(samples, 0.99) * 1e6]
+        print "%-14s %10.1f %8.1f %8s %7.1fus %7.1fus %8s %7.1fus %7.1fus" % tuple(row)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--assets", type="int", default=40, help="assets in the in memory manifest")
+    parser.add_option("--tags", type="int", default=40)
+    parser.add_option("--carpools", type="int", default=4)
+    parser.add_option("--renders", type="int", default=100)
+    options, args = parser.parse_args(argv)
+    if args:
+        # the number of assets, as before the options
+        options.assets = int(args[0])
+    django.setup()
+    resolve_urls(options.assets)
+    render_pages(options.tags, options.carpools, options.renders)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+'''
+Builds carpool bundles at runtime, each once across every process
+
+A request that finds its bundle missing renders the files one by one and
+submits the bundle to the process' BundleScheduler, whose threads combine it,
+run it through the pipeline and publish it in the bundle registry, where every
+process finds it (see convoy.registry).  A lock per bundle (see convoy.locks)
+keeps the other processes from building it meanwhile
+'''
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+
+from convoy.locks import get_lock
+from convoy.registry import bundle_entry, get_registry, install_entry
+from convoy.utils import concatenate
+
+# Build the bundles requests find missing on a pool of threads, the request renders the files one by one meanwhile
+CARPOOL_COMBINE_IN_BACKGROUND = getattr(settings, "CARPOOL_COMBINE_IN_BACKGROUND", False)
+# How many threads of each process build bundles
+CARPOOL_BUILD_WORKERS = getattr(settings, "CARPOOL_BUILD_WORKERS", 1)
+
+logger = logging.getLogger(__name__)
+
+
+def build_bundle(paths, comment_key, format, storage=None):
+    '''
+    concatenate()s paths, records the combined file under comment_key and runs it
+    through the storage's pipeline, but for the hash stage (its name already is one)
+    Adds to the storage's manifest tables in memory, returns the combined file's stored name
+    '''
+    storage = storage or staticfiles_storage
+    stored_name = concatenate(paths, comment_key, format, storage)
+    if hasattr(storage, "hashed_files"):
+        storage.hashed_files[storage.hash_key(comment_key)] = stored_name
+    if hasattr(storage, "process_files"):
+        paths = {stored_name: (storage, stored_name)}
+        for name, hashed_name, processed in storage.process_files(paths, storage.skipped_stages("hash")):
+            if isinstance(processed, Exception):
+                raise processed
+    return stored_name
+
+
+def record_bundles(comment_keys, storage=None, lock=None):
+    '''
+    Publishes the bundles of comment_keys in the storage's registry
+    '''
+    storage = storage or staticfiles_storage
+    if not hasattr(storage, "get_chain"):
+        return
+    entries = dict((comment_key, bundle_entry(storage, comment_key)) for comment_key in comment_keys)
+    get_registry(storage).publish(entries, lock or get_lock())
+
+
+class BundleScheduler(object):
+    '''
+    Builds bundles on a pool of threads, started on the first submit so forked
+    workers each get their own
+
+    A bundle is built by whichever process takes its lock first, the others
+    skip it.  The lock is released once the bundle is published, whoever takes
+    it next asks the registry again before building
+    '''
+    def __init__(self, workers=None, lock=None):
+        self.workers = workers or CARPOOL_BUILD_WORKERS
+        self.lock = lock or get_lock()
+        self.pending = set()
+        self.failed = {}
+        self._pool = None
+        self._pending_lock = threading.Lock()
+
+    def build(self, paths, comment_key, format, storage=None):
+        '''
+        Builds the bundle now, returns its stored name, or None when another
+        process or thread is building it
+        '''
+        storage = storage or staticfiles_storage
+        if not self.lock.acquire(comment_key):
+            return None
+        try:
+            if hasattr(storage, "get_next_link"):
+                # published since we last looked
+                entry = get_registry(storage).lookup(comment_key, fresh=True)
+                if entry is not None:
+                    install_entry(storage, entry)
+                    return storage.get_next_link(comment_key)
+            stored_name = build_bundle(paths, comment_key, format, storage)
+            record_bundles([comment_key], storage, self.lock)
+        finally:
+            self.lock.release(comment_key)
+        return stored_name
+
+    def submit(self, paths, comment_key, format, storage=None):
+        '''
+        Queues the bundle to be built, returns False when it already is
+        '''
+        with self._pending_lock:
+            if comment_key in self.pending:
+                return False
+            self.pending.add(comment_key)
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        self._pool.apply_async(self._run, (paths, comment_key, format, storage))
+        return True
+
+    def _run(self, paths, comment_key, format, storage):
+        try:
+            self.build(paths, comment_key, format, storage)
+            self.failed.pop(comment_key, None)
+        except Exception as e:
+            self.failed[comment_key] = e
+            logger.exception("Couldn't build carpool bundle %s", comment_key)
+        finally:
+            with self._pending_lock:
+                self.pending.discard(comment_key)
+
+    def join(self):
+        '''
+        Waits for the queued bundles to be built, e.g. in tests or before exiting
+        '''
+        with self._pending_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = BundleScheduler()
+    return _scheduler
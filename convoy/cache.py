@@ -0,0 +1,300 @@
+from django.conf import settings
+
+from collections import OrderedDict
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+from convoy.streams import CHUNK_SIZE, iter_chunks, read_spooled
+
+# Where stage outputs (minified, gzipped contents) are kept between
+# collectstatic runs, None turns the cache off
+CONVOY_STAGE_CACHE_ROOT = getattr(settings, "CONVOY_STAGE_CACHE_ROOT", None)
+CONVOY_STAGE_CACHE_MAX_BYTES = getattr(settings, "CONVOY_STAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+# How much of CONVOY_LOCAL_CACHE_ROOT the cached S3 storages may fill, None for no limit
+CONVOY_LOCAL_CACHE_MAX_BYTES = getattr(settings, "CONVOY_LOCAL_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+
+# How many url and chain resolutions each storage remembers
+CONVOY_RESOLUTION_CACHE_SIZE = getattr(settings, "CONVOY_RESOLUTION_CACHE_SIZE", 10000)
+
+TEMP_DIRECTORY = ".convoy-tmp"
+
+
+def fingerprint(contents):
+    '''
+    The md5 hexdigest of bytes or of a spooled file, see convoy.streams
+    '''
+    digest = hashlib.md5()
+    for chunk in iter_chunks(contents):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def prune_directory(root, max_bytes):
+    '''
+    Removes the least recently touched files under root until they add up to at most max_bytes
+    Returns how many bytes are left
+    '''
+    entries = []
+    total = 0
+    for directory, dirnames, filenames in os.walk(root):
+        if TEMP_DIRECTORY in dirnames:
+            # files being written right now
+            dirnames.remove(TEMP_DIRECTORY)
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    return total
+
+
+class StageCache(object):
+    '''
+    A persistent, size bounded, content addressed cache of stage outputs
+
+    Entries are keyed on the stage and the md5 fingerprint of the bytes that
+    went into it, so a hit is always safe to reuse no matter which file or
+    which run it came from.
+    Hits touch the entry, prune() evicts the least recently used entries
+    until the cache fits in max_bytes.
+    '''
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root if root is not None else CONVOY_STAGE_CACHE_ROOT
+        self.max_bytes = max_bytes if max_bytes is not None else CONVOY_STAGE_CACHE_MAX_BYTES
+
+    def key(self, stage, contents_fingerprint):
+        '''
+        stage is the stage's cache_name(), contents_fingerprint the input's md5,
+        which the pipeline already has, so the contents aren't read again
+        '''
+        return hashlib.sha1("%s\0%s" % (stage, contents_fingerprint)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                contents = read_spooled(iter(lambda: f.read(CHUNK_SIZE), ""))
+        except IOError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return contents
+
+    def set(self, key, contents):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        # Write then rename so a concurrent reader never sees a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter_chunks(contents):
+                f.write(chunk)
+        os.rename(tmp_path, path)
+
+    def prune(self):
+        prune_directory(self.root, self.max_bytes)
+
+
+class LocalFileCache(object):
+    '''
+    A size bounded local mirror of a remote storage's files, by name
+
+    Files are streamed into a temporary file then renamed into place, so a
+    reader (another thread, another worker) sees the whole file or nothing.
+    Opening a file touches it; when the cache grows past max_bytes the least
+    recently used files are removed until it's back under 90% of the budget.
+    hits and misses count open() calls.
+    '''
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes if max_bytes is not None else CONVOY_LOCAL_CACHE_MAX_BYTES
+        self.hits = 0
+        self.misses = 0
+        # bytes held, counted on the first write
+        self.size = None
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.root, os.path.normpath(name).lstrip(os.sep))
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def open(self, name):
+        '''
+        The cached file opened for reading, or None
+        '''
+        path = self.path(name)
+        try:
+            cached_file = open(path, 'rb')
+        except IOError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return cached_file
+
+    def stage(self, chunks):
+        '''
+        Streams chunks to a temporary file, returns its path for commit() or discard()
+        '''
+        directory = os.path.join(self.root, TEMP_DIRECTORY)
+        _makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except Exception:
+            self.discard(tmp_path)
+            raise
+        return tmp_path
+
+    def discard(self, tmp_path):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def commit(self, name, tmp_path):
+        path = self.path(name)
+        _makedirs(os.path.dirname(path))
+        added = os.path.getsize(tmp_path)
+        try:
+            added -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.rename(tmp_path, path)
+        self._grew(added)
+
+    def write(self, name, chunks):
+        self.commit(name, self.stage(chunks))
+
+    def delete(self, name):
+        path = self.path(name)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self._grew(-size)
+
+    def _grew(self, added):
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            if self.size is None:
+                self.size = prune_directory(self.root, self.max_bytes)
+            else:
+                self.size += added
+            if self.size > self.max_bytes:
+                self.size = prune_directory(self.root, int(self.max_bytes * 0.9))
+
+
+_stage_cache = None
+
+def get_stage_cache():
+    '''
+    Returns the shared StageCache, or None when CONVOY_STAGE_CACHE_ROOT isn't set
+    '''
+    global _stage_cache
+    if not CONVOY_STAGE_CACHE_ROOT:
+        return None
+    if _stage_cache is None:
+        _stage_cache = StageCache()
+    return _stage_cache
+
+
+_missing = object()
+
+
+class ResolutionCache(object):
+    '''
+    A bounded, thread safe memo of the answers computed from one manifest
+    (terminal urls, chains, carpool path lists)
+
+    Every lookup passes the version of the manifest it's asking about,
+    a new version empties the cache, so answers from an old manifest are never served.
+    The oldest entries are dropped past max_entries.  Hits don't take the lock,
+    they're a dict lookup, so the hit and miss counts are approximate under threads.
+    '''
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or CONVOY_RESOLUTION_CACHE_SIZE
+        self.version = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_set(self, version, key, compute):
+        value = self.get(version, key, _missing)
+        if value is _missing:
+            value = compute()
+            self.set(version, key, value)
+        return value
+
+    def get(self, version, key, default=None):
+        '''
+        The value kept for key from this version of the manifest, or default
+        '''
+        if version == self.version:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return default
+
+    def set(self, version, key, value):
+        with self._lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+        }
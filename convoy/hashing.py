@@ -0,0 +1,97 @@
+'''
+The hashes file names are fingerprinted with, by name
+
+    register("mine", factory)
+
+factory() returns an object with update() and hexdigest(), like hashlib's.
+CONVOY_HASH picks one, CONVOY_HASH_LENGTH how many hex digits of it go in the name
+'''
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from collections import OrderedDict
+import hashlib
+import re
+
+CONVOY_HASH = getattr(settings, "CONVOY_HASH", "md5")
+CONVOY_HASH_LENGTH = getattr(settings, "CONVOY_HASH_LENGTH", 12)
+
+HASHES = OrderedDict()
+
+
+def register(name, factory):
+    HASHES[name] = factory
+
+
+def new_hash(name=None):
+    name = name or CONVOY_HASH
+    try:
+        factory = HASHES[name]
+    except KeyError:
+        raise ImproperlyConfigured("No hash named %r, there's %s" % (name, ", ".join(HASHES)))
+    return factory()
+
+
+def digest(hasher, length):
+    hexdigest = hasher.hexdigest()
+    if length > len(hexdigest):
+        raise ImproperlyConfigured("CONVOY_HASH_LENGTH is %d, the hash only has %d hex digits" % (length, len(hexdigest)))
+    return hexdigest[:length]
+
+
+def hash_chunks(chunks, *hashers):
+    '''
+    Passes chunks on, updating each of hashers with them on the way
+    '''
+    for chunk in chunks:
+        for hasher in hashers:
+            hasher.update(chunk)
+        yield chunk
+
+
+def manifest_hashing(hashing):
+    '''
+    (algorithm, length) from a manifest's "hashing" entry
+    Manifests from before it was recorded were fingerprinted like django does, md5 and 12
+    '''
+    hashing = hashing or {}
+    return hashing.get("algorithm", "md5"), hashing.get("length", 12)
+
+
+def split_hash(name, length=None):
+    '''
+    (name without its fingerprint, the fingerprint) e.g. ("app/base.css", "0123456789ab")
+    for "app/base.0123456789ab.css", or (name, None) when it has no fingerprint of length
+    '''
+    length = length or CONVOY_HASH_LENGTH
+    parts = name.split(".")
+    if len(parts) > 2 and "/" not in parts[-2] and re.match(r"[0-9a-f]{%d}$" % length, parts[-2]):
+        fingerprint = parts.pop(-2)
+        return ".".join(parts), fingerprint
+    return name, None
+
+
+register("md5", hashlib.md5)
+register("sha1", hashlib.sha1)
+register("sha256", hashlib.sha256)
+
+if hasattr(hashlib, "blake2b"):
+    register("blake2b", hashlib.blake2b)
+    register("blake2s", hashlib.blake2s)
+else:
+    try:
+        import pyblake2
+    except ImportError:
+        pass
+    else:
+        register("blake2b", pyblake2.blake2b)
+        register("blake2s", pyblake2.blake2s)
+
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    register("xxh64", xxhash.xxh64)
+    if hasattr(xxhash, "xxh3_128"):
+        register("xxh3_128", xxhash.xxh3_128)
@@ -0,0 +1,105 @@
+from django.conf import settings
+
+import errno
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+# The django cache (by alias) whose add() locks carpool builds across processes and
+# machines, e.g. a memcached or redis shared by every dyno.  None locks with files
+# in CARPOOL_LOCK_ROOT, which only the processes of one machine share
+CARPOOL_LOCK_CACHE = getattr(settings, "CARPOOL_LOCK_CACHE", None)
+CARPOOL_LOCK_ROOT = getattr(settings, "CARPOOL_LOCK_ROOT", os.path.join(tempfile.gettempdir(), "convoy-locks"))
+# Seconds before a lock is taken to be abandoned (its process died) and can be taken again
+CARPOOL_LOCK_TIMEOUT = getattr(settings, "CARPOOL_LOCK_TIMEOUT", 300)
+
+
+class FileLock(object):
+    '''
+    Locks named by key, each a file created with O_EXCL, so one process at a time holds it
+    '''
+    def __init__(self, root=None, timeout=None):
+        self.root = root or CARPOOL_LOCK_ROOT
+        self.timeout = timeout or CARPOOL_LOCK_TIMEOUT
+
+    def path(self, key):
+        return os.path.join(self.root, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def acquire(self, key):
+        '''
+        Takes the lock without waiting, returns whether we got it
+        '''
+        path = self.path(key)
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    try:
+                        os.makedirs(self.root)
+                    except OSError:
+                        pass
+                    continue
+                if e.errno != errno.EEXIST or not self._expired(path):
+                    return False
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            os.write(fd, str(os.getpid()))
+            os.close(fd)
+            return True
+        return False
+
+    def _expired(self, path):
+        try:
+            return os.path.getmtime(path) < time.time() - self.timeout
+        except OSError:
+            return True
+
+    def release(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+class CacheLock(object):
+    '''
+    Locks named by key in a django cache, cache.add() only sets a key nobody holds
+    '''
+    prefix = "convoy-lock:"
+
+    def __init__(self, alias=None, timeout=None):
+        from django.core.cache import caches
+        self.cache = caches[alias or CARPOOL_LOCK_CACHE]
+        self.timeout = timeout or CARPOOL_LOCK_TIMEOUT
+        self.token = uuid.uuid4().hex
+
+    def acquire(self, key):
+        return self.cache.add(self.prefix + key, self.token, self.timeout)
+
+    def release(self, key):
+        if self.cache.get(self.prefix + key) == self.token:
+            self.cache.delete(self.prefix + key)
+
+
+def wait_for(lock, key, seconds=10, interval=0.05):
+    '''
+    Takes lock's key, waiting up to seconds for it, returns whether we got it
+    '''
+    deadline = time.time() + seconds
+    while not lock.acquire(key):
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def get_lock():
+    if CARPOOL_LOCK_CACHE:
+        return CacheLock()
+    return FileLock()
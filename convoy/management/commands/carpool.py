@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from convoy.offline import compile_carpools, scan_templates
+
+
+class Command(NoArgsCommand):
+    help = ("Combines every {% carpool %} block of the templates ahead of time "
+            "and records the bundles in the manifest, run it after collectstatic.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="List the bundles found without building them."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        bundles, errors = scan_templates()
+        for path, error in errors.items():
+            self.stderr.write("Skipped %s: %s" % (path, error))
+        if options['dry_run']:
+            for format, paths in bundles:
+                self.stdout.write("%s: %s" % (format, ", ".join(paths)))
+            return
+        built, existing, failed = compile_carpools(bundles)
+        for comment_key, error in failed.items():
+            self.stderr.write("Couldn't combine %s: %s" % (comment_key, error))
+        if verbosity >= 2:
+            for comment_key in built:
+                self.stdout.write("Combined %s" % comment_key)
+        if verbosity >= 1:
+            self.stdout.write("%d carpool bundles combined, %d already were, %d failed." % (
+                len(built), len(existing), len(failed)))
@@ -0,0 +1,158 @@
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+from collections import MutableMapping
+import json
+import mmap
+import struct
+
+# Also save the manifest as a sorted, memory-mapped index that the storages
+# look names up in lazily instead of parsing staticfiles.json at startup
+CONVOY_MANIFEST_INDEX = getattr(settings, "CONVOY_MANIFEST_INDEX", False)
+
+MAGIC = "CONVOY-INDEX 1\n"
+# key offset, key length, value offset, value length
+RECORD = struct.Struct("<IIII")
+
+
+def build_index(tables, manifest_hash=None, hashing=None):
+    '''
+    The bytes of an index file holding tables, a dict of name: {key: value bytes}
+
+        MAGIC
+        {"manifest_hash": ..., "hashing": ..., "tables": {name: [offset, count]}}\\n
+        for each table: count records sorted by key, then the keys and values
+
+    Offsets are from the end of the header line
+    '''
+    chunks = []
+    layout = {}
+    position = 0
+    for table_name, table in sorted(tables.items()):
+        items = sorted((force_bytes(key), force_bytes(value)) for key, value in table.items())
+        layout[table_name] = [position, len(items)]
+        offset = position + RECORD.size * len(items)
+        blob = []
+        for key, value in items:
+            chunks.append(RECORD.pack(offset, len(key), offset + len(key), len(value)))
+            blob.append(key)
+            blob.append(value)
+            offset += len(key) + len(value)
+        chunks.extend(blob)
+        position = offset
+    header = json.dumps({"manifest_hash": manifest_hash, "hashing": hashing, "tables": layout})
+    return "".join([MAGIC, header, "\n"] + chunks)
+
+
+def index_tables(paths, encodings=None, terminals=None):
+    '''
+    The tables build_index() stores for a manifest, values as the bytes ManifestIndex reads back
+    '''
+    return {
+        "paths": paths,
+        "encodings": dict((key, json.dumps(value)) for key, value in (encodings or {}).items()),
+        "terminals": dict((key, json.dumps(value)) for key, value in (terminals or {}).items()),
+    }
+
+
+def _decode_text(value):
+    return value.decode('utf-8')
+
+
+class ManifestIndex(object):
+    '''
+    An index file opened read only with mmap
+
+    Nothing is parsed up front but the header, every process that opens the
+    same file shares its pages through the OS cache.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s isn't a convoy manifest index" % path)
+        end = self._map.find("\n", len(MAGIC))
+        header = json.loads(self._map[len(MAGIC):end])
+        self.manifest_hash = header.get("manifest_hash")
+        # the manifest's "hashing" entry
+        self.hashing = header.get("hashing")
+        self.layout = header["tables"]
+        self.data_start = end + 1
+
+    def table(self, name, decode=_decode_text):
+        offset, count = self.layout.get(name, (0, 0))
+        return IndexedTable(self._map, self.data_start, offset, count, decode)
+
+    def close(self):
+        self._map.close()
+
+
+class IndexedTable(MutableMapping):
+    '''
+    One table of a ManifestIndex as a dict, each lookup a binary search of the file
+
+    Setting a key (e.g. carpool adding a combined file) keeps it in memory, over the file
+    '''
+    def __init__(self, index_map, data_start, offset, count, decode=_decode_text):
+        self._map = index_map
+        self._base = data_start
+        self._records = data_start + offset
+        self._count = count
+        self._decode = decode
+        self.updates = {}
+        self._added = 0
+
+    def _record(self, i):
+        return RECORD.unpack_from(self._map, self._records + i * RECORD.size)
+
+    def _key(self, record):
+        start = self._base + record[0]
+        return self._map[start:start + record[1]]
+
+    def _find(self, key):
+        key = force_bytes(key)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            found = self._key(record)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return record
+        return None
+
+    def __getitem__(self, key):
+        if key in self.updates:
+            return self.updates[key]
+        record = self._find(key)
+        if record is None:
+            raise KeyError(key)
+        start = self._base + record[2]
+        return self._decode(self._map[start:start + record[3]])
+
+    def __contains__(self, key):
+        return key in self.updates or self._find(key) is not None
+
+    def __setitem__(self, key, value):
+        if key not in self.updates and self._find(key) is None:
+            self._added += 1
+        self.updates[key] = value
+
+    def __delitem__(self, key):
+        if key not in self.updates or self._find(key) is not None:
+            raise TypeError("entries of the manifest index can't be deleted")
+        del self.updates[key]
+        self._added -= 1
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self._key(self._record(i)).decode('utf-8')
+        for key in self.updates:
+            if self._find(key) is None:
+                yield key
+
+    def __len__(self):
+        return self._count + self._added
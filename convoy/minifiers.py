@@ -0,0 +1,274 @@
+'''
+The minifiers MinifyStage can use, by file type
+
+    register("css", "mine", minify_function)
+
+CONVOY_MINIFIERS picks one per file type e.g. {"css": "convoy", "js": "rjsmin"},
+compare() times every registered minifier on some files
+'''
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from collections import OrderedDict
+import re
+import time
+
+# The minifier used for each file type, by registered name
+CONVOY_MINIFIERS = getattr(settings, "CONVOY_MINIFIERS", {})
+
+MINIFIERS = {"css": OrderedDict(), "js": OrderedDict()}
+# convoy's own css minifier is used when cssmin isn't installed, or picked in CONVOY_MINIFIERS
+DEFAULT_MINIFIERS = {"css": "cssmin", "js": "rjsmin"}
+
+
+def register(file_type, name, minifier):
+    '''
+    minifier takes the contents of a file and returns them minified
+    '''
+    MINIFIERS.setdefault(file_type, OrderedDict())[name] = minifier
+
+
+def minifier_name(file_type, name=None):
+    '''
+    name if given, else CONVOY_MINIFIERS's choice for file_type, else the default,
+    else the first one registered. None when nothing is registered for file_type
+    '''
+    registered = MINIFIERS.get(file_type)
+    if not registered:
+        return None
+    name = name or CONVOY_MINIFIERS.get(file_type)
+    if name is not None:
+        if name not in registered:
+            raise ImproperlyConfigured("No %s minifier named %r, there's %s" % (file_type, name, ", ".join(registered)))
+        return name
+    default = DEFAULT_MINIFIERS.get(file_type)
+    return default if default in registered else next(iter(registered))
+
+
+def minify(contents, file_type, name=None):
+    name = minifier_name(file_type, name)
+    if name is None:
+        return contents
+    return MINIFIERS[file_type][name](contents)
+
+
+def compare(file_type, samples, names=None, repeat=3):
+    '''
+    Runs each minifier over samples (a list of file contents), returns a list of
+    (name, best seconds for all the samples, total output bytes), fastest first
+    '''
+    results = []
+    for name in names or MINIFIERS.get(file_type, ()):
+        minifier = MINIFIERS[file_type][name]
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            outputs = [minifier(sample) for sample in samples]
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, best, sum(len(output) for output in outputs)))
+    return sorted(results, key=lambda result: result[1])
+
+
+_css_token = re.compile(r'''
+    (/\*.*?(?:\*/|$))                                 # comment
+  | ("(?:[^"\\]|\\.)*"?|'(?:[^'\\]|\\.)*'?)            # string
+  | (url\(\s*[^"')\s]*\s*\))                          # unquoted url
+  | (\s+)                                             # whitespace
+  | ([{}();:,>+~!])                                   # punctuation
+  | ([^\s"'/{}();:,>+~!]+|/)                          # anything else
+''', re.S | re.X | re.I)
+
+# at-rules whose blocks hold rules rather than declarations
+_group_at_rule = re.compile(r"@(-[a-z]+-)?(media|supports|document|keyframes|layer|container)$", re.I)
+# these are the same with one 0 as with four
+_zero_shorthands = frozenset(["margin", "padding", "border-width", "border-radius", "inset"])
+# IE 10 and 11 drop a flex whose basis is a 0 without a unit
+_zero_units_kept = frozenset(["flex", "-ms-flex", "-webkit-flex", "flex-basis", "-webkit-flex-basis"])
+
+_rgb = re.compile(r"(?<![\w-])rgb\((\d{1,3}),(\d{1,3}),(\d{1,3})\)", re.I)
+_long_hex = re.compile(r"(?<![\w#-])#([0-9a-fA-F]{6})(?![\w-])")
+_zero_unit = re.compile(r"(?<![\w.%#-])(-?)0+(?:\.0*)?(?:px|em|ex|in|cm|mm|pc|pt)(?![\w%(-])", re.I)
+_leading_zero = re.compile(r"(?<![\w.#-])(-?)0+\.(?=\d)")
+_zeros = re.compile(r"0(?: 0){1,3}$")
+
+
+def _rgb_to_hex(match):
+    channels = [int(channel) for channel in match.groups()]
+    if max(channels) > 255:
+        return match.group(0)
+    return "#%02x%02x%02x" % tuple(channels)
+
+
+def _short_hex(match):
+    color = match.group(1)
+    if color[0::2].lower() == color[1::2].lower():
+        return "#" + color[0::2]
+    return match.group(0)
+
+
+def _minify_value(prop, value):
+    '''
+    Shortens a declaration's value, which has no strings or urls in it
+    '''
+    if "rgb" in value or "RGB" in value:
+        value = _rgb.sub(_rgb_to_hex, value)
+    if "#" in value and prop not in ("filter", "-ms-filter") and "=" not in value:
+        value = _long_hex.sub(_short_hex, value)
+    if "0" in value:
+        if "(" not in value and prop not in _zero_units_kept:
+            # units are required inside calc()
+            value = _zero_unit.sub(r"\g<1>0", value)
+        value = _leading_zero.sub(r"\1.", value)
+        if prop in _zero_shorthands and _zeros.match(value):
+            value = "0"
+    return value
+
+
+def css_minify(css):
+    '''
+    A single pass css minifier: splits css into tokens (strings and urls are
+    never changed) and only keeps the whitespace that means something where it is
+     - the comments are dropped, except /*! ones
+     - whitespace is dropped around { } ; , > ( ) and !, around : in declarations
+       and media queries, and around + and ~ in selectors (calc() needs them)
+     - the last ; in a block and empty rules are dropped
+     - in values: 0px is 0 (but in calc() and flex), 0.5 is .5, rgb(255,0,0) is #f00,
+       #aabbcc is #abc and margin:0 0 0 0 is margin:0
+    '''
+    out = []
+    # what the open blocks hold, "rules" or "declarations"
+    blocks = ["rules"]
+    statement_start = 0
+    statement_at = None
+    # the declaration being read: its property, where its value starts in out
+    # and whether the value has strings or urls in it
+    prop = None
+    value_start = None
+    value_raw = False
+    depth = 0
+    space = False
+
+    for comment, string, url, whitespace, punctuation, word in _css_token.findall(css):
+        if whitespace:
+            space = True
+            continue
+        if comment:
+            if comment.startswith("/*!"):
+                if len(out) == statement_start:
+                    statement_start += 1
+                out.append(comment)
+                space = False
+            continue
+        token = punctuation or word or string or url
+        in_declarations = blocks[-1] == "declarations"
+        if space and out:
+            previous = out[-1][-1]
+            if previous in "{};,>(!/" or token in "{};,>)!":
+                pass
+            elif (in_declarations or statement_at) and (previous == ":" or token == ":"):
+                pass
+            elif not in_declarations and not statement_at and (previous in "+~" or token in "+~"):
+                pass
+            else:
+                out.append(" ")
+        space = False
+
+        if punctuation:
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth = max(depth - 1, 0)
+            elif token == ":" and in_declarations and value_start is None and depth == 0:
+                prop = "".join(out[statement_start:]).strip().lower()
+                out.append(token)
+                value_start = len(out)
+                value_raw = False
+                continue
+            elif token in ";}!" and value_start is not None and depth == 0:
+                if not value_raw:
+                    out[value_start:] = [_minify_value(prop, "".join(out[value_start:]))]
+                value_start = None
+
+            if token == ";":
+                if not out or out[-1] in ";{" or (depth == 0 and not in_declarations and not statement_at):
+                    continue
+                if not in_declarations:
+                    # the end of an at-rule like @import
+                    out.append(token)
+                    statement_start = len(out)
+                    statement_at = None
+                    continue
+                out.append(token)
+                statement_start = len(out)
+                continue
+            if token == "{":
+                depth = 0
+                if in_declarations:
+                    # a nested rule, take it as a block of declarations too
+                    blocks.append("declarations")
+                elif statement_at and _group_at_rule.match(statement_at):
+                    blocks.append("rules")
+                else:
+                    blocks.append("declarations")
+                out.append(token)
+                statement_start = len(out)
+                statement_at = None
+                continue
+            if token == "}":
+                depth = 0
+                while out and out[-1] == ";":
+                    out.pop()
+                if len(blocks) > 1:
+                    blocks.pop()
+                if out and out[-1] == "{" and blocks[-1] == "rules":
+                    # an empty rule, drop it and its selector
+                    start = len(out) - 1
+                    while start > 0 and out[start - 1] not in ("{", "}", ";") and not out[start - 1].startswith("/*!"):
+                        start -= 1
+                    del out[start:]
+                    statement_start = len(out)
+                    statement_at = None
+                    continue
+                out.append(token)
+                statement_start = len(out)
+                statement_at = None
+                continue
+        elif string or url:
+            value_raw = True
+            if url:
+                token = "url(%s)" % token[4:-1].strip()
+        elif word.startswith("@") and len(out) == statement_start and not in_declarations:
+            statement_at = word.lower()
+        out.append(token)
+
+    if value_start is not None and not value_raw:
+        out[value_start:] = [_minify_value(prop, "".join(out[value_start:]))]
+    return "".join(out).strip()
+
+
+register("css", "convoy", css_minify)
+
+try:
+    import cssmin
+except ImportError:
+    pass
+else:
+    register("css", "cssmin", cssmin.cssmin)
+
+try:
+    from _rjsmin import jsmin as _rjsmin
+except ImportError:
+    try:
+        from rjsmin import jsmin as _rjsmin
+    except ImportError:
+        _rjsmin = None
+if _rjsmin is not None:
+    register("js", "rjsmin", lambda contents: _rjsmin(contents, keep_bang_comments=True))
+
+try:
+    from jsmin import jsmin as _jsmin
+except ImportError:
+    pass
+else:
+    register("js", "jsmin", lambda contents: _jsmin(contents))
@@ -3,6 +3,11 @@ from django.core.management.base import CommandError
 from django.contrib.staticfiles.management.commands import collectstatic, runserver
 from collections import OrderedDict
 
+from convoy.cache import get_stage_cache
+from convoy.offline import CARPOOL_COMPILE_DURING_COLLECTSTATIC, compile_carpools
+from convoy.pipeline import CONVOY_REPORT
+from convoy.registry import get_registry
+
 
 orig_collect = collectstatic.Command.collect
 def new_collect(self, *args, **kwargs):
@@ -12,9 +17,34 @@ def new_collect(self, *args, **kwargs):
     
     To be removed once https://code.djangoproject.com/ticket/22557 is fixed
     '''
+    if hasattr(self.storage, "load_previous_manifest"):
+        # Keep what the last run knew so unchanged files can be skipped
+        self.storage.load_previous_manifest()
     if hasattr(self.storage, "manifest_name"):
         self.storage.hashed_files = OrderedDict()
-    return orig_collect(self, *args, **kwargs)
+        self.storage.encoded_files = {}
+    if hasattr(self.storage, "build_index"):
+        # One bucket listing instead of a HEAD per exists()
+        self.storage.build_index()
+    try:
+        collected = orig_collect(self, *args, **kwargs)
+    finally:
+        if hasattr(self.storage, "clear_index"):
+            self.storage.clear_index()
+    if CONVOY_REPORT and getattr(self.storage, "report", None) is not None and not self.dry_run:
+        for line in self.storage.report.lines():
+            self.stdout.write(line)
+    stage_cache = get_stage_cache()
+    if stage_cache is not None and not self.dry_run:
+        stage_cache.prune()
+    if hasattr(self.storage, "manifest_name") and not self.dry_run:
+        # the bundles built at runtime were of the last deploy's files
+        get_registry(self.storage).clear()
+    # without post-processing, hashed_files was started over for nothing and the manifest wasn't saved
+    if CARPOOL_COMPILE_DURING_COLLECTSTATIC and self.post_process and not self.dry_run and \
+            hasattr(self.storage, "process_files"):
+        compile_carpools(storage=self.storage)
+    return collected
 collectstatic.Command.collect = new_collect
 
 
@@ -0,0 +1,131 @@
+'''
+Builds the carpool bundles of every template ahead of time, so no request has to
+
+    $ python manage.py carpool
+
+or with CARPOOL_COMPILE_DURING_COLLECTSTATIC, at the end of collectstatic.
+Only {% carpool %} blocks whose paths are all written out are found, a block
+with variables or tags in it is still combined when it's first rendered
+'''
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from collections import OrderedDict
+import os
+
+from convoy.utils import concatenate
+from convoy.workers import WorkerPools
+
+# Build the carpool bundles of every template as the last step of collectstatic
+CARPOOL_COMPILE_DURING_COLLECTSTATIC = getattr(settings, "CARPOOL_COMPILE_DURING_COLLECTSTATIC", False)
+
+
+def template_dirs():
+    '''
+    TEMPLATE_DIRS and every installed app's templates directory
+    '''
+    from django.template.loaders.app_directories import app_template_dirs
+    dirs = []
+    for directory in list(settings.TEMPLATE_DIRS) + list(app_template_dirs):
+        if os.path.isdir(directory) and directory not in dirs:
+            dirs.append(directory)
+    return dirs
+
+
+def find_carpools(source):
+    '''
+    The (format, paths) of each carpool block with literal paths in a template's source
+    '''
+    from django.template import Template
+    from convoy.templatetags.convoytags import CarpoolNode
+    bundles = []
+    for node in Template(source).nodelist.get_nodes_by_type(CarpoolNode):
+        paths = node.literal_paths()
+        if paths:
+            bundles.append((node.format, tuple(paths)))
+    return bundles
+
+
+def scan_templates(dirs=None):
+    '''
+    Returns the bundles of every template under dirs (template_dirs() by default), each once,
+    and the templates that couldn't be read or compiled, {path: exception}
+    '''
+    bundles = OrderedDict()
+    errors = OrderedDict()
+    for root in dirs if dirs is not None else template_dirs():
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(directory, filename)
+                try:
+                    with open(path, 'rb') as f:
+                        source = f.read()
+                    if "carpool" not in source:
+                        continue
+                    found = find_carpools(source.decode(settings.FILE_CHARSET))
+                except Exception as e:
+                    errors[path] = e
+                    continue
+                for bundle in found:
+                    bundles[bundle] = True
+    return list(bundles), errors
+
+
+def _concatenate(job):
+    paths, comment_key, format, storage = job
+    try:
+        return concatenate(paths, comment_key, format, storage), None
+    except Exception as e:
+        return None, e
+
+
+def compile_carpools(bundles=None, storage=None):
+    '''
+    Combines every bundle (format, paths) that isn't in storage's manifest yet, on
+    CONVOY_IO_WORKERS threads, runs the pipeline over the combined files in one pass
+    and saves the manifest once.  Bundles default to scan_templates()'s
+
+    Returns the comment keys of the bundles built, of the ones already built,
+    and {comment key: exception} for the ones that couldn't be
+    '''
+    from convoy.templatetags.convoytags import CarpoolNode
+    storage = storage or staticfiles_storage
+    if bundles is None:
+        bundles = scan_templates()[0]
+    # plain dicts, a manifest index can't be saved back as json
+    for table in ("hashed_files", "encoded_files", "terminals"):
+        if getattr(storage, table, None) is not None and not isinstance(getattr(storage, table), dict):
+            setattr(storage, table, OrderedDict(getattr(storage, table).items()))
+
+    pending = OrderedDict()
+    existing = []
+    for format, paths in bundles:
+        node = CarpoolNode(None, format, storage)
+        convoyable_paths = node._resolve_paths_to_combine(paths)[0]
+        if not convoyable_paths:
+            continue
+        comment_key = node.create_comment_key(convoyable_paths)
+        if node.comment_key_in_cache(comment_key):
+            existing.append(comment_key)
+        elif comment_key not in pending:
+            pending[comment_key] = (convoyable_paths, comment_key, format, storage)
+
+    built = []
+    errors = OrderedDict()
+    combined = OrderedDict()
+    with WorkerPools(jobs=len(pending)) as pools:
+        for comment_key, (stored_name, error) in zip(pending, pools.io_map(_concatenate, pending.values())):
+            if error is not None:
+                errors[comment_key] = error
+                continue
+            storage.hashed_files[storage.hash_key(comment_key)] = stored_name
+            combined[stored_name] = (storage, stored_name)
+            built.append(comment_key)
+    if combined:
+        # the combined file is already named for its hash
+        for name, hashed_name, processed in storage.process_files(combined, storage.skipped_stages("hash")):
+            if isinstance(processed, Exception):
+                raise processed
+        storage.save_manifest()
+    return built, existing, errors
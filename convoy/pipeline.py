@@ -0,0 +1,588 @@
+from django.conf import settings
+from django.contrib.staticfiles.storage import HashedFilesMixin
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
+from django.utils.module_loading import import_string
+
+from convoy import signals
+from convoy.cache import fingerprint, get_stage_cache
+from convoy.hashing import CONVOY_HASH, CONVOY_HASH_LENGTH, digest, hash_chunks, new_hash, split_hash
+from convoy.stages import Stage
+from convoy.streams import as_file, close, is_spooled, iter_chunks, read_spooled, size_of
+from convoy.workers import WorkerPools
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import time
+
+CONVOY_INCREMENTAL = getattr(settings, "CONVOY_INCREMENTAL", False)
+# Prints the time each stage took against the bytes it saved at the end of collectstatic
+CONVOY_REPORT = getattr(settings, "CONVOY_REPORT", False)
+# Where to write every step's numbers as json at the end of collectstatic, None doesn't
+CONVOY_REPORT_PATH = getattr(settings, "CONVOY_REPORT_PATH", None)
+# How many files collectstatic reads at once, each batch is processed and saved before the next is read
+CONVOY_BATCH_SIZE = getattr(settings, "CONVOY_BATCH_SIZE", 64)
+# Each stage is a dotted path to a Stage class, optionally with a dict of its
+# arguments e.g. ("convoy.stages.GzipStage", {"patterns": ("*.css", "*.js", "*.svg")})
+CONVOY_PIPELINE = getattr(settings, "CONVOY_PIPELINE", (
+    "convoy.stages.HashStage",
+    "convoy.stages.MinifyStage",
+    "convoy.stages.GzipStage",
+    "convoy.stages.BrotliStage",
+))
+
+
+class Step(object):
+    '''
+    One stage applied to one asset
+    '''
+    def __init__(self, stage, index, input, output):
+        self.stage = stage
+        self.index = index
+        self.input = input
+        self.output = output
+        self.result = None
+        self.reused = False
+        self.fingerprint = None
+        self.output_fingerprint = None
+        self.seconds = 0.0
+        self.save_seconds = 0.0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+
+class Asset(object):
+    '''
+    An entry of the pipeline's asset index
+    chain holds every name the file has had, in the order get_chain walks them
+    '''
+    def __init__(self, name, contents=None, fingerprint=None):
+        self.name = name
+        self.chain = [name]
+        self.contents = contents
+        # the md5 of contents, while it's known
+        self.fingerprint = fingerprint
+        self.steps = []
+        self.reused = False
+
+
+def _process(stage, name, contents):
+    if is_spooled(contents):
+        return read_spooled(stage.process_chunks(name, iter_chunks(contents)))
+    return stage.process(name, contents)
+
+
+def _run_steps(asset):
+    '''
+    Runs every step of one asset, each step's output feeding the next
+    Each output is fingerprinted once, here, for incremental runs and for save_if_changed
+    Module level so it can be sent to a worker process
+    '''
+    if asset.reused or asset.contents is None:
+        return asset
+    contents = asset.contents
+    contents_fingerprint = asset.fingerprint or fingerprint(contents)
+    stage_cache = get_stage_cache()
+    for step in asset.steps:
+        step.fingerprint = contents_fingerprint
+        started = time.time()
+        result = step.result
+        if result is None and stage_cache is not None:
+            cache_key = stage_cache.key(step.stage.cache_name(step.input), contents_fingerprint)
+            result = stage_cache.get(cache_key)
+            if result is None:
+                result = _process(step.stage, step.input, contents)
+                stage_cache.set(cache_key, result)
+        elif result is None:
+            result = _process(step.stage, step.input, contents)
+        step.output_fingerprint = fingerprint(result)
+        step.seconds = time.time() - started
+        step.input_bytes, step.output_bytes = size_of(contents), size_of(result)
+        step.result = result
+        if not step.stage.encoding:
+            if contents is asset.contents:
+                # no step left reads the file's own contents
+                close(contents)
+            contents, contents_fingerprint = result, step.output_fingerprint
+    if contents is asset.contents:
+        close(contents)
+    asset.contents = None
+    return asset
+
+
+def _run_spooled(assets, spooled):
+    '''
+    Runs the steps of assets held in spooled files here, since open files can't
+    be sent to a worker process, and passes the workers an empty stand in
+    for each one.  The stand in's result is swapped back with spooled.pop(name)
+    A step's result known beforehand (e.g. a distribution's .min file) can be spooled too
+    '''
+    for asset in assets:
+        if is_spooled(asset.contents) or any(is_spooled(step.result) for step in asset.steps):
+            spooled[asset.name] = _run_steps(asset)
+            asset = Asset(asset.name)
+        yield asset
+
+
+def _drain(assets):
+    '''
+    Hands out assets first to last, dropping our reference to each one
+    so its contents can be freed as soon as it has been saved
+    '''
+    assets.reverse()
+    while assets:
+        yield assets.pop()
+
+
+class Report(object):
+    '''
+    What each step of a post processing run cost: seconds, bytes in and out
+    lines() sums it up per stage and kind of file, as_dict() has every step, for json
+    For choosing compression settings per asset class, see Stage.overrides
+    '''
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.steps = []
+        # seconds spent in each pass of the pipeline
+        self.phases = OrderedDict()
+
+    def add(self, step):
+        self.steps.append(step)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    def totals(self):
+        '''
+        (stage, extension) -> files, reused, seconds, save_seconds, bytes_in, bytes_out
+        reused steps only count towards reused
+        '''
+        totals = {}
+        for step in self.steps:
+            key = (step.stage.name, os.path.splitext(step.input)[1])
+            total = totals.setdefault(key, [0, 0, 0.0, 0.0, 0, 0])
+            if step.reused:
+                total[1] += 1
+                continue
+            total[0] += 1
+            total[2] += step.seconds
+            total[3] += step.save_seconds
+            total[4] += step.input_bytes
+            total[5] += step.output_bytes
+        return sorted(totals.items())
+
+    def slowest(self, count=10):
+        steps = [step for step in self.steps if not step.reused]
+        return sorted(steps, key=lambda step: step.seconds + step.save_seconds, reverse=True)[:count]
+
+    def as_dict(self):
+        stages = []
+        for (stage, ext), (files, reused, seconds, save_seconds, bytes_in, bytes_out) in self.totals():
+            stages.append(OrderedDict([
+                ("stage", stage), ("type", ext), ("files", files), ("reused", reused),
+                ("seconds", seconds), ("save_seconds", save_seconds),
+                ("bytes_in", bytes_in), ("bytes_out", bytes_out),
+                ("ratio", float(bytes_out) / bytes_in if bytes_in else 1.0),
+            ]))
+        files = []
+        for step in self.steps:
+            files.append(OrderedDict([
+                ("stage", step.stage.name), ("input", step.input), ("output", step.output),
+                ("reused", step.reused), ("seconds", step.seconds), ("save_seconds", step.save_seconds),
+                ("bytes_in", step.input_bytes), ("bytes_out", step.output_bytes),
+                ("ratio", float(step.output_bytes) / step.input_bytes if step.input_bytes else 1.0),
+            ]))
+        return OrderedDict([
+            ("started", self.started), ("seconds", self.seconds),
+            ("phases", self.phases), ("stages", stages), ("files", files),
+        ])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+    def lines(self, slowest=10):
+        yield "%-10s %-6s %6s %6s %9s %9s %12s %12s %7s" % (
+            "stage", "type", "files", "reused", "seconds", "saving", "bytes in", "bytes saved", "saved")
+        for (stage, ext), (files, reused, seconds, save_seconds, bytes_in, bytes_out) in self.totals():
+            saved = bytes_in - bytes_out
+            yield "%-10s %-6s %6d %6d %9.3f %9.3f %12d %12d %6.1f%%" % (
+                stage, ext, files, reused, seconds, save_seconds, bytes_in, saved,
+                100.0 * saved / bytes_in if bytes_in else 0)
+        yield "%.3f seconds: %s" % (self.seconds, ", ".join(
+            "%s %.3f" % (phase, seconds) for phase, seconds in self.phases.items()))
+        steps = self.slowest(slowest)
+        if steps:
+            yield "slowest:"
+        for step in steps:
+            yield "  %9.3f %-10s %s" % (step.seconds + step.save_seconds, step.stage.name, step.input)
+
+
+class Pipeline(object):
+    '''
+    An ordered list of stages run over a single index of assets
+
+    Stages that use the storage (hashing) run first, one file at a time, since
+    adjusting a css file's urls needs the hashed names of the files it points to.
+    Every other stage runs per asset in memory, on CONVOY_CPU_WORKERS processes,
+    with reads and saves on CONVOY_IO_WORKERS threads.
+
+    Adding a stage only takes a Stage subclass and an entry in CONVOY_PIPELINE
+    '''
+    def __init__(self, stages):
+        self.stages = list(stages)
+        seen_worker_stage = False
+        for stage in self.stages:
+            if not stage.uses_storage:
+                seen_worker_stage = True
+            elif seen_worker_stage:
+                raise ImproperlyConfigured("Pipeline stage %r uses the storage, "
+                    "it must come before every other stage" % stage)
+
+    @classmethod
+    def from_settings(cls, specs=None):
+        if specs is None:
+            specs = CONVOY_PIPELINE
+        stages = []
+        for spec in specs:
+            if isinstance(spec, Stage):
+                stages.append(spec)
+                continue
+            if isinstance(spec, six.string_types):
+                spec = (spec, {})
+            path, kwargs = spec
+            stages.append(import_string(path)(**kwargs))
+        return cls(stages)
+
+    def steps_for(self, name, skip=()):
+        steps = []
+        for index, stage in enumerate(self.stages):
+            if stage.uses_storage or stage.name in skip or not stage.matches(name):
+                continue
+            output = stage.output_name(name)
+            steps.append(Step(stage, index, name, output))
+            if not stage.encoding:
+                name = output
+        return steps
+
+    def run(self, storage, paths, skip=(), report=None):
+        '''
+        Post processes paths into storage, yielding (name, hashed_name, processed)
+        Adds every link of every asset's chain to storage.hashed_files
+        and what each step cost to report, by default storage.report
+
+        Files go through in batches of CONVOY_BATCH_SIZE, each one read, hashed,
+        processed and saved before the next is read, so only a batch's contents
+        are held at once (the pools' maps read their whole input as soon as they start)
+        '''
+        if report is None:
+            report = storage.report
+        linked_files = {}
+        # sorted by the directory level like HashedFilesMixin so css urls resolve
+        path_level = lambda name: len(name.split(os.sep))
+        names = sorted(paths.keys(), key=path_level, reverse=True)
+        with WorkerPools(jobs=len(names)) as pools:
+            for start in range(0, len(names), CONVOY_BATCH_SIZE):
+                batch = names[start:start + CONVOY_BATCH_SIZE]
+                assets = []
+                for processed in self.hash_assets(storage, pools, [(name, paths[name]) for name in batch],
+                                                  skip, assets, report):
+                    yield processed
+                for processed in self.process_assets(storage, pools, assets, linked_files, report):
+                    yield processed
+        # keep the manifest in the order the chained mixins used to leave it:
+        # stage by stage, and within a stage files the previous stage skipped come first
+        for key in sorted(linked_files):
+            storage.hashed_files.update(linked_files[key])
+
+    def hash_assets(self, storage, pools, items, skip, assets, report):
+        '''
+        First pass: stages that need the storage, one file at a time
+        Appends the assets with steps left to assets, keeping their contents for them
+        '''
+        storage_stages = [(index, s) for index, s in enumerate(self.stages) if s.uses_storage and s.name not in skip]
+        started = time.time()
+        for name, contents, file_hash, contents_fingerprint in pools.io_map(storage._read_source, items):
+            asset = Asset(name, contents, contents_fingerprint)
+            for stage_index, stage in storage_stages:
+                step = Step(stage, stage_index, asset.chain[-1], None)
+                step.input_bytes = size_of(asset.contents)
+                step_started = time.time()
+                output, contents, processed, errors = stage.run(storage, asset.chain[-1], asset.contents,
+                                                                file_hash=file_hash)
+                if contents is not asset.contents:
+                    # e.g. css whose urls were adjusted, the hashes were of the old bytes
+                    close(asset.contents)
+                    asset.contents, asset.fingerprint, file_hash = contents, None, None
+                # run() saves as it goes, so this is all save time for files it doesn't change
+                step.seconds = time.time() - step_started
+                step.output, step.output_bytes, step.reused = output, size_of(asset.contents), not processed
+                self.finished_step(storage, step, report)
+                for exc in errors:
+                    yield name, None, exc
+                # in hashed_files at once, the css of this or a later batch may point at it
+                storage.hashed_files[storage.hash_key(asset.chain[-1])] = output
+                yield asset.chain[-1], output, processed
+                asset.chain.append(output)
+            asset.steps = self.steps_for(asset.chain[-1], skip)
+            if asset.steps:
+                assets.append(asset)
+            else:
+                close(asset.contents)
+                asset.contents = None
+        report.add_phase("read and hash", time.time() - started)
+
+    def process_assets(self, storage, pools, assets, linked_files, report):
+        '''
+        Second pass: every other stage in memory (or a chunk at a time for
+        spooled files), then write each output once
+        Adds the links each stage made to linked_files, by stage
+        '''
+        spooled = {}
+        started = time.time()
+        prepared = pools.io_map(storage._prepare_asset, _drain(assets))
+        processed_assets = pools.cpu_map(_run_steps, _run_spooled(prepared, spooled))
+        processed_assets = (spooled.pop(asset.name, asset) for asset in processed_assets)
+        for asset in pools.io_map(storage._save_asset, processed_assets):
+            for position, step in enumerate(asset.steps):
+                encoding = step.stage.encoding
+                if encoding:
+                    variants = storage.encoded_files.setdefault(storage.hash_key(step.input), OrderedDict())
+                    variants[encoding] = step.output
+                # gzip stays linked in the chain so get_chain(gzip=True) keeps working
+                if encoding in (None, "gzip"):
+                    files = linked_files.setdefault((step.index, position), OrderedDict())
+                    files[storage.hash_key(step.input)] = step.output
+                storage.fingerprints[step.input] = step.fingerprint
+                self.finished_step(storage, step, report)
+                asset.chain.append(step.output)
+                yield step.input, step.output, not step.reused
+        report.add_phase("process and save", time.time() - started)
+
+    def finished_step(self, storage, step, report=None):
+        (storage.report if report is None else report).add(step)
+        signals.step_finished.send(sender=storage.__class__, storage=storage, step=step)
+
+
+class PipelineMixin(HashedFilesMixin):
+    '''
+    Post processes every asset in a single pass of the storage's Pipeline
+     - each file is read once, then hashed, minified and gzipped in memory,
+       or through a spooled temporary file when it's bigger than CONVOY_SPOOL_THRESHOLD
+     - each artifact (hashed, .cmin, .gz) is written once and never read back
+     - hashed_files ends up with the same chain get_chain walks:
+           base > base.hash > base.hash.cmin > base.hash.cmin.gz
+
+    The stages come from CONVOY_PIPELINE, or set pipeline on a subclass.
+    _should_<stage name> = False turns a stage off for this storage.
+
+    With CONVOY_INCREMENTAL, assets whose contents haven't changed since the
+    last collectstatic reuse their previous outputs, with CONVOY_STAGE_CACHE_ROOT
+    stage outputs are also kept in a content addressed cache
+    '''
+    pipeline = None
+    # what file names are fingerprinted with, set from CONVOY_HASH and
+    # CONVOY_HASH_LENGTH by post_process and from the manifest when it's loaded
+    hash_algorithm = CONVOY_HASH
+    hash_length = CONVOY_HASH_LENGTH
+    _should_hash = True
+    _should_minify = True
+    _should_gzip = True
+
+    encoded_files = None
+    fingerprints = None
+    report = None
+    previous_fingerprints = None
+    previous_hashed_files = None
+    previous_encoded_files = None
+
+    def get_pipeline(self):
+        if self.pipeline is None:
+            self.pipeline = Pipeline.from_settings()
+        return self.pipeline
+
+    def load_previous_manifest(self):
+        '''
+        Called by collectstatic before hashed_files is cleared
+        '''
+        self.fingerprints = OrderedDict()
+        self.previous_fingerprints = {}
+        self.previous_hashed_files = {}
+        self.previous_encoded_files = {}
+        if not CONVOY_INCREMENTAL or not hasattr(self, 'read_manifest'):
+            return
+        content = self.read_manifest()
+        if content is None:
+            return
+        try:
+            stored = json.loads(content)
+        except ValueError:
+            return
+        self.previous_fingerprints = stored.get('fingerprints', {})
+        self.previous_hashed_files = stored.get('paths', {})
+        self.previous_encoded_files = stored.get('encodings', {})
+
+    def file_hash(self, name, content=None):
+        '''
+        The first hash_length hex digits of content's hash_algorithm hash
+        or content.convoy_hash, when it was hashed as it was read
+        '''
+        if content is None:
+            return None
+        file_hash = getattr(content, 'convoy_hash', None)
+        if file_hash is not None:
+            return file_hash
+        hasher = new_hash(self.hash_algorithm)
+        for chunk in content.chunks():
+            hasher.update(chunk)
+        return digest(hasher, self.hash_length)
+
+    def hash_contents(self, contents):
+        '''
+        The file_hash and the md5 fingerprint of contents, bytes or a spooled file, in one read
+        '''
+        hasher, md5 = new_hash(self.hash_algorithm), hashlib.md5()
+        for chunk in hash_chunks(iter_chunks(contents), hasher, md5):
+            pass
+        return digest(hasher, self.hash_length), md5.hexdigest()
+
+    def split_hash(self, name):
+        '''
+        (name without its fingerprint, the fingerprint or None), see convoy.hashing.split_hash
+        '''
+        return split_hash(name, self.hash_length)
+
+    def _read_source(self, item):
+        '''
+        Returns name, the file's contents, its file_hash and its md5 fingerprint,
+        both hashed as the file is read
+        '''
+        name, (storage, path) = item
+        hasher, md5 = new_hash(self.hash_algorithm), hashlib.md5()
+        # use the original, local file, not the copied-but-unprocessed
+        # file, which might be somewhere far away, like S3
+        with storage.open(path) as original_file:
+            contents = read_spooled(hash_chunks(original_file.chunks(), hasher, md5))
+        return name, contents, digest(hasher, self.hash_length), md5.hexdigest()
+
+    def _step_reusable(self, step, input_fingerprint):
+        key = self.hash_key(step.input)
+        if step.stage.encoding:
+            previous_output = self.previous_encoded_files.get(key, {}).get(step.stage.encoding)
+        else:
+            previous_output = self.previous_hashed_files.get(key)
+        return input_fingerprint is not None and \
+            self.previous_fingerprints.get(step.input) == input_fingerprint and \
+            previous_output == step.output and \
+            self.exists(step.output)
+
+    def _prepare_asset(self, asset):
+        '''
+        Marks the steps we can skip because the previous run already did them
+        '''
+        if self.previous_fingerprints:
+            if asset.fingerprint is None:
+                asset.fingerprint = fingerprint(asset.contents)
+            input_fingerprints = {asset.steps[0].input: asset.fingerprint}
+            for step in asset.steps:
+                input_fingerprint = input_fingerprints.get(step.input)
+                if not self._step_reusable(step, input_fingerprint):
+                    break
+                step.reused = True
+                step.fingerprint = input_fingerprint
+                input_fingerprints[step.output] = self.previous_fingerprints.get(step.output)
+        asset.reused = all(step.reused for step in asset.steps)
+        if asset.reused:
+            close(asset.contents)
+            asset.contents = None
+            return asset
+        first_step = asset.steps[0]
+        first_step.result = first_step.stage.existing_output(self, first_step.input)
+        return asset
+
+    def stored_digest(self, name):
+        '''
+        The md5 hexdigest of the stored file, or None when there isn't one
+        Storages that know it without reading the file (e.g. S3's ETag) override this
+        '''
+        if not self.exists(name):
+            return None
+        digest = hashlib.md5()
+        with self.open(name) as stored_file:
+            for chunk in stored_file.chunks():
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def save_if_changed(self, name, contents, contents_fingerprint=None):
+        '''
+        Saves contents as name, unless the stored file already has the same bytes
+        Replaces exists(), delete(), save(): on S3 that's one HEAD instead of a HEAD,
+        a DELETE and a PUT per unchanged file
+        Pass contents' md5 fingerprint when it's already known
+        '''
+        stored_digest = self.stored_digest(name)
+        if stored_digest == (contents_fingerprint or fingerprint(contents)):
+            return name
+        # Storages that don't overwrite would save under a new name
+        if stored_digest is not None and not getattr(self, "file_overwrite", False):
+            self.delete(name)
+        return self._save(name, as_file(contents))
+
+    def _save_asset(self, asset):
+        for step in asset.steps:
+            if not step.reused:
+                started = time.time()
+                self.save_if_changed(step.output, step.result, step.output_fingerprint)
+                step.save_seconds = time.time() - started
+            close(step.result)
+            step.result = None
+        return asset
+
+    def post_process(self, paths, dry_run=False, **options):
+        # don't even dare to process the files if we're in dry run mode
+        if dry_run:
+            return
+        # a new run fingerprints with the current settings, whatever the manifest it replaces used
+        self.hash_algorithm, self.hash_length = CONVOY_HASH, CONVOY_HASH_LENGTH
+        self.report = Report()
+        for processed in self.process_files(paths, self.skipped_stages(), self.report):
+            yield processed
+        if CONVOY_REPORT_PATH:
+            self.report.save(CONVOY_REPORT_PATH)
+
+    def skipped_stages(self, *names):
+        '''
+        names and the stages turned off with _should_<stage name> = False
+        '''
+        return list(names) + [stage.name for stage in self.get_pipeline().stages
+                              if not getattr(self, "_should_%s" % stage.name, True)]
+
+    def process_files(self, paths, skip=(), report=None):
+        '''
+        Runs paths through the pipeline, but for the stages named in skip, adding
+        to hashed_files rather than starting it over like ManifestFilesMixin.post_process
+        What it cost goes to report, a new one by default: carpool builds bundles
+        at runtime, while other threads use the storage
+        '''
+        if self.fingerprints is None:
+            self.fingerprints = OrderedDict()
+        if self.encoded_files is None:
+            self.encoded_files = {}
+        if report is None:
+            report = Report()
+        for processed in self.get_pipeline().run(self, paths, skip, report):
+            yield processed
+        if hasattr(self, "tables_changed"):
+            self.tables_changed()
+        report.finish()
+        signals.report_finished.send(sender=self.__class__, storage=self, report=report)
@@ -0,0 +1,225 @@
+'''
+Where the carpool bundles built at runtime are published for every process
+
+A bundle's entry is what a process needs to serve it: the links of its chain
+and their precompressed variants.  It's kept in a django cache (CARPOOL_REGISTRY_CACHE),
+or by default in a json file beside the manifest, on the storage itself so
+every machine reading the storage shares it (they then lock it with
+CARPOOL_LOCK_CACHE, without it they use the default cache).  Lookups are remembered for
+CARPOOL_REGISTRY_TTL seconds, so a bundle still being built costs a dict lookup.
+
+collectstatic starts the registry over, bundles are built once per deploy
+'''
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+from convoy.locks import CARPOOL_LOCK_CACHE, FileLock, get_lock, wait_for
+
+# The django cache (by alias) bundles are published in, None keeps them in CARPOOL_REGISTRY_NAME on the storage
+CARPOOL_REGISTRY_CACHE = getattr(settings, "CARPOOL_REGISTRY_CACHE", None)
+CARPOOL_REGISTRY_NAME = getattr(settings, "CARPOOL_REGISTRY_NAME", "staticfiles.carpool.json")
+# Seconds a process remembers what it looked up, found or not
+CARPOOL_REGISTRY_TTL = getattr(settings, "CARPOOL_REGISTRY_TTL", 5)
+
+REGISTRY_LOCK = "registry"
+
+
+def bundle_entry(storage, comment_key):
+    '''
+    The links of the bundle's chain, {hash key: next link}, and their encoded variants
+    '''
+    chain = storage.get_chain(comment_key, gzip=True)
+    paths = OrderedDict((storage.hash_key(link), next_link) for link, next_link in zip(chain, chain[1:]))
+    encoded_files = storage.encoded_files or {}
+    encodings = dict((storage.hash_key(link), encoded_files[storage.hash_key(link)])
+                     for link in chain if storage.hash_key(link) in encoded_files)
+    return {"paths": paths, "encodings": encodings}
+
+
+def install_entry(storage, entry):
+    '''
+    Adds a bundle's entry to the storage's tables in memory
+    '''
+    if storage.encoded_files is None:
+        storage.encoded_files = {}
+    # the variants first, a render that finds the links finds them too
+    for key, variants in entry["encodings"].items():
+        storage.encoded_files[key] = variants
+    for key, link in entry["paths"].items():
+        storage.hashed_files[key] = link
+    if hasattr(storage, "tables_changed"):
+        storage.tables_changed()
+
+
+class BundleRegistry(object):
+    '''
+    Remembers lookups for ttl seconds, subclasses fetch(), store() and clear()
+    '''
+    def __init__(self, ttl=None):
+        self.ttl = CARPOOL_REGISTRY_TTL if ttl is None else ttl
+        self._seen = {}
+
+    def lookup(self, comment_key, fresh=False):
+        '''
+        The bundle's entry, or None when no process published it
+        fresh=True asks the registry, rather than what was remembered
+        '''
+        now = time.time()
+        seen = self._seen.get(comment_key)
+        if seen is not None and seen[0] > now and not fresh:
+            return seen[1]
+        entry = self.fetch(comment_key, fresh)
+        self._seen[comment_key] = (now + self.ttl, entry)
+        return entry
+
+    def publish(self, entries, lock=None):
+        '''
+        Adds {comment key: entry} to the registry
+        '''
+        self.store(entries, lock)
+        expires = time.time() + self.ttl
+        for comment_key, entry in entries.items():
+            self._seen[comment_key] = (expires, entry)
+
+    def forget(self):
+        '''
+        Drops what was remembered, the next lookups go to the registry
+        '''
+        self._seen = {}
+
+
+class CacheRegistry(BundleRegistry):
+    '''
+    One cache key per bundle, under a generation key that clear() replaces
+    '''
+    prefix = "convoy-carpool:"
+
+    def __init__(self, alias=None, ttl=None):
+        from django.core.cache import caches
+        super(CacheRegistry, self).__init__(ttl)
+        self.cache = caches[alias or CARPOOL_REGISTRY_CACHE]
+        self._generation = (0, None)
+
+    def generation(self):
+        expires, generation = self._generation
+        if expires <= time.time():
+            generation = self.cache.get(self.prefix + "generation") or "0"
+            self._generation = (time.time() + self.ttl, generation)
+        return generation
+
+    def key(self, comment_key):
+        return "%s%s:%s" % (self.prefix, self.generation(), hashlib.md5(comment_key.encode('utf-8')).hexdigest())
+
+    def fetch(self, comment_key, fresh=False):
+        return self.cache.get(self.key(comment_key))
+
+    def store(self, entries, lock=None):
+        self.cache.set_many(dict((self.key(comment_key), entry) for comment_key, entry in entries.items()), None)
+
+    def clear(self):
+        generation = uuid.uuid4().hex
+        self.cache.set(self.prefix + "generation", generation, None)
+        self._generation = (time.time() + self.ttl, generation)
+        self.forget()
+
+
+class StorageRegistry(BundleRegistry):
+    '''
+    Every bundle in one json file on the storage, read at most once per ttl
+    '''
+    def __init__(self, storage, name=None, ttl=None):
+        super(StorageRegistry, self).__init__(ttl)
+        self.storage = storage
+        self.name = name or CARPOOL_REGISTRY_NAME
+        self._entries = (0, {})
+        self._read_lock = threading.Lock()
+
+    def read(self):
+        if hasattr(self.storage, "local_cache"):
+            # our local copy is of the registry some process published before
+            self.storage.local_cache.delete(self.name)
+        if not self.storage.exists(self.name):
+            return OrderedDict()
+        with self.storage.open(self.name) as f:
+            return json.loads(f.read().decode('utf-8'), object_pairs_hook=OrderedDict)
+
+    def fetch(self, comment_key, fresh=False):
+        with self._read_lock:
+            expires, entries = self._entries
+            if expires <= time.time() or fresh:
+                try:
+                    entries = self.read()
+                except (IOError, ValueError):
+                    entries = {}
+                self._entries = (time.time() + self.ttl, entries)
+        return entries.get(comment_key)
+
+    def store(self, entries, lock=None):
+        # read, add and write back under a lock, so two processes publishing at once don't lose each other's
+        lock = lock or get_lock()
+        if isinstance(lock, FileLock) and not self.on_this_machine():
+            raise ImproperlyConfigured("%s is shared by several machines, lock it in a cache they share "
+                                       "with CARPOOL_LOCK_CACHE" % self.name)
+        if not wait_for(lock, REGISTRY_LOCK):
+            raise RuntimeError("Timed out waiting for the lock on %s" % self.name)
+        try:
+            stored = self.read()
+            stored.update(entries)
+            contents = json.dumps(stored).encode('utf-8')
+            if hasattr(self.storage, "save_if_changed"):
+                self.storage.save_if_changed(self.name, contents)
+            else:
+                if self.storage.exists(self.name):
+                    self.storage.delete(self.name)
+                self.storage.save(self.name, ContentFile(contents))
+        finally:
+            lock.release(REGISTRY_LOCK)
+        with self._read_lock:
+            self._entries = (time.time() + self.ttl, stored)
+
+    def on_this_machine(self):
+        '''
+        Whether the registry is a file of this machine, which a FileLock can lock
+        '''
+        try:
+            self.storage.path(self.name)
+        except NotImplementedError:
+            return False
+        return True
+
+    def forget(self):
+        super(StorageRegistry, self).forget()
+        self._entries = (0, {})
+
+    def clear(self):
+        if self.storage.exists(self.name):
+            self.storage.delete(self.name)
+        self.forget()
+
+
+def get_registry(storage):
+    '''
+    The storage's registry, made on first use
+    A storage other machines share (S3) without CARPOOL_LOCK_CACHE gets one in the default cache
+    '''
+    registry = getattr(storage, "bundle_registry", None)
+    if registry is None:
+        if CARPOOL_REGISTRY_CACHE:
+            registry = CacheRegistry()
+        else:
+            registry = StorageRegistry(storage)
+            if not CARPOOL_LOCK_CACHE and not registry.on_this_machine():
+                # the lock files of one machine can't keep the others from overwriting the
+                # registry file, a key per bundle in django's default cache needs no lock
+                from django.core.cache import DEFAULT_CACHE_ALIAS
+                registry = CacheRegistry(DEFAULT_CACHE_ALIAS)
+        storage.bundle_registry = registry
+    return registry
@@ -12,10 +12,13 @@ TEMP_DIR = tempfile.mkdtemp(prefix='django_')
 os.environ['DJANGO_TEST_TEMP_DIR'] = TEMP_DIR
 
 def findtests():
-    suite = unittest.defaultTestLoader.discover('tests', 'tests.py', PROJECT_PATH)
-
+    # the tests import convoy, whose modules read the settings
     if "DJANGO_SETTINGS_MODULE" not in os.environ:
         os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.test_sqlite'
+    import django
+    django.setup()
+
+    suite = unittest.defaultTestLoader.discover('tests', 'tests.py', PROJECT_PATH)
 
     unittest.TextTestRunner().run(suite)
 
@@ -0,0 +1,17 @@
+'''
+Sent while the pipeline post processes files, for forwarding its numbers to a metrics system
+
+    from convoy.signals import step_finished
+
+    @receiver(step_finished)
+    def time_step(sender, storage, step, **kwargs):
+        statsd.timing("convoy.%s" % step.stage.name, step.seconds * 1000)
+
+sender is the storage's class
+'''
+from django.dispatch import Signal
+
+# Each step (one stage applied to one file) once its output is saved, see convoy.pipeline.Step
+step_finished = Signal(providing_args=["storage", "step"])
+# The run's convoy.pipeline.Report, once post processing is done
+report_finished = Signal(providing_args=["storage", "report"])
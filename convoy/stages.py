@@ -0,0 +1,342 @@
+from django.conf import settings
+from django.contrib.staticfiles.utils import matches_patterns
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_bytes, force_text
+
+import logging
+import struct
+import zlib
+
+from convoy.minifiers import minifier_name, minify
+from convoy.streams import as_file, read_all, read_spooled, rechunk
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import zopfli.gzip
+except ImportError:
+    zopfli = None
+
+CONVOY_USE_EXISTING_MIN_FILES = getattr(settings, "CONVOY_USE_EXISTING_MIN_FILES", False)
+
+logger = logging.getLogger(__name__)
+
+
+def gzip_compress(contents, level=9, wbits=15, mem_level=8):
+    '''
+    The same bytes as gzip.GzipFile(mtime=0) at level, with the deflate
+    window (wbits) and memory (mem_level) parameters exposed
+    '''
+    return "".join(gzip_chunks([contents], level, wbits, mem_level))
+
+
+def gzip_chunks(chunks, level=9, wbits=15, mem_level=8):
+    '''
+    gzip_compress() a chunk at a time, yields the compressed chunks
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -wbits, mem_level, 0)
+    yield "\037\213\010\000"  # magic, deflate, no flags
+    yield struct.pack("<I", 0)  # mtime, 0 keeps the output reproducible
+    yield "\002\377"  # extra flags, unknown os
+    crc, size = 0, 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+    yield struct.pack("<I", crc & 0xffffffff)
+    yield struct.pack("<I", size & 0xffffffff)
+
+def zopfli_compress(contents, iterations=15):
+    '''
+    Exhaustive deflate, standard gzip output that's a few percent smaller than level 9
+    and around a hundred times slower to produce
+    '''
+    return zopfli.gzip.compress(contents, numiterations=iterations)
+
+
+class Stage(object):
+    '''
+    One step of the convoy pipeline
+
+    A stage takes the bytes of a file whose name matches its patterns (and none
+    of its exclude patterns) and returns new bytes, which are saved under
+    output_name(name) and linked to name in the manifest.
+
+    process() runs in a worker process when CONVOY_CPU_WORKERS > 1, so it must
+    only use the stage's own attributes, and everything set in __init__ must be
+    picklable.  Files bigger than CONVOY_SPOOL_THRESHOLD go to process_chunks()
+    instead, in the collectstatic process, see convoy.streams.
+
+    Extra keyword arguments are kept in self.options and are part of the stage cache key.
+
+    overrides gives different options to some files: a list of (patterns, options)
+    pairs, the first pair whose patterns match the file's name is applied over
+    self.options e.g. overrides=[(("*.js",), {"level": 6})]
+    '''
+    name = None
+    patterns = ("*",)
+    exclude = ()
+    # Stages that need the storage (e.g. to read other files) run first, one file at a time
+    uses_storage = False
+    # Content-Encoding of the output, for compressors
+    # encoded outputs are siblings: they don't feed the next stage, which gets
+    # this stage's input instead, and the template tags pick between them
+    encoding = None
+    overrides = ()
+
+    def __init__(self, patterns=None, exclude=None, overrides=None, **options):
+        if patterns is not None:
+            self.patterns = tuple(patterns)
+        if exclude is not None:
+            self.exclude = tuple(exclude)
+        if overrides is not None:
+            self.overrides = tuple((tuple(patterns), dict(override)) for patterns, override in overrides)
+        self.options = options
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+    def options_for(self, name):
+        options = dict(self.options)
+        for patterns, override in self.overrides:
+            if matches_patterns(name, patterns):
+                options.update(override)
+                break
+        return options
+
+    def cache_name(self, name):
+        return "%s:%s" % (self.name, sorted(self.options_for(name).items()))
+
+    def matches(self, name):
+        if not matches_patterns(name, self.patterns):
+            return False
+        return not (self.exclude and matches_patterns(name, self.exclude))
+
+    def output_name(self, name):
+        raise NotImplementedError
+
+    def existing_output(self, storage, name):
+        '''
+        Returns contents to use instead of running process(), or None
+        '''
+        return None
+
+    def process(self, name, contents):
+        raise NotImplementedError
+
+    def process_chunks(self, name, chunks):
+        '''
+        process() for a file too big to hold in memory, yields the output in chunks
+        Stages that can work a chunk at a time (compressors) override it, the rest
+        get the whole file at once
+        '''
+        yield self.process(name, "".join(chunks))
+
+
+class HashStage(Stage):
+    '''
+    Fingerprints each file and adjusts the urls in css files
+    HashedFilesMixin.post_process for a single file whose contents are already read
+    The fingerprint is taken a chunk at a time, css is read whole to adjust its urls
+    '''
+    name = "hash"
+    uses_storage = True
+
+    def run(self, storage, name, contents, file_hash=None):
+        '''
+        returns the hashed name, the (possibly adjusted) contents, whether it was saved,
+        and any errors raised while adjusting urls
+        file_hash is the storage's file_hash of contents, when it was worked out as they were read
+        '''
+        errors = []
+        content = as_file(contents)
+        content.convoy_hash = file_hash
+        hashed_name = storage.hashed_name(name, content)
+        processed = False
+        if matches_patterns(name, storage._patterns.keys()):
+            content = read_all(contents).decode(settings.FILE_CHARSET)
+            for patterns in storage._patterns.values():
+                for pattern, template in patterns:
+                    converter = storage.url_converter(name, template)
+                    try:
+                        content = pattern.sub(converter, content)
+                    except ValueError as exc:
+                        errors.append(exc)
+            contents = force_bytes(content)
+            saved_name = storage.save_if_changed(hashed_name, contents)
+            hashed_name = force_text(storage.clean_name(saved_name))
+            processed = True
+        elif not storage.exists(hashed_name):
+            # the name is the hash of the contents, an existing file is the same file
+            processed = True
+            saved_name = storage._save(hashed_name, as_file(contents))
+            hashed_name = force_text(storage.clean_name(saved_name))
+        return hashed_name, contents, processed, errors
+
+
+class MinifyStage(Stage):
+    '''
+    Minifies css and js into name.cmin.ext
+    With CONVOY_USE_EXISTING_MIN_FILES, uses the distribution's name.min.ext when there is one
+
+    engines picks a minifier from convoy.minifiers by file type e.g. engines={"css": "cssmin"},
+    CONVOY_MINIFIERS picks the ones it doesn't
+    '''
+    name = "minify"
+    patterns = ("*.css", "*.js")
+    exclude = ("*.min.*",)
+    marker = "cmin"
+
+    def __init__(self, *args, **kwargs):
+        engines = kwargs.pop("engines", None) or {}
+        super(MinifyStage, self).__init__(*args, **kwargs)
+        self.engines = dict((file_type, minifier_name(file_type, engines.get(file_type)))
+                            for file_type in ("css", "js"))
+
+    def output_name(self, name):
+        split_path = name.split(".")
+        split_path.insert(-1, self.marker)
+        return ".".join(split_path)
+
+    def existing_output(self, storage, name):
+        if not CONVOY_USE_EXISTING_MIN_FILES:
+            return None
+        #This works best if minification is FIRST OR SECOND in the pipeline
+        # if a minified file exists from the distribution, use it
+        # we want all bugs in minified code to match the distributed bugs 1 to 1
+        # the distribution's file is named after the file before it was fingerprinted
+        if hasattr(storage, "split_hash"):
+            name = storage.split_hash(name)[0]
+        split_path = name.split(".")
+        split_path.insert(-1, "min")
+        dist_min_path = ".".join(split_path)
+        if storage.exists(dist_min_path):
+            logger.info("Using existing minified file %s", dist_min_path)
+            #Copy the existing minified file into our name scheme
+            f = storage.open(dist_min_path)
+            min_contents = read_spooled(f.chunks())
+            f.close()
+            return min_contents or None
+        return None
+
+    def cache_name(self, name):
+        # the same bytes minify differently as css and as js, and with each minifier
+        file_type = name.split(".")[-1]
+        return "%s:%s:%s" % (super(MinifyStage, self).cache_name(name), file_type, self.engines.get(file_type))
+
+    def process(self, name, contents):
+        file_type = name.split(".")[-1]
+        return minify(contents, file_type, self.engines.get(file_type))
+
+
+class GzipStage(Stage):
+    '''
+    Gzips css and js into name.gz
+    Based on GZIPMixin from from django-pipeline
+
+    Options: level (1-9, default 9), wbits (9-15) and mem_level (1-9) for zlib,
+    or zopfli=True (requires the zopfli package) with iterations, which
+    takes much longer for smaller, still standard, .gz files
+    '''
+    name = "gzip"
+    patterns = ("*.css", "*.js")
+    encoding = "gzip"
+
+    def __init__(self, *args, **kwargs):
+        super(GzipStage, self).__init__(*args, **kwargs)
+        uses_zopfli = [self.options] + [override for patterns, override in self.overrides]
+        if zopfli is None and any(options.get("zopfli") for options in uses_zopfli):
+            raise ImproperlyConfigured("GzipStage with zopfli=True requires the zopfli package: pip install zopfli")
+
+    def output_name(self, name):
+        return "{0}.gz".format(name)
+
+    def process(self, name, contents):
+        options = self.options_for(name)
+        if options.pop("zopfli", False):
+            return zopfli_compress(contents, options.get("iterations", 15))
+        options.pop("iterations", None)
+        return gzip_compress(contents, **options)
+
+    def process_chunks(self, name, chunks):
+        options = self.options_for(name)
+        if options.pop("zopfli", False):
+            # zopfli needs the whole file
+            return super(GzipStage, self).process_chunks(name, chunks)
+        options.pop("iterations", None)
+        return gzip_chunks(chunks, **options)
+
+
+class BrotliStage(Stage):
+    '''
+    Compresses css and js into name.br, served to browsers that accept br
+    Requires the brotli package, quality defaults to the maximum since
+    static files are compressed once and downloaded many times
+    Options: quality (0-11), lgwin (10-24), mode (1 for text)
+    '''
+    name = "brotli"
+    patterns = ("*.css", "*.js")
+    encoding = "br"
+
+    def __init__(self, *args, **kwargs):
+        if brotli is None:
+            raise ImproperlyConfigured("BrotliStage requires the brotli package: pip install brotli")
+        kwargs.setdefault("quality", 11)
+        super(BrotliStage, self).__init__(*args, **kwargs)
+
+    def output_name(self, name):
+        return "{0}.br".format(name)
+
+    def process(self, name, contents):
+        return brotli.compress(contents, **self.options_for(name))
+
+    def process_chunks(self, name, chunks):
+        compressor = brotli.Compressor(**self.options_for(name))
+        # brotli compresses small inputs to process() worse than the same bytes at once
+        for chunk in rechunk(chunks, 1024 * 1024):
+            compressed = compressor.process(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+
+
+class ZstdStage(Stage):
+    '''
+    Compresses css and js into name.zst, served to browsers that accept zstd
+    Requires the zstandard package
+    Options: level (1-22)
+    '''
+    name = "zstd"
+    patterns = ("*.css", "*.js")
+    encoding = "zstd"
+
+    def __init__(self, *args, **kwargs):
+        if zstandard is None:
+            raise ImproperlyConfigured("ZstdStage requires the zstandard package: pip install zstandard")
+        kwargs.setdefault("level", 19)
+        super(ZstdStage, self).__init__(*args, **kwargs)
+
+    def output_name(self, name):
+        return "{0}.zst".format(name)
+
+    def process(self, name, contents):
+        return zstandard.ZstdCompressor(**self.options_for(name)).compress(contents)
+
+    def process_chunks(self, name, chunks):
+        compressor = zstandard.ZstdCompressor(**self.options_for(name)).compressobj()
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
@@ -1,42 +1,54 @@
 from django.conf import settings
 from django.contrib.staticfiles.storage import StaticFilesStorage, HashedFilesMixin, ManifestFilesMixin
-from django.contrib.staticfiles.utils import matches_patterns
-from django.core.files.base import ContentFile
-from django.core.files import File
+from django.core.files.base import ContentFile, File
 from django.utils.six.moves.urllib.parse import unquote
 
 from s3_folder_storage.s3 import StaticStorage as S3FolderStaticStorage
 from s3_folder_storage.s3 import FixedS3BotoStorage as S3BotoStorage
+from storages.backends.s3boto import parse_ts_extended
+
+from convoy.cache import LocalFileCache, ResolutionCache
+from convoy.hashing import CONVOY_HASH, CONVOY_HASH_LENGTH, manifest_hashing
+from convoy.manifest import CONVOY_MANIFEST_INDEX, ManifestIndex, build_index, index_tables
+from convoy.pipeline import PipelineMixin
+from convoy.transfer import MD5_METADATA, TransferManager, content_size
 
 from collections import OrderedDict
-from io import BytesIO
-import copy
-import gzip
+import datetime
+import hashlib
+import itertools
 import json
+import logging
+import mimetypes
+import os
+import threading
+import time
 
-import cssmin
-try:
-    from _rjsmin import jsmin
-except ImportError:
-    try:
-        from rjsmin import jsmin
-    except ImportError:
-        from jsmin import jsmin as _jsmin
-        def jsmin(string, *args, **kwargs):
-            return _jsmin(string)
-
-CONVOY_USE_EXISTING_MIN_FILES = getattr(settings, "CONVOY_USE_EXISTING_MIN_FILES", False)
 CONVOY_AWS_QUERYSTRING_AUTH = getattr(settings, 'CONVOY_AWS_QUERYSTRING_AUTH', True)
 CONVOY_AWS_HEADERS = getattr(settings, 'CONVOY_AWS_HEADERS', {})
-CONVOY_LOCAL_CACHE_ROOT = getattr(settings, 'CONVOY_LOCAL_CACHE_ROOT', getattr(settings, "STATIC_ROOT", ""))
+# A directory of its own: the cache prunes whatever it finds in it to CONVOY_LOCAL_CACHE_MAX_BYTES
+CONVOY_LOCAL_CACHE_ROOT = getattr(settings, 'CONVOY_LOCAL_CACHE_ROOT',
+                                  os.path.join(getattr(settings, "STATIC_ROOT", None) or "", ".convoy-cache"))
+# Seconds between checks for a new manifest on the storage, None never checks
+CONVOY_MANIFEST_RELOAD_INTERVAL = getattr(settings, 'CONVOY_MANIFEST_RELOAD_INTERVAL', None)
+
+logger = logging.getLogger(__name__)
+
+_manifest_check_lock = threading.Lock()
+# next() of a count is atomic, two threads changing the tables at once each get a version of their own
+_table_versions = itertools.count(1)
+
 
 class S3LocalCachedMixin(object):
     """
     Mixin that adds local caching to S3 storage backend
+    Keeps at most CONVOY_LOCAL_CACHE_MAX_BYTES in CONVOY_LOCAL_CACHE_ROOT, see LocalFileCache
     """
     def __init__(self, *args, **kwargs):
-        super(S3LocalCachedMixin, self).__init__(*args, **kwargs)
+        # before super().__init__, which reads the manifest through open()
         self._local = StaticFilesStorage(location=CONVOY_LOCAL_CACHE_ROOT)
+        self.local_cache = LocalFileCache(self._local.location)
+        super(S3LocalCachedMixin, self).__init__(*args, **kwargs)
 
     def save(self, name, content, *args, **kwargs):
         if not hasattr(content, 'chunks'):
@@ -47,246 +59,258 @@ class S3LocalCachedMixin(object):
     def _save(self, name, content, *args, **kwargs):
         # some configurations of s3 backend mutate the content in place 
         # Esp when AWS_IS_GZIPPED = True
-        # keep a pre-mutation copy for the local cache so we don't save garbage to disk
-        orig_content = copy.copy(content)
-        sname = super(S3LocalCachedMixin, self)._save(name, content, *args, **kwargs)
-        if self._local.exists(name):
-            self._local.delete(name)
-        lname = self._local._save(name, orig_content, *args, **kwargs)
+        # so stream it to the local cache first, and only publish it there once it's on s3
+        content.seek(0)
+        staged = self.local_cache.stage(content.chunks())
+        try:
+            content.seek(0)
+            sname = super(S3LocalCachedMixin, self)._save(name, content, *args, **kwargs)
+        except Exception:
+            self.local_cache.discard(staged)
+            raise
+        self.local_cache.commit(name, staged)
         return name        
         
-    def delete(self, *args, **kwargs):
-        if self._local.exists(*args, **kwargs):
-            self._local.delete(*args, **kwargs)
-        return super(S3LocalCachedMixin, self).delete(*args, **kwargs)
+    def delete(self, name, *args, **kwargs):
+        self.local_cache.delete(name)
+        return super(S3LocalCachedMixin, self).delete(name, *args, **kwargs)
         
-    def open(self, name, *args, **kwargs):
-        if self._local.exists(name):
-            #print "reading %s from cache" % name
-            return self._local.open(name, *args, **kwargs)
-        else:
-            #print "reading %s from network" % name
-            the_file = super(S3LocalCachedMixin, self).open(name, *args, **kwargs)
-            #we had a cache miss, save it locally for the future
-            self._local.save(name, the_file)
-            if hasattr(the_file, "seek"):
-                the_file.seek(0)
-            return the_file
+    def open(self, name, mode='rb', *args, **kwargs):
+        if 'w' in mode:
+            return super(S3LocalCachedMixin, self).open(name, mode, *args, **kwargs)
+        cached_file = self.local_cache.open(name)
+        if cached_file is None:
+            #we had a cache miss, stream it to the cache for the future
+            remote_file = super(S3LocalCachedMixin, self).open(name, mode, *args, **kwargs)
+            try:
+                self.local_cache.write(name, remote_file.chunks())
+            finally:
+                remote_file.close()
+            cached_file = open(self.local_cache.path(name), 'rb')
+        return File(cached_file, name)
     
     def local_path(self, *args, **kwargs):
         return self._local.path(*args, **kwargs)
 
-class ChainableHashedFilesMixin(HashedFilesMixin):
-    _should_hash = True
-    '''
-    Over-rides behavior of HashedFilesMixin to be chainable in our pipeline
+    def cache_locally(self, name):
+        '''
+        Makes sure name is in the local cache, returns its path there or None
+        '''
+        try:
+            self.open(name).close()
+        except Exception:
+            return None
+        return self.local_cache.path(name)
+
+class ChainableManifestFilesMixin(ManifestFilesMixin):
     '''
-    def post_process(self, paths, dry_run=False, **options):
-        # Do HashedFilesMixin's proprietary stuff
-        if self._should_hash:
-            print "starting hash super 1", len(paths)   
-            super_class = super(HashedFilesMixin, self)
-            if hasattr(super_class, 'post_process'):
-                for name, hashed_name, processed in super_class.post_process(paths.copy(), dry_run, **options):
-                    if hashed_name != name:
-                        #Delete so we keep a chain
-                        if paths.has_key(name):
-                            del paths[name]
-                        paths[hashed_name] = (self, hashed_name)               
-                    yield name, hashed_name, processed
-            print "leave hash super 1", len(paths)   
-
-            #Then continue the chain
-            print "Starting Hash super 2", len(paths)   
-            super_class = super(ChainableHashedFilesMixin, self)
-            if hasattr(super_class, 'post_process'):
-                for name, hashed_name, processed in super_class.post_process(paths.copy(), dry_run, **options):
-                    if hashed_name != name:
-                        if paths.has_key(name):
-                            del paths[name]
-                        paths[hashed_name] = (self, hashed_name)                       
-                    yield name, hashed_name, processed        
-            print "leave Hash super 2", len(paths)   
-
-
-class MinifyMixin(object):
+    Over-rides behavior of ManifestFilesMixin to be chainable in our pipeline
     '''
-    Adds a Minification step to the pipeline
-    '''    
-    min_patterns = ("*.css", "*.js")
-    min_anti_pattern = ".min."
-    _should_minify = True
-    
-    def _min_compress(self, original_file, file_type):
-        if file_type == "css":
-            return cssmin.cssmin(original_file.read())
-        elif file_type == "js":
-            return jsmin(original_file.read(), keep_bang_comments=True)
-            #return _rjsmin.jsmin(str(original_file.read()), keep_bang_comments=True)
-            #return uglipyjs.compile(original_file.read())
-            #return slimit.minify(original_file.read())
-        return original_file
-        
-    def post_process(self, paths, dry_run=False, **options):
-        print "min enter super", len(paths)
-        super_class = super(MinifyMixin, self)
-        if hasattr(super_class, 'post_process'):
-            for name, hashed_name, processed in super_class.post_process(paths.copy(), dry_run, **options):
-                if hashed_name != name:
-                    if paths.has_key(name):
-                        del paths[name]
-                    paths[hashed_name] = (self, hashed_name)
-                yield name, hashed_name, processed
-        print "min leave super", len(paths)   
-
-        if not self._should_minify:
+    _should_manifest = True
+    encoded_files = None
+    terminals = None
+    # md5 of the manifest we last loaded or saved
+    manifest_hash = None
+    manifest_index_name = 'staticfiles.index'
+    # when check_manifest() next looks at the storage, and what the manifest's modified time was
+    _manifest_check_at = 0
+    _manifest_stamp = None
+    # changes whenever the tables are added to in place, see tables_changed()
+    tables_version = 0
+
+    def local_manifest_path(self, name):
+        '''
+        A path on this machine to mmap name from, or None
+        '''
+        if hasattr(self, 'cache_locally'):
+            return self.cache_locally(name)
+        try:
+            path = self.path(name)
+        except NotImplementedError:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def load_manifest_index(self):
+        '''
+        The ManifestIndex saved beside the manifest, or None when there's no local one
+        '''
+        path = self.local_manifest_path(self.manifest_index_name)
+        if path is None:
+            return None
+        try:
+            return ManifestIndex(path)
+        except (IOError, ValueError, EnvironmentError):
+            return None
+
+    def load_manifest(self):
+        '''
+        Also loads the precompressed variants of each file, and the terminal
+        entry table, kept beside paths
+        With CONVOY_MANIFEST_INDEX, they're looked up lazily in the index instead
+        '''
+        paths, self.encoded_files, self.terminals, self.manifest_hash, hashing = self.read_manifest_tables()
+        self.hash_algorithm, self.hash_length = hashing
+        return paths
+
+    def read_manifest_tables(self):
+        '''
+        Returns paths, encodings, terminals, the manifest's hash and the (algorithm, length)
+        its files were fingerprinted with, without touching the storage's own
+        '''
+        if CONVOY_MANIFEST_INDEX:
+            index = self.load_manifest_index()
+            if index is not None:
+                return (index.table('paths'), index.table('encodings', json.loads),
+                        index.table('terminals', json.loads), index.manifest_hash, manifest_hashing(index.hashing))
+        content = self.read_manifest()
+        if content is None:
+            return OrderedDict(), {}, {}, None, (CONVOY_HASH, CONVOY_HASH_LENGTH)
+        manifest_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
+        try:
+            stored = json.loads(content, object_pairs_hook=OrderedDict)
+        except ValueError:
+            pass
+        else:
+            version = stored.get('version', None)
+            if version == '1.0':
+                return (stored.get('paths', OrderedDict()), stored.get('encodings', {}),
+                        stored.get('terminals', {}), manifest_hash, manifest_hashing(stored.get('hashing')))
+        raise ValueError("Couldn't load manifest '%s' (version %s)" %
+                         (self.manifest_name, self.manifest_version))
+
+    def check_manifest(self):
+        '''
+        At most every CONVOY_MANIFEST_RELOAD_INTERVAL seconds, starts a thread that
+        reloads the manifest if it changed, the caller carries on with the current one
+        '''
+        if not CONVOY_MANIFEST_RELOAD_INTERVAL:
             return
-        if dry_run:
+        now = time.time()
+        if now < self._manifest_check_at:
             return
-        hashed_files = OrderedDict()
-        
-        print "starting minify step"
-        for path in paths:
-            if path:
-                if not matches_patterns(path, self.min_patterns):
-                    continue
-                if self.min_anti_pattern in str(path):
-                    continue
-                original_file = self.open(path)
-                convoy_split_path = path.split(".")
-                convoy_split_path.insert(-1, "cmin")
-                convoy_min_path = ".".join(convoy_split_path)
-                
-                min_contents = False
-                if CONVOY_USE_EXISTING_MIN_FILES:
-                    #This works best if minification is FIRST OR SECOND in the pipeline
-                    # if a minified file exists from the distribution, use it 
-                    # we want all bugs in minified code to match the distributed bugs 1 to 1
-                    split_path = path.split(".")
-                    # Kludge for if there is a hash in the filename
-                    # Tolerable because we falback to minifying it ourselves
-                    # TODO: break this out into a has_hash or has_fingerprint method
-                    #       that looks at the filesystem for the un-hashed file
-                    # TODO: write a test that fails if django increases the hash length
-                    if len(split_path[-2]) == 12 and len(split_path) > 2: 
-                        split_path.pop(-2)
-                    split_path.insert(-1, "min")
-                    dist_min_path = ".".join(split_path)
-                    if self.exists(dist_min_path):
-                        print "Using existing minified file %s" % dist_min_path
-                        #Copy the existing minified file into our name scheme
-                        f = self.open(dist_min_path)
-                        min_contents = f.read()
-                        f.close()
-                if not min_contents:
-                    min_contents = self._min_compress(original_file, convoy_split_path[-1])
-                
-                if self.exists(convoy_min_path):
-                    self.delete(convoy_min_path)
-                saved_name = self.save(convoy_min_path, ContentFile(min_contents))
-                hashed_files[self.hash_key(path)] = convoy_min_path
-                yield path, convoy_min_path, True
-
-        self.hashed_files.update(hashed_files)
-
-
-class GZIPMixin(object):
-    '''
-    Adds a Gzipping step to the pipeline
-    Based on GZIPMixin from from django-pipeline
-    '''
-    gzip_patterns = ("*.css", "*.js")
-    _should_gzip = True
-
-    def _gzip_compress(self, original_file):
-        content = BytesIO()
-        gzip_file = gzip.GzipFile(mode='wb', fileobj=content, mtime=0)
-        gzip_file.write(original_file.read())
-        gzip_file.close()
-        content.seek(0)
-        return File(content)
+        with _manifest_check_lock:
+            if now < self._manifest_check_at:
+                return
+            self._manifest_check_at = now + CONVOY_MANIFEST_RELOAD_INTERVAL
+        thread = threading.Thread(target=self._reload_manifest_quietly)
+        thread.daemon = True
+        thread.start()
 
-    def post_process(self, paths, dry_run=False, **options):
-        print "gzip enter super", len(paths)           
-        super_class = super(GZIPMixin, self)
-        if hasattr(super_class, 'post_process'):
-            for name, hashed_name, processed in super_class.post_process(paths.copy(), dry_run, **options):
-                if hashed_name != name:
-                    if paths.has_key(name):
-                        del paths[name]
-                    paths[hashed_name] = (self, hashed_name)                    
-                yield name, hashed_name, processed
-        print "gzip leave super", len(paths)
-
-        if not self._should_gzip:
-            return        
-        if dry_run:
-            return    
-        hashed_files = OrderedDict()
-
-        print "starting gzip step"
-        for path in paths:
-            if path:
-                if not matches_patterns(path, self.gzip_patterns):
-                    continue
-                original_file = self.open(path)
-                original_file.seek(0)
-                gzipped_path = "{0}.gz".format(path)
-                gzipped_file = self._gzip_compress(original_file)
-                gzipped_file.seek(0)
-                if self.exists(gzipped_path):
-                    self.delete(gzipped_path)
-                saved_name = self.save(gzipped_path, gzipped_file)                
-                hashed_files[self.hash_key(path)] = gzipped_path
-                yield path, gzipped_path, True
-                
-        self.hashed_files.update(hashed_files)
+    def _reload_manifest_quietly(self):
+        try:
+            self.reload_manifest()
+        except Exception:
+            # keep serving the manifest we have
+            logger.warning("Couldn't reload manifest '%s'", self.manifest_name, exc_info=True)
 
+    def reload_manifest(self):
+        '''
+        Loads the manifest again if its modified time changed, returns whether it was swapped in
+        '''
+        name = self.manifest_index_name if CONVOY_MANIFEST_INDEX else self.manifest_name
+        stamp = self.modified_time(name)
+        if stamp == self._manifest_stamp:
+            return False
+        if hasattr(self, 'local_cache'):
+            # our local copies are of the old manifest
+            self.local_cache.delete(self.manifest_name)
+            self.local_cache.delete(self.manifest_index_name)
+        paths, encoded_files, terminals, manifest_hash, hashing = self.read_manifest_tables()
+        self._manifest_stamp = stamp
+        if manifest_hash == self.manifest_hash:
+            return False
+        # One dict.update, which other threads can't interleave with, so a render
+        # sees the old manifest or the new one but never new paths with old terminals
+        self.__dict__.update({
+            'hashed_files': paths,
+            'encoded_files': encoded_files,
+            'terminals': terminals,
+            'manifest_hash': manifest_hash,
+            'hash_algorithm': hashing[0],
+            'hash_length': hashing[1],
+            'tables_version': next(_table_versions),
+        })
+        return True
 
-class ChainableManifestFilesMixin(ManifestFilesMixin):
-    '''
-    Over-rides behavior of ManifestFilesMixin to be chainable in our pipeline
-    '''
-    _should_manifest = True
+    def tables_changed(self):
+        '''
+        Call after adding to hashed_files or encoded_files in place (carpool bundles),
+        what was memoized from them is dropped
+        '''
+        self.tables_version = next(_table_versions)
 
     def post_process(self, paths, dry_run=False, **options):
-        print "Starting manifest super", len(paths)           
-        super_class = super(ChainableManifestFilesMixin, self)
-        if hasattr(super_class, 'post_process'):
-            for name, hashed_name, processed in super_class.post_process(paths.copy(), dry_run, **options):
-                if hashed_name != name:
-                    if paths.has_key(name):
-                        del paths[name]
-                    paths[hashed_name] = (self, hashed_name)                       
-                yield name, hashed_name, processed
-        print "leave manifest super", len(paths)   
+        if dry_run:
+            # ManifestFilesMixin would save the empty hashed_files over the manifest
+            return
+        for processed in super(ChainableManifestFilesMixin, self).post_process(paths, dry_run, **options):
+            yield processed
 
+    def save_manifest(self):
         if not self._should_manifest:
             return
-        if dry_run:
-            return
-        
         payload = {'paths': self.hashed_files, 'version': self.manifest_version}
-        if self.exists(self.manifest_name):
-            self.delete(self.manifest_name)
+        hashing = {'algorithm': self.hash_algorithm, 'length': self.hash_length}
+        payload['hashing'] = hashing
+        if self.encoded_files:
+            payload['encodings'] = self.encoded_files
+        if hasattr(self, 'build_terminals'):
+            self.terminals = self.build_terminals()
+        if self.terminals:
+            payload['terminals'] = self.terminals
+        if getattr(self, 'fingerprints', None):
+            payload['fingerprints'] = self.fingerprints
         contents = json.dumps(payload).encode('utf-8')
-        self.save(self.manifest_name, ContentFile(contents))
+        self.save_if_changed(self.manifest_name, contents)
+        self.manifest_hash = hashlib.md5(contents).hexdigest()
+        if CONVOY_MANIFEST_INDEX:
+            tables = index_tables(self.hashed_files, self.encoded_files, self.terminals)
+            self.save_if_changed(self.manifest_index_name, build_index(tables, self.manifest_hash, hashing))
 
 
-class ConvoyBase(ChainableManifestFilesMixin, GZIPMixin, MinifyMixin, ChainableHashedFilesMixin):
+class ConvoyBase(ChainableManifestFilesMixin, PipelineMixin):
     '''
     Sets up a storage for convoying assets
-     - On collect-static the mixins chain off of post_process
-     - Order is important: ChainableManifestFilesMixin must be first from the left
-     - Order is important: MinifyMixin works best the far right or with directly right of 
-                           ChainableHashedFilesMixin
+     - On collect-static PipelineMixin runs every file through the stages of
+       CONVOY_PIPELINE (hash, minify, gzip, brotli by default) in one pass
+     - ChainableManifestFilesMixin writes the manifest once every file has been processed
      
      - Sets up storage methods to be invoked by the {% convoy %} template tags
+       their answers are memoized in resolution_cache until the manifest changes
     '''
+    resolution_cache = None
+
     def _is_gzip_file(self, name):
         if name and (name[-3:] == ".gz" or ".gz." in name):
             return True
         return False
+
+    def _content_encoding(self, name):
+        '''
+        The Content-Encoding a precompressed file is served with, or None
+        '''
+        if self._is_gzip_file(name):
+            return "gzip"
+        for suffix, encoding in ((".br", "br"), (".zst", "zstd")):
+            if name and name.endswith(suffix):
+                return encoding
+        return None
+
+    def get_encoded_entry(self, name, encodings=()):
+        '''
+        The first of encodings (in preference order) that name has a variant for,
+        falls back on the gzip link of manifests from before encodings were recorded
+        '''
+        variants = self.encoded_files or {}
+        for encoding in encodings:
+            variant = variants.get(self.hash_key(name), {}).get(encoding)
+            if variant is None and encoding == "gzip":
+                variant = self.get_next_link(name)
+                if not self._is_gzip_file(variant):
+                    variant = None
+            if variant is not None:
+                return variant
+        return name
     
     def get_next_link(self, name):
         '''
@@ -303,7 +327,39 @@ class ConvoyBase(ChainableManifestFilesMixin, GZIPMixin, MinifyMixin, ChainableH
     def get_full_chain(self, name):
         return self.get_chain(name, gzip=True)
         
+    def _resolution_version(self):
+        # hashed_files is replaced by collectstatic and added to by carpool, which calls tables_changed()
+        # the dicts themselves rather than their ids, so they can't be freed and their ids reused,
+        # comparing them is an identity check while they're the same dicts
+        return (self.manifest_hash, self.tables_version, self.hashed_files, self.terminals)
+
+    def memoize(self, key, compute):
+        '''
+        compute()'s answer for key, remembered until the manifest changes
+        '''
+        if self.resolution_cache is None:
+            self.resolution_cache = ResolutionCache()
+        return self.resolution_cache.get_or_set(self._resolution_version(), key, compute)
+
+    def memoize_if(self, key, compute):
+        '''
+        Like memoize, for answers that aren't always final: compute() returns the answer
+        and whether to keep it.  It's only kept if the manifest didn't change meanwhile
+        '''
+        if self.resolution_cache is None:
+            self.resolution_cache = ResolutionCache()
+        value = self.resolution_cache.get(self._resolution_version(), key)
+        if value is None:
+            version = self._resolution_version()
+            value, keep = compute()
+            if keep and version == self._resolution_version():
+                self.resolution_cache.set(version, key, value)
+        return value
+
     def get_chain(self, name, dry_mode=False, gzip=False):
+        return list(self.memoize(("chain", name, gzip), lambda: tuple(self._walk_chain(name, gzip))))
+
+    def _walk_chain(self, name, gzip=False):
         #TODO
         # Should there be some kind of checking on get_full_chain to see if the file actually exists?
         chain = []
@@ -315,57 +371,264 @@ class ConvoyBase(ChainableManifestFilesMixin, GZIPMixin, MinifyMixin, ChainableH
             latest_link = self.get_next_link(latest_link)            
         return chain
         
-    def get_terminal_entry(self, name, dry_mode=False, gzip=False):
+    def get_terminal_entry(self, name, dry_mode=False, gzip=False, encodings=None):
+        '''
+        The last link of name's chain, or its best precompressed variant
+        encodings is the list the client accepts, in the order we prefer them
+        gzip=True is the same as encodings=("gzip",)
+        '''
         if dry_mode:
             return name
-        chain = self.get_chain(name, gzip=gzip)
-        if chain:
-            return chain[-1]
-        else:
+        if encodings is None:
+            encodings = ("gzip",) if gzip else ()
+        chain = self.get_chain(name)
+        if not chain:
             return None
+        return self.get_encoded_entry(chain[-1], encodings)
         
-    def get_terminal_url(self, name, dry_mode=False, gzip=False):
-        terminal_entry = self.get_terminal_entry(name, dry_mode, gzip)
+    def build_terminals(self):
+        '''
+        The terminal entry of every source file and its precompressed variants:
+           {source: {"identity": terminal, "gzip": terminal.gz, "br": terminal.br}}
+        Resolved once when the manifest is saved, so the template tags don't walk chains
+        '''
+        links = set(self.hashed_files.values())
+        terminals = OrderedDict()
+        for source in self.hashed_files:
+            if source in links:
+                continue
+            identity = self.get_chain(source)[-1]
+            entries = OrderedDict([("identity", identity)])
+            variants = (self.encoded_files or {}).get(self.hash_key(identity), {})
+            entries.update(variants)
+            if "gzip" not in entries:
+                gzip_entry = self.get_encoded_entry(identity, ("gzip",))
+                if gzip_entry != identity:
+                    entries["gzip"] = gzip_entry
+            terminals[source] = entries
+        return terminals
+
+    def _table_entry(self, name, encodings):
+        '''
+        name's terminal from the precomputed table, or None when it isn't in it
+        '''
+        entries = self.terminals.get(name) if self.terminals else None
+        if entries is None:
+            return None
+        for encoding in encodings:
+            if encoding in entries:
+                return entries[encoding]
+        return entries["identity"]
+
+    def _resolve_terminal_url(self, name, dry_mode, encodings):
+        terminal_entry = None
+        if not dry_mode:
+            terminal_entry = self._table_entry(name, encodings)
+        if terminal_entry is None:
+            terminal_entry = self.get_terminal_entry(name, dry_mode, encodings=encodings)
         final_url = super(HashedFilesMixin, self).url(terminal_entry)
         return unquote(final_url)
 
+    def get_terminal_url(self, name, dry_mode=False, gzip=False, encodings=None):
+        self.check_manifest()
+        if encodings is None:
+            encodings = ("gzip",) if gzip else ()
+        if getattr(self, 'querystring_auth', False):
+            # signed urls expire, don't keep them
+            return self._resolve_terminal_url(name, dry_mode, encodings)
+        return self.memoize(("url", name, dry_mode, tuple(encodings)),
+                            lambda: self._resolve_terminal_url(name, dry_mode, encodings))
+
+
+class IndexedBucket(object):
+    '''
+    A bucket whose get_key() answers None without a HEAD for the keys
+    missing from index, a listing of the bucket (see S3ConvoyMixin.build_index)
+    '''
+    def __init__(self, bucket, index, decode_name):
+        self._bucket = bucket
+        self._index = index
+        self._decode_name = decode_name
+
+    def get_key(self, key_name, *args, **kwargs):
+        if self._decode_name(key_name) not in self._index:
+            return None
+        return self._bucket.get_key(key_name, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._bucket, name)
+
 
 class S3ConvoyMixin(object):
     '''
     Adds the ability to override S3 settings only for convoyed assets
     - remove auth-string, customize headers for static assets only
-    - over-ride to content-encoding headers to serve gzipped assets correctly
+    - over-ride to content-encoding headers to serve gzipped, brotli and zstd assets correctly
+    - uploads through a TransferManager: retries with backoff, multipart for large files
+    - one connection per thread, so CONVOY_IO_WORKERS threads upload at once
+    - during collectstatic, answers exists() etc. from one listing of the bucket
     '''
     #TODO write a test that fails if our assumptions of S3BotoStorage change
+    # name: (size, md5 or ETag, last modified), None when there's no listing
+    _index = None
+
     def __init__(self, *args, **kwargs):
+        # before super().__init__, which reads the manifest through the bucket
+        self._connections = threading.local()
+        self.transfer = TransferManager()
         super(S3ConvoyMixin, self).__init__(*args, **kwargs)
         self.querystring_auth = CONVOY_AWS_QUERYSTRING_AUTH 
         self.headers = CONVOY_AWS_HEADERS
+
+    @property
+    def connection(self):
+        connection = getattr(self._connections, 'connection', None)
+        if connection is None:
+            connection = self._connections.connection = self.connection_class(
+                self.access_key, self.secret_key,
+                calling_format=self.calling_format)
+        return connection
+
+    @property
+    def bucket(self):
+        bucket = getattr(self._connections, 'bucket', None)
+        if bucket is None:
+            bucket = self._connections.bucket = self._get_or_create_bucket(self.bucket_name)
+        if self._index is not None:
+            return IndexedBucket(bucket, self._index, self._decode_name)
+        return bucket
+
+    def build_index(self):
+        '''
+        Lists the bucket once, boto pages through it a thousand keys per request
+        Until clear_index(), exists(), size(), modified_time() and stored_digest()
+        answer from the listing without a HEAD, and _save and delete keep it current
+        S3BotoStorage._save's HEAD before each PUT is skipped for keys it doesn't have
+        '''
+        index = {}
+        for key in self.bucket.list(prefix=self.location):
+            index[self._decode_name(key.name)] = (
+                key.size, (key.etag or "").strip('"'), parse_ts_extended(key.last_modified))
+        self._index = index
+
+    def clear_index(self):
+        self._index = None
+
+    def exists(self, name):
+        if self._index is None:
+            return super(S3ConvoyMixin, self).exists(name)
+        return self._normalize_name(self._clean_name(name)) in self._index
+
+    def size(self, name):
+        if self._index is None:
+            return super(S3ConvoyMixin, self).size(name)
+        return self._index.get(self._normalize_name(self._clean_name(name)), (0,))[0]
+
+    def modified_time(self, name):
+        entry = None
+        if self._index is not None:
+            entry = self._index.get(self._normalize_name(self._clean_name(name)))
+        if entry is None:
+            return super(S3ConvoyMixin, self).modified_time(name)
+        return entry[2]
+
+    def delete(self, name):
+        super(S3ConvoyMixin, self).delete(name)
+        if self._index is not None:
+            self._index.pop(self._normalize_name(self._clean_name(name)), None)
+
+    def stored_digest(self, name):
+        '''
+        The md5 of the contents that were saved: the key's ETag for single part uploads,
+        for multipart and gzipped ones (whose ETag is of the gzipped bytes) the md5 in its metadata
+        Uses the index or the bucket listing when AWS_PRELOAD_METADATA is on, else a HEAD
+        '''
+        name = self._normalize_name(self._clean_name(name))
+        gzipped = self._gzipped(name)
+        if self._index is not None:
+            entry = self._index.get(name)
+            if entry is None:
+                return None
+            if "-" not in entry[1] and not gzipped:
+                return entry[1]
+            # the listing has no metadata
+            key = self.transfer.retry(self.bucket.get_key, self._encode_name(name))
+        elif self.entries and not gzipped:
+            key = self.entries.get(name)
+        else:
+            key = self.transfer.retry(self.bucket.get_key, self._encode_name(name))
+        if key is None:
+            return None
+        etag = (key.etag or "").strip('"')
+        if "-" in etag or gzipped:
+            # without our md5 in the metadata treat them as changed
+            return key.get_metadata(MD5_METADATA) or etag
+        return etag
+
+    def _gzipped(self, name):
+        '''
+        Whether _save gzips name on its way to s3
+        '''
+        if not self.gzip or self._content_encoding(name):
+            return False
+        content_type = mimetypes.guess_type(name)[0] or self.key_class.DefaultContentType
+        return content_type in self.gzip_content_types
         
     def _save(self, name, content, *args, **kwargs):
         ''' 
         Check to see if we're uploading a gzip file, if so mark it as such for 
         the s3 uplaod
+        Same for .br and .zst files, which also need the type of the file they encode
+        The headers travel with the content, the storage itself isn't changed
         '''
         #TODO: check if there is a hash, if there isn't mark the file as private
         #      this will make it impossible to shoot ourselves in the foot by accidentally serving
         #      non fingerprinted files
         #      ?? is this a good idea?
-        
-        self._orig_headers = self.headers.copy()
-        self._orig_gzip = self.gzip
-        if self._is_gzip_file(name):
-            self.headers.update({
-                    'Content-Encoding': 'gzip',
-                    #http://gtmetrix.com/specify-a-vary-accept-encoding-header.html 
-                    'Vary': "Accept-Encoding", 
-                })
-            #Don't let s3 storage gzip it a second time
-            self.gzip = False
-        sname = super(S3ConvoyMixin, self)._save(name, content, *args, **kwargs)
-        self.headers = self._orig_headers
-        self.gzip = self._orig_gzip
-        return sname
+        encoding = self._content_encoding(name)
+        if encoding:
+            content.convoy_headers = {
+                'Content-Encoding': encoding,
+                #http://gtmetrix.com/specify-a-vary-accept-encoding-header.html 
+                'Vary': "Accept-Encoding", 
+            }
+            # mimetypes doesn't know .br or .zst, type it as the file it encodes
+            content_type = mimetypes.guess_type(name.rsplit(".", 1)[0])[0]
+            if content_type and not getattr(content, 'content_type', None):
+                content.content_type = content_type
+        return super(S3ConvoyMixin, self)._save(name, content, *args, **kwargs)
+
+    def _compress_content(self, content):
+        #Don't let s3 storage gzip a precompressed file a second time
+        if getattr(content, 'convoy_headers', None):
+            return content
+        # the ETag will be the md5 of the gzipped bytes, keep the md5 of these in the metadata
+        digest = hashlib.md5()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        content.convoy_md5 = digest.hexdigest()
+        return super(S3ConvoyMixin, self)._compress_content(content)
+
+    def _save_content(self, key, content, headers):
+        headers = dict(headers, **getattr(content, 'convoy_headers', {}))
+        md5 = getattr(content, 'convoy_md5', None)
+        if md5:
+            headers["x-amz-meta-%s" % MD5_METADATA] = md5
+        options = {}
+        if self.encryption:
+            options['encrypt_key'] = self.encryption
+        self.transfer.upload(key, content, headers, policy=self.default_acl,
+                             reduced_redundancy=self.reduced_redundancy, **options)
+        if self._index is not None:
+            if not md5:
+                digest = hashlib.md5()
+                content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                md5 = digest.hexdigest()
+            self._index[self._decode_name(key.name)] = (content_size(content), md5, datetime.datetime.utcnow())
     
 
 class ConvoyStorage(ConvoyBase, StaticFilesStorage):
@@ -0,0 +1,126 @@
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+
+import tempfile
+
+# Files bigger than this go through the pipeline as spooled temporary files,
+# read, fingerprinted, compressed and saved a chunk at a time, smaller ones stay in memory
+CONVOY_SPOOL_THRESHOLD = getattr(settings, "CONVOY_SPOOL_THRESHOLD", 4 * 1024 * 1024)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def read_spooled(chunks, threshold=None):
+    '''
+    The bytes of chunks, or when there are more than threshold of them
+    a spooled temporary file holding them, rewound
+    '''
+    if threshold is None:
+        threshold = CONVOY_SPOOL_THRESHOLD
+    spooled = tempfile.SpooledTemporaryFile(max_size=threshold)
+    size = 0
+    for chunk in chunks:
+        spooled.write(chunk)
+        size += len(chunk)
+    if size <= threshold:
+        # never rolled over to disk, the bytes are already in memory
+        spooled.seek(0)
+        contents = spooled.read()
+        spooled.close()
+        return contents
+    spooled.seek(0)
+    return spooled
+
+
+class HashingWriter(object):
+    '''
+    Writes to a spooled temporary file, updating each of hashers with what's written
+    contents() hands it over like read_spooled: bytes, or the file rewound
+    '''
+    def __init__(self, hashers=(), threshold=None):
+        self.hashers = hashers
+        self.threshold = CONVOY_SPOOL_THRESHOLD if threshold is None else threshold
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.threshold)
+        self.size = 0
+
+    def write(self, data):
+        for hasher in self.hashers:
+            hasher.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def contents(self):
+        self.file.seek(0)
+        if self.size <= self.threshold:
+            contents = self.file.read()
+            self.file.close()
+            return contents
+        return self.file
+
+
+def is_spooled(contents):
+    return contents is not None and not isinstance(contents, bytes)
+
+
+def iter_chunks(contents, chunk_size=CHUNK_SIZE):
+    '''
+    The chunks of bytes or of a file, from the start
+    '''
+    if not is_spooled(contents):
+        yield contents
+        return
+    contents.seek(0)
+    while True:
+        chunk = contents.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def rechunk(chunks, size):
+    '''
+    chunks joined into chunks of at least size bytes, but the last
+    '''
+    held, held_size = [], 0
+    for chunk in chunks:
+        held.append(chunk)
+        held_size += len(chunk)
+        if held_size >= size:
+            yield "".join(held)
+            held, held_size = [], 0
+    if held:
+        yield "".join(held)
+
+
+def read_all(contents):
+    '''
+    All of contents in memory, for the steps that need the whole text (css urls, minifiers)
+    '''
+    if not is_spooled(contents):
+        return contents
+    contents.seek(0)
+    return contents.read()
+
+
+def size_of(contents):
+    if not is_spooled(contents):
+        return len(contents)
+    position = contents.tell()
+    contents.seek(0, 2)
+    size = contents.tell()
+    contents.seek(position)
+    return size
+
+
+def as_file(contents):
+    '''
+    contents as a django File for storage._save()
+    '''
+    if is_spooled(contents):
+        return File(contents)
+    return ContentFile(contents)
+
+
+def close(contents):
+    if is_spooled(contents):
+        contents.close()
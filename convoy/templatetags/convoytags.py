@@ -1,14 +1,18 @@
 from django.conf import settings
 from django import template
-from django.template.base import Node
+from django.template.base import Node, TextNode
 from django.utils.encoding import iri_to_uri
 from django.utils.six.moves.urllib.parse import urljoin
 from django.contrib.staticfiles.templatetags.staticfiles import StaticFilesNode, do_static
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core.exceptions import ImproperlyConfigured
 
-from convoy.utils import CssAbsolute, concatenate_and_hash
-from convoy.utils import request_accepts_gzip, convoy_terminus, convoy_chain, convoy_from_context
+import logging
+
+from convoy.bundles import CARPOOL_COMBINE_IN_BACKGROUND, get_scheduler
+from convoy.registry import get_registry, install_entry
+from convoy.utils import CssAbsolute
+from convoy.utils import request_accepts_gzip, convoy_terminus, convoy_chain, convoy_from_context, context_encodings
 
 CONVOY_DURING_DEBUG = getattr(settings, "CONVOY_DURING_DEBUG", False)
 CARPOOL_COMBINE_DURING_DEBUG = getattr(settings, "CARPOOL_COMBINE_DURING_DEBUG", False)
@@ -23,6 +27,8 @@ CARPOOL_JS_TEMPLATE  = getattr(settings, "CARPOOL_JS_TEMPLATE", u'<script type="
 CARPOOL_START_COMMENT_TEMPLATE = getattr(settings, "CARPOOL_START_COMMENT_TEMPLATE", u"\n<!-- %s -->\n")
 CARPOOL_END_COMMENT_TEMPLATE = getattr(settings, "CARPOOL_END_COMMENT_TEMPLATE", CARPOOL_START_COMMENT_TEMPLATE)
 
+logger = logging.getLogger(__name__)
+
 
 register = template.Library()
 
@@ -53,32 +59,67 @@ def do_convoy(parser, token):
     return ConvoyStaticNode.handle_token(parser, token)
 
 
+def split_paths(text):
+    '''
+    The paths of a carpool block, one per line, without whitespace or quotes
+    '''
+    return [x.strip(' \'"\r') for x in text.split('\n') if bool(x.strip())]
+
+
 class CarpoolNode(template.Node):
     def __init__(self, nodelist, format, storage=None):
-        if not storage:
-            self.storage = staticfiles_storage
+        self.storage = storage or staticfiles_storage
         self.nodelist = nodelist
         self.format = format
+        # split once, when the template is compiled, if they're all written out
+        paths = self.literal_paths() if nodelist is not None else None
+        self.static_paths = tuple(paths) if paths else None
+
+    def literal_paths(self):
+        '''
+        The block's paths when they're all written out, or None when it has
+        variables or tags, whose paths are only known when it's rendered
+        '''
+        if not all(isinstance(node, TextNode) for node in self.nodelist):
+            return None
+        return split_paths("".join(node.s for node in self.nodelist))
         
     def resolve_paths_to_combine(self, paths):
+        if hasattr(self.storage, 'check_manifest'):
+            self.storage.check_manifest()
+        if hasattr(self.storage, 'memoize'):
+            convoyable_paths, unconvoyable_paths = self.storage.memoize(
+                ("carpool", tuple(paths), CARPOOL_COMBINE_ORIGINALS),
+                lambda: tuple(map(tuple, self._resolve_paths_to_combine(paths))))
+            return list(convoyable_paths), list(unconvoyable_paths)
+        return self._resolve_paths_to_combine(paths)
+
+    def _resolve_paths_to_combine(self, paths):
         convoyable_paths = []
         unconvoyable_paths = []
         for p in paths:
-            chain = convoy_chain(p, gzip=False) #can't concatenate gziped files
+            chain = convoy_chain(p, gzip=False, storage=self.storage) #can't concatenate gziped files
             if chain:
                 if CARPOOL_COMBINE_ORIGINALS:
                     convoyable_paths.append(chain[0])
                 else:
                     convoyable_paths.append(chain[-1])
             else:
-                unconvoyable_paths.append(path)
+                unconvoyable_paths.append(p)
         return convoyable_paths, unconvoyable_paths     
         
     def comment_key_in_cache(self, comment_key):
         storage = self.storage
         if hasattr(storage, 'get_next_link'):
             # First check in the convoy project's storages
-            return self.storage.get_next_link(comment_key) 
+            found = self.storage.get_next_link(comment_key)
+            if not found:
+                # then whether another process built it
+                entry = get_registry(storage).lookup(comment_key)
+                if entry is not None:
+                    install_entry(storage, entry)
+                    found = self.storage.get_next_link(comment_key)
+            return found
         elif hasattr(storage, 'hashed_files'):
             # Fallback to staticfiles default method
             # This _should_ allow the tag to be used with CachedFilesMixin, 
@@ -87,18 +128,49 @@ class CarpoolNode(template.Node):
         return False
         
     def create_comment_key(self, paths):
-        return u"+++".join([convoy_terminus(x, gzip=False).split("/")[-1] for x in paths])
+        return u"+++".join([convoy_terminus(x, gzip=False, storage=self.storage).split("/")[-1] for x in paths])
         
+    def combine(self, paths, comment_key):
+        '''
+        Builds the bundle during the request, returns its stored name, or None when another
+        process is building it or it failed: the files are rendered one by one meanwhile
+        '''
+        try:
+            return get_scheduler().build(paths, comment_key, self.format, self.storage)
+        except Exception:
+            if settings.DEBUG:
+                raise
+            # concatenation simply isn't important enough to bring down the site
+            logger.exception("Couldn't combine carpool bundle %s", comment_key)
+            return None
+
     def tag_for_filename(self, file_name, context):
         if self.format == "css":
-            return CARPOOL_CSS_TEMPLATE % convoy_from_context(file_name, context) 
+            return CARPOOL_CSS_TEMPLATE % convoy_from_context(file_name, context, self.storage)
         elif self.format == "js":
-            return CARPOOL_JS_TEMPLATE % convoy_from_context(file_name, context)
-        
+            return CARPOOL_JS_TEMPLATE % convoy_from_context(file_name, context, self.storage)
+
     def render(self, context):
-        node_text = self.nodelist.render(context)
-        # if the line has content get just the path without whitespaces or quotes
-        paths = [x.strip(' \'"\r') for x in node_text.split('\n') if bool(x.strip())]
+        '''
+        A block with its paths written out renders the same html until the manifest
+        changes, for each set of encodings: it's kept and a warm render is one lookup
+        '''
+        if self.static_paths is None or not hasattr(self.storage, 'memoize_if') or \
+                getattr(self.storage, 'querystring_auth', False):
+            # if the line has content get just the path without whitespaces or quotes
+            return self.render_paths(split_paths(self.nodelist.render(context)), context)[0]
+        self.storage.check_manifest()
+        encodings = context_encodings(context)
+        key = ("carpool-html", self.format, self.static_paths, settings.DEBUG,
+               tuple(encodings) if encodings is not None else None)
+        return self.storage.memoize_if(key, lambda: self.render_paths(list(self.static_paths), context))
+
+    def render_paths(self, paths, context):
+        '''
+        The html for paths, and whether it's final: False when it falls back on the files
+        one by one while their bundle is being built
+        '''
+        final = True
         convoyable_paths, unconvoyable_paths = self.resolve_paths_to_combine(paths)
         compressed_file_name = None
         comment_key = self.create_comment_key(convoyable_paths)
@@ -113,13 +185,16 @@ class CarpoolNode(template.Node):
                     compressed_file_name = in_cache
                 else:
                     #Combine the if we can
-                    compressed_file_name = concatenate_and_hash(convoyable_paths, comment_key, self.format)
+                    compressed_file_name = self.combine(convoyable_paths, comment_key)
+                    final = bool(compressed_file_name)
         else:
             if in_cache:
                 compressed_file_name = in_cache
             else:
-                #TODO: create mechanisms for enqueuing this to be compressed after the request
-                # celery, monkey patched close
+                if CARPOOL_COMBINE_IN_BACKGROUND and not (settings.DEBUG and not CARPOOL_COMBINE_DURING_DEBUG):
+                    # built after the response, the next requests find it in the registry
+                    get_scheduler().submit(convoyable_paths, comment_key, self.format, self.storage)
+                    final = False
                 unconvoyable_paths = paths
         
         # Part 2: rendering work
@@ -136,7 +211,7 @@ class CarpoolNode(template.Node):
             out += self.tag_for_filename(path, context)
         out += CARPOOL_END_COMMENT_TEMPLATE % comment_key if CARPOOL_END_COMMENT_TEMPLATE else ""
 
-        return out
+        return out, final
 
 @register.tag
 def carpool(parser, token):
@@ -1,5 +1,44 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.template import Context
+from django.template.base import NodeList, TextNode
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
 import unittest
+
+from convoy import bundles, cache, pipeline, registry, stages, stores, streams, workers
+from convoy.benchmarks.collectstatic import generate_tree
+from convoy.benchmarks.s3stub import MemoryS3Connection
+from convoy.benchmarks.tags import build_storage, page_template, percentile
+from convoy.bundles import BundleScheduler, build_bundle
+from convoy.cache import LocalFileCache, ResolutionCache, StageCache
+from convoy.locks import CacheLock, FileLock
+from convoy.minifiers import MINIFIERS, css_minify
+from convoy.offline import compile_carpools, scan_templates
+from convoy.pipeline import Asset, Pipeline, Report, Step, _run_steps
+from convoy.registry import CacheRegistry, StorageRegistry, get_registry, install_entry
+from convoy.signals import step_finished
+from convoy.stages import GzipStage, MinifyStage, gzip_chunks, gzip_compress
+from convoy.stores import ConvoyStorage, S3ConvoyStorage
+from convoy.streams import read_all, read_spooled, size_of
+from convoy.templatetags.convoytags import CarpoolNode
 from convoy.tests.adminscript import AdminScriptTestCase, test_dir
+from convoy.transfer import TransferManager
+from convoy.utils import concatenate, request_encodings
+from convoy.workers import WorkerPools
 
 
 class ManageRunserverEmptyAllowedHosts(AdminScriptTestCase):
@@ -108,4 +147,945 @@ class ManageRunserverEmptyAllowedHosts(AdminScriptTestCase):
 
 
         self.assertNoOutput(err)
-        print out
\ No newline at end of file
+        print out
+
+class ConvoyCollectstaticTests(AdminScriptTestCase):
+    def write_convoy_settings(self, static_root, **extra):
+        sdict = {
+            'ALLOWED_HOSTS': [],
+            'DEBUG': False,
+            'DATABASES': {
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3'
+                },
+            },
+            'STATIC_ROOT': "'%s'" % static_root,
+            'STATIC_URL': "'/static/'",
+            'STATICFILES_STORAGE': "'convoy.stores.ConvoyStorage'",
+        }
+        sdict.update(extra)
+        self.write_settings('settings.py',
+            apps=[
+                'django.contrib.admin',
+                'django.contrib.staticfiles',
+                'convoy',
+            ],
+            sdict=sdict,
+        )
+
+    def read_manifest(self, static_root):
+        with open(os.path.join(test_dir, static_root, 'staticfiles.json')) as f:
+            return json.load(f)
+
+    def tearDown(self):
+        self.remove_settings('settings.py')
+        for static_root in ('serial_static', 'parallel_static', 'incremental_static', 'stage_cache', 'carpool_templates'):
+            shutil.rmtree(os.path.join(test_dir, static_root), ignore_errors=True)
+
+    def test_parallel_matches_serial(self):
+        self.write_convoy_settings('serial_static/')
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        serial_out = [l for l in out.splitlines() if l.startswith('Post-processed')]
+
+        self.write_convoy_settings('parallel_static/', CONVOY_CPU_WORKERS='4', CONVOY_IO_WORKERS='4')
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        parallel_out = [l for l in out.splitlines() if l.startswith('Post-processed')]
+
+        self.assertTrue(serial_out)
+        self.assertEqual(serial_out, parallel_out)
+        self.assertEqual(self.read_manifest('serial_static'), self.read_manifest('parallel_static'))
+
+    def test_incremental_reuses_unchanged_outputs(self):
+        self.write_convoy_settings('incremental_static/', CONVOY_INCREMENTAL='True',
+                                   CONVOY_STAGE_CACHE_ROOT="'stage_cache/'")
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        first_manifest = self.read_manifest('incremental_static')
+        self.assertIn('fingerprints', first_manifest)
+        self.assertTrue(os.listdir(os.path.join(test_dir, 'stage_cache')))
+
+        out, err = self.run_manage(['collectstatic', '--noinput', '-v', '2'])
+        self.assertNoOutput(err)
+        self.assertNotInOutput(out, ".cmin.css.gz'")
+        self.assertOutput(out, "Skipped post-processing 'admin/css/base.")
+        self.assertEqual(first_manifest, self.read_manifest('incremental_static'))
+
+    def test_identical_outputs_are_not_rewritten(self):
+        self.write_convoy_settings('serial_static/')
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        paths = self.read_manifest('serial_static')['paths']
+        minified = paths[paths['admin/css/base.css']]
+        outputs = [os.path.join(test_dir, 'serial_static', name) for name in
+                   (paths['admin/css/base.css'], minified, minified + '.gz', 'staticfiles.json')]
+        for output in outputs:
+            os.utime(output, (0, 0))
+
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        for output in outputs:
+            self.assertEqual(os.stat(output).st_mtime, 0)
+
+    def test_manifest_chain(self):
+        self.write_convoy_settings('serial_static/')
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        paths = self.read_manifest('serial_static')['paths']
+        chain = ['admin/css/base.css']
+        while chain[-1] in paths:
+            chain.append(paths[chain[-1]])
+        self.assertEqual(len(chain), 4)
+        self.assertTrue(chain[2].endswith('.cmin.css'))
+        self.assertEqual(chain[3], chain[2] + '.gz')
+        for name in chain[1:]:
+            self.assertTrue(os.path.exists(os.path.join(test_dir, 'serial_static', name)))
+
+    def test_dry_run_keeps_the_manifest(self):
+        self.write_convoy_settings('serial_static/')
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        manifest = self.read_manifest('serial_static')
+        self.assertTrue(manifest['paths'])
+        out, err = self.run_manage(['collectstatic', '--noinput', '--dry-run'])
+        self.assertNoOutput(err)
+        self.assertEqual(self.read_manifest('serial_static'), manifest)
+
+    def test_carpools_are_only_compiled_after_post_processing(self):
+        templates = os.path.join(test_dir, 'carpool_templates')
+        os.makedirs(templates)
+        with open(os.path.join(templates, 'page.html'), 'w') as f:
+            f.write('{% load convoytags %}\n{% carpool css %}\n  "admin/css/base.css"\n  "admin/css/dashboard.css"\n{% endcarpool %}\n')
+        self.write_convoy_settings('serial_static/', CARPOOL_COMPILE_DURING_COLLECTSTATIC='True',
+                                   TEMPLATE_DIRS=repr([templates]))
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        manifest = self.read_manifest('serial_static')
+        self.assertTrue([name for name in manifest['paths'].values() if name.startswith('CARPOOL/')])
+        out, err = self.run_manage(['collectstatic', '--noinput', '--no-post-process'])
+        self.assertNoOutput(err)
+        self.assertEqual(self.read_manifest('serial_static'), manifest)
+
+    def test_configured_pipeline(self):
+        self.write_convoy_settings('serial_static/', CONVOY_PIPELINE=repr((
+            "convoy.stages.HashStage",
+            ("convoy.stages.GzipStage", {"patterns": ("*.css", "*.txt")}),
+        )))
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        paths = self.read_manifest('serial_static')['paths']
+        hashed_license = paths['admin/js/LICENSE-JQUERY.txt']
+        self.assertEqual(paths[hashed_license], hashed_license + '.gz')
+        hashed_base = paths['admin/css/base.css']
+        self.assertEqual(paths[hashed_base], hashed_base + '.gz')
+        self.assertNotIn(paths['admin/js/core.js'], paths)
+
+    def test_report(self):
+        self.write_convoy_settings('serial_static/', CONVOY_REPORT='True', CONVOY_REPORT_PATH="'report.json'",
+            CONVOY_PIPELINE=repr((
+                "convoy.stages.HashStage",
+                ("convoy.stages.GzipStage", {"overrides": [(("*.js",), {"level": 1})]}),
+            )))
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        self.assertOutput(out, "bytes saved")
+        self.assertOutput(out, "slowest:")
+        report = [l.split() for l in out.splitlines() if l.startswith('gzip ')]
+        self.assertEqual(sorted(l[1] for l in report), ['.css', '.js'])
+        with open(os.path.join(test_dir, 'report.json')) as f:
+            report = json.load(f)
+        self.assertEqual(list(report['phases']), ['read and hash', 'process and save'])
+        self.assertEqual(sorted(set(stage['stage'] for stage in report['stages'])), ['gzip', 'hash'])
+        gzipped = [step for step in report['files'] if step['input'].endswith('.css') and step['stage'] == 'gzip']
+        self.assertTrue(gzipped)
+        self.assertTrue(all(0 < step['ratio'] < 1 for step in gzipped))
+
+    def test_encoded_variants(self):
+        self.write_convoy_settings('serial_static/')
+        out, err = self.run_manage(['collectstatic', '--noinput'])
+        self.assertNoOutput(err)
+        manifest = self.read_manifest('serial_static')
+        paths = manifest['paths']
+        minified = paths[paths['admin/css/base.css']]
+        # brotli is a sibling of gzip, it isn't linked into the chain
+        self.assertEqual(manifest['encodings'][minified], {'gzip': minified + '.gz', 'br': minified + '.br'})
+        self.assertNotIn(minified + '.gz', paths)
+        self.assertFalse([name for name in paths.values() if name.endswith('.br')])
+        self.assertEqual(manifest['terminals']['admin/css/base.css'],
+                         {'identity': minified, 'gzip': minified + '.gz', 'br': minified + '.br'})
+        self.assertNotIn(paths['admin/css/base.css'], manifest['terminals'])
+        import brotli
+        with open(os.path.join(test_dir, 'serial_static', minified), 'rb') as f:
+            original = f.read()
+        with open(os.path.join(test_dir, 'serial_static', minified + '.br'), 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()), original)
+
+
+class CollectTestCase(unittest.TestCase):
+    '''
+    Collects source files into a ConvoyStorage, both in a temporary directory
+    '''
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work, True)
+        self.source = FileSystemStorage(location=os.path.join(self.work, 'source'))
+
+    def convoy_storage(self, location='static'):
+        return ConvoyStorage(location=os.path.join(self.work, location), base_url='/static/')
+
+    def collect(self, files, storage=None):
+        '''
+        Post-processes {name: contents} into storage (a new one by default) and saves its manifest
+        '''
+        for name, contents in files.items():
+            if not self.source.exists(name):
+                self.source.save(name, ContentFile(contents))
+        storage = storage or self.convoy_storage()
+        list(storage.post_process(dict((name, (self.source, name)) for name in files)))
+        storage.save_manifest()
+        return storage
+
+
+class PipelineTests(unittest.TestCase):
+    def test_storage_stages_come_first(self):
+        self.assertRaises(ImproperlyConfigured, Pipeline.from_settings,
+                          ["convoy.stages.GzipStage", "convoy.stages.HashStage"])
+
+    def test_steps_for(self):
+        pipeline = Pipeline.from_settings()
+        self.assertEqual([(s.input, s.output) for s in pipeline.steps_for("app/base.12ab.css")], [
+            ("app/base.12ab.css", "app/base.12ab.cmin.css"),
+            ("app/base.12ab.cmin.css", "app/base.12ab.cmin.css.gz"),
+            ("app/base.12ab.cmin.css", "app/base.12ab.cmin.css.br"),
+        ])
+        self.assertEqual([s.output for s in pipeline.steps_for("app/jquery.min.js")],
+                         ["app/jquery.min.js.gz", "app/jquery.min.js.br"])
+        self.assertEqual([s.output for s in pipeline.steps_for("app/base.css", skip=["minify", "brotli"])],
+                         ["app/base.css.gz"])
+        self.assertEqual(pipeline.steps_for("app/logo.png"), [])
+
+
+class WorkerPoolsTests(unittest.TestCase):
+    def test_processes_are_forked_before_threads(self):
+        with WorkerPools(cpu_workers=2, io_workers=2, jobs=4) as pools:
+            self.assertEqual(list(pools.io_map(str, range(4))), ['0', '1', '2', '3'])
+            # the thread pool started the process pool first
+            self.assertNotEqual(pools._cpu_pool, None)
+            self.assertEqual(list(pools.cpu_map(abs, [-1, 2, -3])), [1, 2, 3])
+
+    def test_single_job_never_forks(self):
+        pools = WorkerPools(cpu_workers=4, io_workers=4, jobs=1)
+        self.assertEqual(list(pools.io_map(str, [1])), ['1'])
+        self.assertEqual((pools._cpu_pool, pools._io_pool), (None, None))
+
+
+class StageTests(unittest.TestCase):
+    def test_overrides(self):
+        stage = GzipStage(level=6, overrides=[(("*.js",), {"level": 1, "mem_level": 9})])
+        self.assertEqual(stage.options_for("app/base.css"), {"level": 6})
+        self.assertEqual(stage.options_for("app/base.js"), {"level": 1, "mem_level": 9})
+        self.assertNotEqual(stage.cache_name("app/base.css"), stage.cache_name("app/base.js"))
+
+    def test_gzip_levels(self):
+        contents = "body { color: red; }\n" * 500
+        fast = GzipStage(level=1, wbits=10).process("base.css", contents)
+        best = GzipStage().process("base.css", contents)
+        self.assertTrue(len(best) < len(fast))
+        for compressed in (fast, best):
+            self.assertEqual(gzip.GzipFile(fileobj=BytesIO(compressed)).read(), contents)
+
+    def test_zopfli_requires_package(self):
+        if stages.zopfli is not None:
+            return
+        self.assertRaises(ImproperlyConfigured, stages.GzipStage, overrides=[(("*.js",), {"zopfli": True})])
+
+
+class StreamTests(CollectTestCase):
+    def test_read_spooled(self):
+        self.assertEqual(read_spooled(['body', '{}'], threshold=6), 'body{}')
+        spooled = read_spooled(['body', '{}', 'a{}'], threshold=6)
+        self.assertFalse(isinstance(spooled, bytes))
+        self.assertEqual(size_of(spooled), 9)
+        self.assertEqual(read_all(spooled), 'body{}a{}')
+
+    def test_gzip_chunks(self):
+        contents = "".join("body .c%d { color: #%06x; }\n" % (i, i * 7919) for i in range(5000))
+        chunks = [contents[i:i + 1000] for i in range(0, len(contents), 1000)]
+        self.assertEqual("".join(gzip_chunks(chunks)), gzip_compress(contents))
+
+    def test_large_assets_are_streamed(self):
+        files = {
+            'app/logo.png': 'png' * 100,
+            'app/base.css': 'body { background: url("logo.png"); }\n' * 100,
+            'app/base.js': 'var a = 1;\n' * 100,
+        }
+        results = []
+        # in memory, spooled, and spooled a file at a time
+        for threshold, batch_size in ((streams.CONVOY_SPOOL_THRESHOLD, 64), (100, 64), (100, 1)):
+            orig = streams.CONVOY_SPOOL_THRESHOLD, pipeline.CONVOY_BATCH_SIZE
+            streams.CONVOY_SPOOL_THRESHOLD, pipeline.CONVOY_BATCH_SIZE = threshold, batch_size
+            try:
+                storage = self.collect(files, self.convoy_storage('%d-%d' % (threshold, batch_size)))
+            finally:
+                streams.CONVOY_SPOOL_THRESHOLD, pipeline.CONVOY_BATCH_SIZE = orig
+            results.append((storage.hashed_files, storage.encoded_files,
+                            dict((name, storage.open(name).read()) for name in storage.hashed_files.values())))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(len([name for name in results[1][2] if name.endswith('.cmin.js.gz')]), 1)
+
+    def test_spooled_min_files_stay_in_process(self):
+        storage = self.convoy_storage()
+        storage.save('app/lib.min.js', ContentFile('var lib=1;' * 20))
+        orig = streams.CONVOY_SPOOL_THRESHOLD, stages.CONVOY_USE_EXISTING_MIN_FILES, workers.CONVOY_CPU_WORKERS
+        streams.CONVOY_SPOOL_THRESHOLD, stages.CONVOY_USE_EXISTING_MIN_FILES, workers.CONVOY_CPU_WORKERS = 100, True, 2
+        try:
+            # the .min file is spooled, the worker processes can't be sent it
+            self.collect({'app/lib.js': 'var lib = 1;\n', 'app/base.js': 'var a = 1;\n'}, storage)
+        finally:
+            streams.CONVOY_SPOOL_THRESHOLD, stages.CONVOY_USE_EXISTING_MIN_FILES, workers.CONVOY_CPU_WORKERS = orig
+        minified = storage.hashed_files[storage.hashed_files['app/lib.js']]
+        self.assertEqual(storage.open(minified).read(), 'var lib=1;' * 20)
+
+
+class HashingTests(CollectTestCase):
+    def test_file_hash(self):
+        storage = ConvoyStorage(location='/tmp/convoy-hashing/', base_url='/static/')
+        self.assertEqual(storage.file_hash('app/base.css', ContentFile('body{}')), hashlib.md5('body{}').hexdigest()[:12])
+        self.assertEqual(storage.hash_contents('body{}'), (hashlib.md5('body{}').hexdigest()[:12], hashlib.md5('body{}').hexdigest()))
+        storage.hash_algorithm, storage.hash_length = 'sha256', 16
+        hashed_name = storage.hashed_name('app/base.css', ContentFile('body{}'))
+        self.assertEqual(hashed_name, 'app/base.%s.css' % hashlib.sha256('body{}').hexdigest()[:16])
+        self.assertEqual(storage.split_hash(hashed_name), ('app/base.css', hashlib.sha256('body{}').hexdigest()[:16]))
+        self.assertEqual(storage.split_hash('app/base.0123456789ab.css'), ('app/base.0123456789ab.css', None))
+        storage.hash_length = 100
+        self.assertRaises(ImproperlyConfigured, storage.file_hash, 'app/base.css', ContentFile('body{}'))
+        storage.hash_algorithm = 'nonesuch'
+        self.assertRaises(ImproperlyConfigured, storage.file_hash, 'app/base.css', ContentFile('body{}'))
+
+    def test_length_is_recorded_in_the_manifest(self):
+        orig = pipeline.CONVOY_HASH_LENGTH, stages.CONVOY_USE_EXISTING_MIN_FILES
+        pipeline.CONVOY_HASH_LENGTH, stages.CONVOY_USE_EXISTING_MIN_FILES = 20, True
+        try:
+            storage = self.convoy_storage()
+            storage.save('app/lib.min.js', ContentFile('var lib=1'))
+            self.collect({'app/lib.js': 'var lib = 1;\n'}, storage)
+        finally:
+            pipeline.CONVOY_HASH_LENGTH, stages.CONVOY_USE_EXISTING_MIN_FILES = orig
+        hashed_name = storage.hashed_files['app/lib.js']
+        self.assertEqual(len(storage.split_hash(hashed_name)[1]), 20)
+        # the distribution's .min.js was found behind the 20 digit fingerprint
+        self.assertEqual(storage.open(storage.hashed_files[hashed_name]).read(), 'var lib=1')
+        loaded = self.convoy_storage()
+        self.assertEqual((loaded.hash_algorithm, loaded.hash_length), ('md5', 20))
+        # a bundle built at runtime leaves the storage's hashing and report alone
+        report = loaded.report
+        build_bundle([storage.hashed_files[hashed_name]], 'lib+++', 'js', loaded)
+        self.assertEqual((loaded.hash_algorithm, loaded.hash_length, loaded.report), ('md5', 20, report))
+
+
+class OfflineCarpoolTests(CollectTestCase):
+    def test_compile_carpools(self):
+        with override_settings(INSTALLED_APPS=['django.contrib.staticfiles', 'convoy'], STATIC_URL='/static/'):
+            templates = os.path.join(self.work, 'templates')
+            os.makedirs(templates)
+            with open(os.path.join(templates, 'page.html'), 'w') as f:
+                f.write('{% load convoytags %}\n{% carpool css %}\n  "app/a.css"\n  "app/b.css"\n{% endcarpool %}\n'
+                        '{% carpool js %}\n  "{{ script }}"\n{% endcarpool %}\n')
+            with open(os.path.join(templates, 'broken.html'), 'w') as f:
+                f.write('{% load convoytags %}{% carpool %}{% endcarpool %}')
+            found, errors = scan_templates([templates])
+            self.assertEqual(found, [('css', ('app/a.css', 'app/b.css'))])
+            self.assertEqual(list(errors), [os.path.join(templates, 'broken.html')])
+
+            storage = self.collect({'app/a.css': 'a { color: red; }\n', 'app/b.css': 'b { color: blue; }\n'})
+            built, existing, failed = compile_carpools(found, storage)
+            self.assertEqual((len(built), existing, failed), (1, [], {}))
+            chain = storage.get_chain(built[0])
+            self.assertTrue(chain[1].startswith('CARPOOL/'))
+            self.assertTrue(chain[-1].endswith('.cmin.css'))
+            # recorded in the manifest, a new process has nothing left to build
+            self.assertEqual(compile_carpools(found, self.convoy_storage()), ([], built, {}))
+
+
+class ConcatenateTests(CollectTestCase):
+    def test_streamed_bundle(self):
+        threshold = streams.CONVOY_SPOOL_THRESHOLD
+        self.addCleanup(setattr, streams, 'CONVOY_SPOOL_THRESHOLD', threshold)
+        storage = self.convoy_storage()
+        script = u'var s = "h\xe9llo \u2603";\n'.encode('utf-8') * 1000
+        storage.save('app/a.js', ContentFile(script))
+        storage.save('app/b.js', ContentFile('var b = 2;'))
+        expected = '/*!a+++b*/\n /*!app/a.js*/ \n' + script + '\n /*!app/b.js*/ \nvar b = 2;'
+        for spool_threshold in (threshold, 100):
+            streams.CONVOY_SPOOL_THRESHOLD = spool_threshold
+            name = concatenate(['app/a.js', 'app/b.js'], u'a+++b', 'js', storage)
+            self.assertEqual(name, 'CARPOOL/%s.js' % hashlib.md5(expected).hexdigest()[:12])
+            self.assertEqual(storage.open(name).read(), expected)
+
+
+class BundleSchedulerTests(CollectTestCase):
+    def test_file_lock(self):
+        lock, other = FileLock(os.path.join(self.work, 'locks'), 60), FileLock(os.path.join(self.work, 'locks'), 60)
+        self.assertTrue(lock.acquire('bundle'))
+        self.assertFalse(other.acquire('bundle'))
+        self.assertTrue(other.acquire('another bundle'))
+        lock.release('bundle')
+        self.assertTrue(other.acquire('bundle'))
+        # a lock whose process died is taken over once it's expired
+        stale = time.time() - 120
+        os.utime(other.path('bundle'), (stale, stale))
+        self.assertTrue(lock.acquire('bundle'))
+
+    def test_failed_builds_are_logged(self):
+
+        class Records(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        records, handler = [], Records()
+        logging.getLogger('convoy.bundles').addHandler(handler)
+        self.addCleanup(logging.getLogger('convoy.bundles').removeHandler, handler)
+        scheduler = BundleScheduler(lock=FileLock(os.path.join(self.work, 'locks')))
+        scheduler.submit(['app/missing.js'], 'missing.js+++', 'js', self.convoy_storage())
+        scheduler.join()
+        self.assertEqual(list(scheduler.failed), ['missing.js+++'])
+        self.assertEqual([record.exc_info[1] for record in records], [scheduler.failed['missing.js+++']])
+
+    def test_build_once_in_background(self):
+        storage = self.collect({'app/a.js': 'var a = 1;\n', 'app/b.js': 'var b = 2;\n'})
+        paths = [storage.get_chain(name)[-1] for name in ('app/a.js', 'app/b.js')]
+        comment_key = '+++'.join(path.split('/')[-1] for path in paths)
+
+        early = self.convoy_storage()
+        self.assertEqual(get_registry(early).lookup(comment_key), None)
+        scheduler = BundleScheduler(lock=FileLock(os.path.join(self.work, 'locks')))
+        self.assertTrue(scheduler.submit(paths, comment_key, 'js', storage))
+        scheduler.join()
+        self.assertEqual(scheduler.failed, {})
+        chain = storage.get_chain(comment_key)
+        self.assertTrue(chain[1].startswith('CARPOOL/'))
+        self.assertTrue(chain[-1].endswith('.cmin.js'))
+
+        # another process finds it in the registry, and doesn't build it again
+        loaded = self.convoy_storage()
+        self.assertEqual(loaded.get_next_link(comment_key), None)
+        self.assertEqual(CarpoolNode(None, 'js', loaded).comment_key_in_cache(comment_key), chain[1])
+        self.assertEqual(loaded.get_chain(comment_key), chain)
+        self.assertEqual(loaded.get_terminal_entry(comment_key, gzip=True), chain[-1] + '.gz')
+        other = BundleScheduler(lock=FileLock(os.path.join(self.work, 'locks')))
+        self.assertTrue(other.lock.acquire(comment_key))
+        self.assertEqual(other.build(paths, comment_key, 'js', loaded), None)
+        other.lock.release(comment_key)
+        # one that looked before it was published asks the registry again once it has the lock
+        self.assertEqual(CarpoolNode(None, 'js', early).comment_key_in_cache(comment_key), None)
+        self.assertEqual(other.build(paths, comment_key, 'js', early), chain[1])
+        self.assertEqual(early.get_chain(comment_key), chain)
+        # the manifest collectstatic saved is left as it was
+        self.assertNotIn(comment_key, loaded.hashed_files.keys()[:2])
+
+
+class CarpoolRenderTests(CollectTestCase):
+    def test_static_blocks_keep_their_html(self):
+        self.addCleanup(setattr, bundles, '_scheduler', bundles._scheduler)
+        bundles._scheduler = BundleScheduler(lock=FileLock(os.path.join(self.work, 'locks')))
+        storage = self.collect({'app/a.js': 'var a = 1;\n', 'app/b.js': 'var b = 2;\n'})
+
+        node = CarpoolNode(NodeList([TextNode('\n  "app/a.js"\n  "app/b.js"\n')]), 'js', storage)
+        self.assertEqual(node.static_paths, ('app/a.js', 'app/b.js'))
+        rendered = []
+        render_paths = node.render_paths
+        node.render_paths = lambda paths, context: rendered.append(paths) or render_paths(paths, context)
+        comment_key = node.create_comment_key(node.resolve_paths_to_combine(['app/a.js', 'app/b.js'])[0])
+
+        # while another process builds the bundle, the files one by one, asked again next time
+        bundles._scheduler.lock.acquire(comment_key)
+        self.assertEqual(node.render(Context({})).count('<script'), 2)
+        bundles._scheduler.lock.release(comment_key)
+        html = node.render(Context({}))
+        self.assertEqual(html.count('<script'), 1)
+        self.assertIn('/static/CARPOOL/', html)
+        self.assertEqual(len(rendered), 2)
+        # the bundle changed the manifest while it was rendered, the next render keeps its html
+        self.assertEqual(node.render(Context({})), html)
+        self.assertEqual(node.render(Context({})), html)
+        self.assertEqual(len(rendered), 3)
+
+
+class BundleRegistryTests(CollectTestCase):
+    def test_lookups_are_remembered(self):
+        storage = FileSystemStorage(location=self.work)
+        lock = FileLock(os.path.join(self.work, 'locks'))
+        entry = {'paths': {'a.js+++b.js': 'CARPOOL/0123456789ab.js'}, 'encodings': {}}
+        registry, other = StorageRegistry(storage, ttl=60), StorageRegistry(storage, ttl=60)
+        self.assertEqual(other.lookup('a.js+++b.js'), None)
+        registry.publish({'a.js+++b.js': entry}, lock)
+        self.assertEqual(registry.lookup('a.js+++b.js'), entry)
+        # other read the registry less than ttl ago
+        self.assertEqual(other.lookup('a.js+++b.js'), None)
+        other.forget()
+        self.assertEqual(other.lookup('a.js+++b.js'), entry)
+        other.clear()
+        self.assertFalse(storage.exists('staticfiles.carpool.json'))
+        self.assertEqual(other.lookup('a.js+++b.js'), None)
+
+    def test_cache_registry_generations(self):
+        entry = {'paths': {'a.js+++b.js': 'CARPOOL/0123456789ab.js'}, 'encodings': {}}
+        registry, other = CacheRegistry('default', ttl=60), CacheRegistry('default', ttl=0)
+        registry.publish({'a.js+++b.js': entry})
+        self.assertEqual(other.lookup('a.js+++b.js'), entry)
+        # a deploy starts a new generation, the last one's bundles are gone
+        registry.clear()
+        self.assertEqual(other.lookup('a.js+++b.js'), None)
+
+    def test_default_registry_on_s3(self):
+
+        class MemoryS3ConvoyStorage(S3ConvoyStorage):
+            connection_class = MemoryS3Connection
+
+        MemoryS3Connection.reset()
+        with override_settings(STATIC_URL='/static/'):
+            storages = [MemoryS3ConvoyStorage(bucket='convoy-test', access_key='a', secret_key='s')
+                        for machine in ('one', 'two')]
+        # no CARPOOL_LOCK_CACHE, the registry file couldn't be locked across machines
+        self.assertTrue(isinstance(get_registry(storages[0]), CacheRegistry))
+        entry = {'paths': {'a.js+++b.js': 'CARPOOL/0123456789ab.js'}, 'encodings': {}}
+        get_registry(storages[0]).publish({'a.js+++b.js': entry})
+        self.assertEqual(get_registry(storages[1]).lookup('a.js+++b.js'), entry)
+        self.assertEqual(storages[1].bucket.keys, {})
+
+        orig_cache, registry.CARPOOL_LOCK_CACHE = registry.CARPOOL_LOCK_CACHE, 'default'
+        try:
+            storages[0].bundle_registry = None
+            self.assertTrue(isinstance(get_registry(storages[0]), StorageRegistry))
+        finally:
+            registry.CARPOOL_LOCK_CACHE = orig_cache
+
+    def test_registry_on_s3(self):
+
+        class MemoryCachedS3ConvoyStorage(stores.CachedS3ConvoyStorage):
+            connection_class = MemoryS3Connection
+
+        MemoryS3Connection.reset()
+        orig_root = stores.CONVOY_LOCAL_CACHE_ROOT
+        self.addCleanup(setattr, stores, 'CONVOY_LOCAL_CACHE_ROOT', orig_root)
+        machines = []
+        for machine in ('one', 'two'):
+            # each machine has a local cache of its own
+            stores.CONVOY_LOCAL_CACHE_ROOT = os.path.join(self.work, machine)
+            with override_settings(STATIC_URL='/static/'):
+                machines.append(MemoryCachedS3ConvoyStorage(bucket='convoy-test', access_key='a', secret_key='s'))
+        registry, other = StorageRegistry(machines[0], ttl=60), StorageRegistry(machines[1], ttl=60)
+        first = {'paths': {'a.js+++b.js': 'CARPOOL/0123456789ab.js'}, 'encodings': {}}
+        second = {'paths': {'c.js+++d.js': 'CARPOOL/ba9876543210.js'}, 'encodings': {}}
+        # the machines don't share files, a FileLock would let them overwrite each other's bundles
+        self.assertRaises(ImproperlyConfigured, registry.publish, {'a.js+++b.js': first},
+                          FileLock(os.path.join(self.work, 'locks')))
+        registry.publish({'a.js+++b.js': first}, CacheLock('default'))
+        self.assertEqual(other.lookup('a.js+++b.js'), first)
+        other.publish({'c.js+++d.js': second}, CacheLock('default'))
+        # the first machine's local copy of the registry is out of date
+        registry.forget()
+        self.assertEqual(registry.lookup('c.js+++d.js'), second)
+        self.assertEqual(registry.lookup('a.js+++b.js'), first)
+
+
+class ReportTests(unittest.TestCase):
+    def test_step_finished_signal(self):
+
+        class Storage(object):
+            report = Report()
+
+        received = []
+        def receiver(sender, storage, step, **kwargs):
+            received.append((sender, step.output))
+        step_finished.connect(receiver)
+        try:
+            step = Step(GzipStage(), 0, 'app/base.css', 'app/base.css.gz')
+            step.seconds, step.input_bytes, step.output_bytes = 0.5, 100, 25
+            Pipeline([]).finished_step(Storage(), step)
+        finally:
+            step_finished.disconnect(receiver)
+        self.assertEqual(received, [(Storage, 'app/base.css.gz')])
+        self.assertEqual(Storage.report.as_dict()['stages'][0]['ratio'], 0.25)
+
+
+class BenchmarkTreeTests(unittest.TestCase):
+    def test_generated_trees_are_reproducible(self):
+        roots = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        try:
+            sizes = [generate_tree(os.path.join(root, 'tree'), css=3, js=2, images=4, median_kb=2, seed=7)
+                     for root in roots]
+            self.assertEqual(sizes[0], sizes[1])
+            self.assertEqual(sizes[0][0], 9)
+            with open(os.path.join(roots[0], 'tree', 'app', 'css', 'style0.css')) as f:
+                first = f.read()
+            with open(os.path.join(roots[1], 'tree', 'app', 'css', 'style0.css')) as f:
+                self.assertEqual(f.read(), first)
+            self.assertIn('url("../img/image', first)
+        finally:
+            for root in roots:
+                shutil.rmtree(root)
+
+
+class MinifierTests(unittest.TestCase):
+    def test_css_minify(self):
+        css = """/* gone */ a > b ,  p :hover { color : #AABBCC ; margin : 0px 0 0 0;
+            width: calc(100% - 10px); content: "  (pdf) "; padding: 0.5em }
+            @media screen and (max-width : 600px) { .empty { } .x { top : rgb(255, 0, 0) ; } }
+            /*! kept */"""
+        self.assertEqual(css_minify(css),
+                         'a>b,p :hover{color:#ABC;margin:0;width:calc(100% - 10px);content:"  (pdf) ";padding:.5em}'
+                         '@media screen and (max-width:600px){.x{top:#f00}}/*! kept */')
+
+    def test_css_minify_values(self):
+        for css, minified in (
+                ('a { color: rgb(255, 0, 0); background: RGB(0,128,255) }', 'a{color:#f00;background:#0080ff}'),
+                ('a { border-color: rgb(300, 0, 0) }', 'a{border-color:rgb(300,0,0)}'),
+                ('a { margin: 0px; top: -0em; padding: 0px 1px }', 'a{margin:0;top:-0;padding:0 1px}'),
+                ('.f { flex: 1 1 0px; flex-basis: 0px }', '.f{flex:1 1 0px;flex-basis:0px}'),
+                ('a { margin: 0 0 0 0 !important }', 'a{margin:0!important}'),
+                ('.a {} .b { color: red } @media print { .c { } } .d { ; }', '.b{color:red}'),
+                ('@page :first { margin: 1in }', '@page:first{margin:1in}')):
+            self.assertEqual(css_minify(css), minified)
+
+    def test_css_minify_is_no_larger_than_cssmin(self):
+        if 'cssmin' not in MINIFIERS['css']:
+            return
+        for path in glob.glob(os.path.join(os.path.dirname(__file__), 'staticfiles_tests', '*', '*', '*', '*.css')):
+            with open(path) as f:
+                css = f.read()
+            self.assertTrue(len(MINIFIERS['css']['convoy'](css)) <= len(MINIFIERS['css']['cssmin'](css)), path)
+
+    def test_engines(self):
+        default = MinifyStage()
+        self.assertEqual(default.engines["css"], "cssmin" if "cssmin" in MINIFIERS["css"] else "convoy")
+        for other in MINIFIERS["css"]:
+            if other != default.engines["css"]:
+                self.assertNotEqual(MinifyStage(engines={"css": other}).cache_name("base.css"),
+                                    default.cache_name("base.css"))
+        self.assertRaises(ImproperlyConfigured, MinifyStage, engines={"css": "nonesuch"})
+
+
+class LocalFileCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = LocalFileCache(self.root, max_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_hits_and_misses(self):
+        self.assertEqual(self.cache.open('app/base.css'), None)
+        self.cache.write('app/base.css', ['body', '{}'])
+        with self.cache.open('app/base.css') as f:
+            self.assertEqual(f.read(), 'body{}')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        for i in range(2):
+            self.cache.write('app/%d.js' % i, ['x' * 40])
+            os.utime(self.cache.path('app/%d.js' % i), (i, i))
+        self.cache.open('app/0.js').close()
+        self.cache.write('app/2.js', ['x' * 40])
+        self.assertTrue(self.cache.size <= 90)
+        self.assertTrue(self.cache.exists('app/0.js'))
+        self.assertTrue(self.cache.exists('app/2.js'))
+        self.assertFalse(self.cache.exists('app/1.js'))
+
+    def test_failed_write_leaves_nothing(self):
+        def chunks():
+            yield 'partial'
+            raise IOError("connection reset")
+        self.assertRaises(IOError, self.cache.write, 'app/base.css', chunks())
+        self.assertFalse(self.cache.exists('app/base.css'))
+        self.assertEqual(os.listdir(os.path.join(self.root, '.convoy-tmp')), [])
+
+
+class StageCacheTests(unittest.TestCase):
+    def test_outputs_are_reused_by_fingerprint(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        self.addCleanup(setattr, cache, '_stage_cache', cache._stage_cache)
+        cache._stage_cache = StageCache(root)
+        orig_root, cache.CONVOY_STAGE_CACHE_ROOT = cache.CONVOY_STAGE_CACHE_ROOT, root
+        self.addCleanup(setattr, cache, 'CONVOY_STAGE_CACHE_ROOT', orig_root)
+
+        class FailingGzipStage(GzipStage):
+            def process(self, name, contents):
+                raise AssertionError("processed again")
+
+        contents = 'body { color: red; }\n' * 100
+        asset = Asset('app/base.css', contents)
+        asset.steps = [Step(GzipStage(), 0, 'app/base.css', 'app/base.css.gz')]
+        compressed = _run_steps(asset).steps[0].result
+        # another file with the same bytes, its fingerprint known from hashing it
+        asset = Asset('app/copy.css', contents, hashlib.md5(contents).hexdigest())
+        asset.steps = [Step(FailingGzipStage(), 0, 'app/copy.css', 'app/copy.css.gz')]
+        self.assertEqual(_run_steps(asset).steps[0].result, compressed)
+
+
+class TerminalTableTests(unittest.TestCase):
+    def test_table_matches_chain(self):
+        with override_settings(STATIC_URL='/static/', STATIC_ROOT='/tmp/convoy-terminals/'):
+            storage = build_storage(3)
+            sources = [name for name in storage.hashed_files if '.css' in name and name.count('.') == 1]
+            for encodings in ([], ['gzip'], ['br', 'gzip'], ['zstd']):
+                storage.terminals = {}
+                walked = [storage.get_terminal_url(name, encodings=encodings) for name in sources]
+                storage.terminals = storage.build_terminals()
+                self.assertEqual(sorted(storage.terminals), sorted(sources))
+                self.assertEqual([storage.get_terminal_url(name, encodings=encodings) for name in sources], walked)
+            self.assertEqual(storage.get_terminal_url('app/css/file0.css', gzip=True),
+                             '/static/app/css/file0.0123456789ab.cmin.css.gz')
+
+    def test_resolutions_are_memoized_per_manifest(self):
+        with override_settings(STATIC_URL='/static/', STATIC_ROOT='/tmp/convoy-terminals/'):
+            storage = build_storage(2)
+            url = storage.get_terminal_url('app/css/file0.css', gzip=True)
+            self.assertEqual(storage.get_terminal_url('app/css/file0.css', gzip=True), url)
+            self.assertEqual(storage.get_chain('app/css/file0.css'), storage.get_chain('app/css/file0.css'))
+            stats = storage.resolution_cache.stats()
+            # the url's miss resolved (and remembered) the chain too
+            self.assertEqual((stats['hits'], stats['misses']), (3, 2))
+            self.assertEqual(stats['hit_rate'], 0.6)
+            # a new manifest invalidates everything resolved from the old one
+            storage.hashed_files['app/css/file0.css'] = 'app/css/file0.fedcba987654.css'
+            storage.manifest_hash = 'another manifest'
+            self.assertEqual(storage.get_terminal_url('app/css/file0.css', gzip=True),
+                             '/static/app/css/file0.fedcba987654.css')
+            self.assertEqual(storage.resolution_cache.stats()['entries'], 2)
+
+    def test_installed_entries_change_the_version(self):
+        with override_settings(STATIC_URL='/static/', STATIC_ROOT='/tmp/convoy-terminals/'):
+            storage = build_storage(1)
+            chain = storage.get_chain('app/css/file0.css', gzip=True)
+            # a link replaced in place, hashed_files is as long as it was
+            install_entry(storage, {'paths': {chain[2]: chain[2] + '.zst'}, 'encodings': {}})
+            self.assertEqual(storage.get_chain('app/css/file0.css', gzip=True), chain[:3] + [chain[2] + '.zst'])
+
+    def test_resolution_cache_is_bounded(self):
+        cache = ResolutionCache(max_entries=2)
+        for key in 'abc':
+            cache.get_or_set(1, key, lambda: key.upper())
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual(cache.get_or_set(1, 'c', None), 'C')
+
+
+class TagBenchmarkTests(unittest.TestCase):
+    def test_page_template(self):
+        source = page_template(5, 2, ["a.css", "b.css"], ["a.js"])
+        self.assertEqual(source.count("{% convoy "), 5)
+        self.assertEqual(source.count("{% carpool css %}") + source.count("{% carpool js %}"), 2)
+        self.assertEqual(source.count("{% endcarpool %}"), 2)
+        self.assertEqual(percentile(range(100), 0.99), 99)
+
+
+class ManifestIndexTests(unittest.TestCase):
+    def test_index_matches_json_manifest(self):
+        root = tempfile.mkdtemp()
+        try:
+            with override_settings(STATIC_URL='/static/', STATIC_ROOT=root):
+                saved = build_storage(50)
+                saved.location = saved.base_location = root
+                orig_index, stores.CONVOY_MANIFEST_INDEX = stores.CONVOY_MANIFEST_INDEX, True
+                try:
+                    saved.save_manifest()
+                    loaded = stores.ConvoyStorage(location=root)
+                finally:
+                    stores.CONVOY_MANIFEST_INDEX = orig_index
+                self.assertTrue(os.path.exists(os.path.join(root, 'staticfiles.index')))
+                self.assertEqual(loaded.manifest_hash, saved.manifest_hash)
+                self.assertEqual(dict(loaded.hashed_files), dict(saved.hashed_files))
+                self.assertEqual(dict(loaded.terminals), dict(saved.terminals))
+                self.assertNotIn('app/css/missing.css', loaded.hashed_files)
+                for name in ('app/css/file0.css', 'app/css/file49.css'):
+                    self.assertEqual(loaded.get_terminal_url(name, encodings=['br', 'gzip']),
+                                     saved.get_terminal_url(name, encodings=['br', 'gzip']))
+                # carpool adds entries at runtime, they're kept over the file
+                loaded.hashed_files['carpool-key'] = 'app/css/combined.css'
+                self.assertEqual(loaded.hashed_files.get('carpool-key'), 'app/css/combined.css')
+                self.assertEqual(len(loaded.hashed_files), len(saved.hashed_files) + 1)
+        finally:
+            shutil.rmtree(root)
+
+
+class ManifestReloadTests(unittest.TestCase):
+    def test_reload_swaps_in_a_new_manifest(self):
+        root = tempfile.mkdtemp()
+        try:
+            with override_settings(STATIC_URL='/static/', STATIC_ROOT=root):
+                deployer = build_storage(2)
+                deployer.location = deployer.base_location = root
+                deployer.save_manifest()
+                worker = ConvoyStorage(location=root)
+                url = worker.get_terminal_url('app/css/file0.css')
+                self.assertFalse(worker.reload_manifest())
+
+                deployer.hashed_files['app/css/file0.css'] = 'app/css/file0.fedcba987654.css'
+                deployer.save_manifest()
+                manifest = os.path.join(root, 'staticfiles.json')
+                os.utime(manifest, (os.path.getatime(manifest), os.path.getmtime(manifest) + 10))
+                self.assertEqual(worker.get_terminal_url('app/css/file0.css'), url)
+                self.assertTrue(worker.reload_manifest())
+                self.assertEqual(worker.get_terminal_url('app/css/file0.css'),
+                                 '/static/app/css/file0.fedcba987654.css')
+                self.assertFalse(worker.reload_manifest())
+        finally:
+            shutil.rmtree(root)
+
+
+class AcceptEncodingTests(unittest.TestCase):
+    def encodings(self, accept_encoding):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return request_encodings(request, ("br", "zstd", "gzip"))
+
+    def test_server_preference_order(self):
+        self.assertEqual(self.encodings("gzip, deflate, br"), ["br", "gzip"])
+        self.assertEqual(self.encodings("zstd;q=0.5, gzip;q=1.0"), ["zstd", "gzip"])
+        self.assertEqual(self.encodings("identity"), [])
+
+    def test_q_zero_refuses(self):
+        self.assertEqual(self.encodings("br;q=0, gzip"), ["gzip"])
+        self.assertEqual(self.encodings("gzip; q=0.0"), [])
+
+    def test_wildcard(self):
+        self.assertEqual(self.encodings("*"), ["br", "zstd", "gzip"])
+        self.assertEqual(self.encodings("gzip, *;q=0"), ["gzip"])
+        self.assertEqual(self.encodings("br;q=0, *"), ["zstd", "gzip"])
+        self.assertEqual(self.encodings("*;q=0"), [])
+
+
+class S3StorageTests(unittest.TestCase):
+    def setUp(self):
+
+        class MemoryS3ConvoyStorage(S3ConvoyStorage):
+            connection_class = MemoryS3Connection
+
+        MemoryS3Connection.reset()
+        self.storage = MemoryS3ConvoyStorage(bucket='convoy-test', access_key='a', secret_key='s', gzip=True)
+        self.storage.transfer = TransferManager(backoff=0)
+        self.bucket = self.storage.bucket
+
+    def test_encoded_headers(self):
+        self.storage.save_if_changed('app/base.css', 'body{}')
+        self.storage.save_if_changed('app/base.css.br', 'not really brotli')
+        css, br = self.bucket.keys['app/base.css'], self.bucket.keys['app/base.css.br']
+        self.assertEqual(css.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(br.data, 'not really brotli')
+        self.assertEqual(br.headers['Content-Encoding'], 'br')
+        self.assertEqual(br.headers['Content-Type'], 'text/css')
+        self.assertEqual(br.headers['Vary'], 'Accept-Encoding')
+        # nothing about the storage was changed for the .br file
+        self.assertNotIn('Content-Encoding', self.storage.headers)
+        self.assertTrue(self.storage.gzip)
+
+    def test_identical_save_is_one_head(self):
+        self.storage.gzip = False
+        self.storage.save_if_changed('app/base.js', 'var a;')
+        del self.bucket.requests[:]
+        self.storage.save_if_changed('app/base.js', 'var a;')
+        self.assertEqual(self.bucket.requests, [('HEAD', 'app/base.js')])
+
+    def test_identical_gzipped_save_is_one_head(self):
+        self.storage.save_if_changed('app/base.css', 'body{}')
+        self.assertEqual(self.bucket.keys['app/base.css'].headers['Content-Encoding'], 'gzip')
+        del self.bucket.requests[:]
+        self.storage.save_if_changed('app/base.css', 'body{}')
+        self.assertEqual(self.bucket.requests, [('HEAD', 'app/base.css')])
+        # the listing only has the ETag of the gzipped bytes, the md5 is in the metadata
+        self.storage.build_index()
+        del self.bucket.requests[:]
+        self.storage.save_if_changed('app/base.css', 'body{}')
+        self.assertEqual(self.bucket.requests, [('HEAD', 'app/base.css')])
+        self.storage.save_if_changed('app/base.css', 'a{}')
+        self.assertEqual(self.bucket.requests[-1], ('PUT', 'app/base.css'))
+
+    def test_retries(self):
+        self.bucket.failures = 2
+        self.storage.save_if_changed('app/logo.png', 'png')
+        self.assertEqual(self.bucket.keys['app/logo.png'].data, 'png')
+        self.bucket.failures = 10
+        self.assertRaises(Exception, self.storage.save_if_changed, 'app/other.png', 'png')
+
+    def test_multipart(self):
+        self.storage.transfer = TransferManager(backoff=0, multipart_threshold=10, chunksize=4)
+        self.storage.gzip = False
+        contents = 'x' * 9 + 'y' * 9
+        self.storage.save_if_changed('app/big.js', contents)
+        key = self.bucket.keys['app/big.js']
+        self.assertEqual(key.data, contents)
+        self.assertTrue(key.etag.endswith('-5"'))
+        del self.bucket.requests[:]
+        self.storage.save_if_changed('app/big.js', contents)
+        self.assertEqual(self.bucket.requests, [('HEAD', 'app/big.js')])
+
+    def test_connection_per_thread(self):
+        names = ['app/%d.png' % i for i in range(20)]
+        pool = ThreadPool(4)
+        pool.map(lambda name: self.storage.save_if_changed(name, name), names)
+        pool.close()
+        pool.join()
+        self.assertEqual(sorted(self.bucket.keys), sorted(names))
+        self.assertTrue(len(MemoryS3Connection.connections) > 1)
+
+    def test_index(self):
+        self.storage.gzip = False
+        for name in ('app/base.css', 'app/base.js', 'app/logo.png'):
+            self.storage.save_if_changed(name, name)
+        self.storage.build_index()
+        del self.bucket.requests[:]
+        self.assertTrue(self.storage.exists('app/base.css'))
+        self.assertFalse(self.storage.exists('app/base.min.css'))
+        self.assertEqual(self.storage.size('app/base.js'), len('app/base.js'))
+        self.storage.save_if_changed('app/base.css', 'app/base.css')
+        self.assertEqual(self.bucket.requests, [])
+
+        # a key the listing doesn't have is put without a HEAD first
+        self.storage.save_if_changed('app/new.css', 'body{}')
+        self.assertEqual(self.bucket.requests, [('PUT', 'app/new.css')])
+        self.assertTrue(self.storage.exists('app/new.css'))
+        self.storage.delete('app/logo.png')
+        self.assertFalse(self.storage.exists('app/logo.png'))
+        del self.bucket.requests[:]
+        self.storage.save_if_changed('app/new.css', 'body{}')
+        self.assertEqual(self.bucket.requests, [])
+
+        self.storage.clear_index()
+        self.assertTrue(self.storage.exists('app/new.css'))
+        self.assertTrue(self.bucket.requests)
+
+    def test_local_cache(self):
+        with override_settings(STATIC_URL='/static/'):
+            self._test_local_cache()
+
+    def _test_local_cache(self):
+
+        class MemoryCachedS3ConvoyStorage(stores.CachedS3ConvoyStorage):
+            connection_class = MemoryS3Connection
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        orig_root, stores.CONVOY_LOCAL_CACHE_ROOT = stores.CONVOY_LOCAL_CACHE_ROOT, root
+        try:
+            storage = MemoryCachedS3ConvoyStorage(bucket='convoy-test', access_key='a', secret_key='s', gzip=True)
+        finally:
+            stores.CONVOY_LOCAL_CACHE_ROOT = orig_root
+        # the manifest isn't there yet
+        self.assertEqual((storage.local_cache.hits, storage.local_cache.misses), (0, 1))
+        storage.save('app/base.css', 'body{}')
+        # s3 gets the gzipped file, the cache keeps the original
+        self.assertEqual(self.bucket.keys['app/base.css'].headers['Content-Encoding'], 'gzip')
+        with storage.open('app/base.css') as f:
+            self.assertEqual(f.read(), 'body{}')
+        self.assertEqual((storage.local_cache.hits, storage.local_cache.misses), (1, 1))
+
+        self.storage.gzip = False
+        self.storage.save('app/remote.js', ContentFile('var a;'))
+        with storage.open('app/remote.js') as f:
+            self.assertEqual(f.read(), 'var a;')
+        self.assertTrue(storage.local_cache.exists('app/remote.js'))
+        self.assertEqual(storage.local_cache.misses, 2)
+        storage.delete('app/remote.js')
+        self.assertFalse(storage.local_cache.exists('app/remote.js'))
@@ -0,0 +1,101 @@
+from django.conf import settings
+
+from boto.exception import S3ResponseError
+
+from io import BytesIO
+import hashlib
+import httplib
+import os
+import socket
+import time
+
+# Uploads that fail with a network error or a 5xx are retried, waiting
+# CONVOY_AWS_UPLOAD_BACKOFF seconds, then twice that, and so on
+CONVOY_AWS_UPLOAD_RETRIES = getattr(settings, "CONVOY_AWS_UPLOAD_RETRIES", 3)
+CONVOY_AWS_UPLOAD_BACKOFF = getattr(settings, "CONVOY_AWS_UPLOAD_BACKOFF", 0.5)
+# Files at least this big are uploaded in parts of CONVOY_AWS_MULTIPART_CHUNKSIZE bytes
+# S3 requires every part but the last to be at least 5MB
+CONVOY_AWS_MULTIPART_THRESHOLD = getattr(settings, "CONVOY_AWS_MULTIPART_THRESHOLD", 8 * 1024 * 1024)
+CONVOY_AWS_MULTIPART_CHUNKSIZE = getattr(settings, "CONVOY_AWS_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024)
+
+# The ETags of multipart uploads and of files s3 storage gzipped aren't the md5
+# of what was saved, so we keep it in the key's metadata
+MD5_METADATA = "convoy-md5"
+
+
+def content_size(content):
+    '''
+    The size of content as it is now, s3boto gzips content in place without updating content.size
+    '''
+    content.seek(0, os.SEEK_END)
+    size = content.tell()
+    content.seek(0)
+    return size
+
+
+def is_retryable(exc):
+    if isinstance(exc, S3ResponseError):
+        return exc.status >= 500 or exc.status in (408, 429)
+    return isinstance(exc, (socket.error, httplib.HTTPException, IOError))
+
+
+class TransferManager(object):
+    '''
+    Uploads a file to an S3 key: with retries and exponential backoff,
+    and in parts when it's larger than multipart_threshold
+
+    Everything a single upload needs (headers, acl) is passed to upload(),
+    so one manager can be used by many threads at once as long as each
+    thread uses its own connection (see S3ConvoyMixin.bucket)
+    '''
+    def __init__(self, retries=None, backoff=None, multipart_threshold=None, chunksize=None):
+        self.retries = retries if retries is not None else CONVOY_AWS_UPLOAD_RETRIES
+        self.backoff = backoff if backoff is not None else CONVOY_AWS_UPLOAD_BACKOFF
+        self.multipart_threshold = multipart_threshold or CONVOY_AWS_MULTIPART_THRESHOLD
+        self.chunksize = chunksize or CONVOY_AWS_MULTIPART_CHUNKSIZE
+
+    def retry(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:
+                if attempt >= self.retries or not is_retryable(exc):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+    def upload(self, key, content, headers, **options):
+        '''
+        options are passed on to boto e.g. policy, reduced_redundancy, encrypt_key
+        '''
+        if content_size(content) >= self.multipart_threshold:
+            return self.multipart_upload(key, content, headers, **options)
+        return self.retry(key.set_contents_from_file, content, headers=headers, rewind=True, **options)
+
+    def multipart_upload(self, key, content, headers, **options):
+        headers = dict(headers)
+        # gzipped content comes with the md5 of what was gzipped already
+        if "x-amz-meta-%s" % MD5_METADATA not in headers:
+            digest = hashlib.md5()
+            for chunk in content.chunks():
+                digest.update(chunk)
+            headers["x-amz-meta-%s" % MD5_METADATA] = digest.hexdigest()
+        upload = self.retry(key.bucket.initiate_multipart_upload, key.name, headers=headers, **options)
+        try:
+            content.seek(0)
+            part_num = 0
+            while True:
+                part = content.read(self.chunksize)
+                if not part:
+                    break
+                part_num += 1
+                self.retry(self._upload_part, upload, part, part_num)
+            return self.retry(upload.complete_upload)
+        except Exception:
+            upload.cancel_upload()
+            raise
+
+    def _upload_part(self, upload, part, part_num):
+        # a fresh file each attempt, boto reads it to the end
+        return upload.upload_part_from_file(BytesIO(part), part_num)
@@ -1,10 +1,11 @@
 from django.conf import settings
 from django.contrib.staticfiles.storage import staticfiles_storage
-from django.middleware.gzip import re_accepts_gzip
+from django.utils.encoding import force_bytes
 
-from collections import OrderedDict
-from django.core.files.base import ContentFile
+from convoy.hashing import digest, new_hash
+from convoy.streams import HashingWriter, as_file, close
 
+import codecs
 import os
 import re
 import posixpath
@@ -15,6 +16,8 @@ CONVOY_DURING_DEBUG = getattr(settings, "CONVOY_DURING_DEBUG", False)
 #TODO, find a better name for CONVOY_GZIP_IN_TEMPLATE
 CONVOY_GZIP_IN_TEMPLATE = getattr(settings, "CONVOY_GZIP_IN_TEMPLATE", True)
 CONVOY_CONSERVATIVE_MSIE_GZIP = getattr(settings, "CONVOY_CONSERVATIVE_MSIE_GZIP", False)
+# The precompressed variants the template tags may serve, most preferred first
+CONVOY_ENCODINGS = getattr(settings, "CONVOY_ENCODINGS", ("br", "zstd", "gzip"))
 CARPOOL_PATH_FRAGMENT = getattr(settings, "CARPOOL_CACHE_PATH_FRAGMENT", "CARPOOL")
 
 URL_PATTERN = re.compile(r'url\(([^\)]+)\)')
@@ -96,60 +99,80 @@ class CssAbsolute(object):
         return self._converter(matchobj, 2, "src='%s'")
 
 
-def concatenate_and_hash(paths, comment_key, format, storage=None, fail_loudly=False):
+def _transcode(chunks, charset):
+    '''
+    chunks of a file in charset, as utf-8, decoded incrementally so a character can straddle two chunks
+    '''
+    decoder = codecs.getincrementaldecoder(charset)()
+    for chunk in chunks:
+        yield decoder.decode(chunk).encode('utf-8')
+    yield decoder.decode(b"", final=True).encode('utf-8')
+
+
+def concatenate(paths, comment_key, format, storage=None):
+    '''
+    Combines paths into one file named for the hash of its contents under CARPOOL_PATH_FRAGMENT
+    Saves it (when it isn't already there) and returns its stored name, without post processing it
+
+    The files are streamed one after the other into a spooled temporary file, fingerprinted
+    as they're written, only a css file is held whole while its urls are rewritten
+    '''
     if not storage:
         storage = staticfiles_storage
-    storage._should_hash = False
     css_abs = CssAbsolute(storage=storage)
-    
+
+    md5 = hashlib.md5()
+    hashers = [md5]
+    # Use the storage's hash if possible, computed from the same writes
+    if hasattr(storage, 'hash_algorithm'):
+        file_hasher = new_hash(storage.hash_algorithm)
+        hashers.append(file_hasher)
+    writer = HashingWriter(hashers)
+    writer.write(force_bytes(u"/*!" + comment_key + u"*/"))
+    for path in paths:
+        writer.write(force_bytes(u"\n /*!" + path + u"*/ \n"))
+        if format == "css":
+            processed = css_abs.get_and_process(path)
+            if "@import" in processed:
+                raise ValueError("%s: convoy cannot safely concatenate css files that use the @import statement"  % path)
+            writer.write(force_bytes(processed))
+        elif format == "js":
+            with storage.open(path) as f:
+                for chunk in _transcode(f.chunks(), settings.FILE_CHARSET):
+                    writer.write(chunk)
+    contents = writer.contents()
+
     try:
-        content = u"/*!" + comment_key + u"*/"
-        for path in paths:
-            content += u"\n /*!" + path + u"*/ \n"
-            if format == "css":
-                processed = css_abs.get_and_process(path)
-                if "@import" in processed:
-                    raise ValueError("%s: convoy cannot safely concatenate css files that use the @import statement"  % path)
-                content += processed
-            elif format == "js":
-                with storage.open(path) as f:
-                    f_content = f.read().decode(settings.FILE_CHARSET)
-                    content += f_content
-        content = ContentFile(content)
-
-        # Use the storage's file_hash if possible
-        if hasattr(storage, 'file_hash'):
-            hashed_name = storage.file_hash(comment_key, content)
-        elif content is not None:
-            hashed_name = hashlib.md5()
-            for chunk in content.chunks():
-                hashed_name.update(chunk)        
+        if hasattr(storage, 'hash_algorithm'):
+            hashed_name = digest(file_hasher, storage.hash_length)
+        elif hasattr(storage, 'file_hash'):
+            hashed_name = storage.file_hash(comment_key, as_file(contents))
+        else:
+            hashed_name = md5.hexdigest()
         file_name = CARPOOL_PATH_FRAGMENT + u"/" + hashed_name + u"." + format
 
-        #Save it
+        #Save it, the name is a hash of the contents so it's usually already there
+        if hasattr(storage, "save_if_changed"):
+            return storage.save_if_changed(file_name, contents, md5.hexdigest())
         if storage.exists(file_name):
             storage.delete(file_name)
-        stored_name = storage.save(file_name, content)
-        
-        #Store it in the cache
-        if hasattr(storage, "hashed_files"):                
-            hashed_files = OrderedDict()
-            hashed_files[storage.hash_key(comment_key)] = stored_name
-            storage.hashed_files.update(hashed_files)
-        
-        #Post process it
-        if hasattr(storage, "post_process"):
-            found_files = OrderedDict()
-            found_files[stored_name] = (storage, stored_name)
-            processor = storage.post_process(found_files, False)
-            for orig_path, processed_path, processed in processor:
-                if isinstance(processed, Exception):
-                    print "Post-processing '%s' failed!" % orig_path
-                    raise processed
-                if processed:
-                    print "Post-processed '%s' as '%s'" % (orig_path, processed_path)
-                else:
-                    print("Skipped post-processing '%s'" % orig_path)
+        return storage.save(file_name, as_file(contents))
+    finally:
+        close(contents)
+
+
+def concatenate_and_hash(paths, comment_key, format, storage=None, fail_loudly=False):
+    '''
+    Builds the bundle of paths and publishes it for every process, see convoy.bundles
+    Returns its stored name, or False when it couldn't be built (unless DEBUG or fail_loudly)
+    '''
+    from convoy.bundles import build_bundle, record_bundles
+    if not storage:
+        storage = staticfiles_storage
+
+    try:
+        stored_name = build_bundle(paths, comment_key, format, storage)
+        record_bundles([comment_key], storage)
         return stored_name
         
     except Exception as e:
@@ -163,22 +186,47 @@ def concatenate_and_hash(paths, comment_key, format, storage=None, fail_loudly=F
             #TODO: add logging here
 
 
-def request_accepts_gzip(request):
+def request_encodings(request, preferred=None):
+    '''
+    The encodings of preferred (CONVOY_ENCODINGS) the request's Accept-Encoding allows,
+    in our order of preference: the client's q-values only decide what's acceptable
+    '''
+    if preferred is None:
+        preferred = CONVOY_ENCODINGS
     # MSIE has issues with gzipped response of various content types
     # but, if we're only gzipping text/css and javascript, we should be ok
     if CONVOY_CONSERVATIVE_MSIE_GZIP:
         if "msie" in request.META.get('HTTP_USER_AGENT', '').lower():
-            return False
-    ae = request.META.get('HTTP_ACCEPT_ENCODING', '')
-    if re_accepts_gzip.search(ae):
-        return True
-    return False
+            return []
+    qualities = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(","):
+        params = part.strip().split(";")
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+    # "*" stands for the codings the header doesn't name (RFC 7231 5.3.4)
+    wildcard = qualities.get("*", 0)
+    return [encoding for encoding in preferred if qualities.get(encoding, wildcard) > 0]
+
+
+def request_accepts_gzip(request):
+    return "gzip" in request_encodings(request, ("gzip",))
 
 
-def convoy_terminus(path, dry_mode=False, gzip=False, storage=None):
+def convoy_terminus(path, dry_mode=False, gzip=False, storage=None, encodings=None):
     if not storage:
         storage = staticfiles_storage
     if hasattr(storage, "get_terminal_url"):
+        if encodings is not None:
+            return storage.get_terminal_url(path, dry_mode, gzip, encodings)
         return storage.get_terminal_url(path, dry_mode, gzip)
     return storage.url(path) 
     
@@ -189,6 +237,15 @@ def convoy_chain(path, dry_mode=False, gzip=False, storage=None):
         return storage.get_chain(path, gzip=False) 
     return [storage.url(path)]
 
+def context_encodings(context):
+    '''
+    The encodings the context's request may be served, None when the templates don't negotiate them
+    '''
+    if CONVOY_GZIP_IN_TEMPLATE:
+        if context.has_key('request'):
+            return request_encodings(context['request'])
+    return None
+
 def convoy_from_context(path, context, storage=None):
     if not storage:
         storage = staticfiles_storage    
@@ -204,8 +261,7 @@ def convoy_from_context(path, context, storage=None):
             dry_mode = False
         else:
             dry_mode = True
-    if CONVOY_GZIP_IN_TEMPLATE:
-        if context.has_key('request'):
-            if request_accepts_gzip(context['request']):
-                gzip=True
-    return convoy_terminus(path, dry_mode, gzip, storage)
\ No newline at end of file
+    encodings = context_encodings(context)
+    if encodings is not None:
+        gzip = "gzip" in encodings
+    return convoy_terminus(path, dry_mode, gzip, storage, encodings)
\ No newline at end of file
@@ -0,0 +1,84 @@
+from django.conf import settings
+
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import itertools
+
+# How many processes run the cpu bound work (minifying, compressing)
+# and how many threads run the io bound work (open, exists, save)
+# 1 keeps post processing serial, 0 or None uses one worker per cpu
+CONVOY_CPU_WORKERS = getattr(settings, "CONVOY_CPU_WORKERS", 1)
+CONVOY_IO_WORKERS = getattr(settings, "CONVOY_IO_WORKERS", 1)
+
+
+def _worker_count(workers):
+    if not workers:
+        return cpu_count()
+    return max(int(workers), 1)
+
+
+class WorkerPools(object):
+    '''
+    A process pool for cpu bound work and a thread pool for io bound work
+
+    Both maps are ordered, results come back in the order of their inputs
+    no matter which worker finishes first, so callers can yield and update
+    hashed_files exactly as the serial code would have.
+
+    Pass the number of jobs when it is known: pools are only started when
+    there is more than one job, so single file post processing
+    (e.g. carpool during a request) never forks
+    '''
+    def __init__(self, cpu_workers=None, io_workers=None, jobs=None):
+        if cpu_workers is None:
+            cpu_workers = CONVOY_CPU_WORKERS
+        if io_workers is None:
+            io_workers = CONVOY_IO_WORKERS
+        self.cpu_workers = _worker_count(cpu_workers)
+        self.io_workers = _worker_count(io_workers)
+        if jobs is not None and jobs < 2:
+            self.cpu_workers = self.io_workers = 1
+        self._cpu_pool = None
+        self._io_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def cpu_map(self, func, items):
+        '''
+        Ordered map of func over items across processes
+        func and every item must be picklable: use module level functions
+        '''
+        if self.cpu_workers < 2:
+            return itertools.imap(func, items)
+        return self._start_cpu_pool().imap(func, items)
+
+    def io_map(self, func, items):
+        '''
+        Ordered map of func over items across threads
+        '''
+        if self.io_workers < 2:
+            return itertools.imap(func, items)
+        if self._io_pool is None:
+            # fork the processes before the threads start: a child forked while a thread
+            # holds a lock (logging's, the import lock) would wait on it forever
+            if self.cpu_workers > 1:
+                self._start_cpu_pool()
+            self._io_pool = ThreadPool(self.io_workers)
+        return self._io_pool.imap(func, items)
+
+    def _start_cpu_pool(self):
+        if self._cpu_pool is None:
+            self._cpu_pool = Pool(self.cpu_workers)
+        return self._cpu_pool
+
+    def close(self):
+        for pool in (self._cpu_pool, self._io_pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self._cpu_pool = None
+        self._io_pool = None
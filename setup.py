@@ -25,7 +25,7 @@ setup(
     version='0.1.3',
     author='Ted Tieken <ted.tieken@gmail.com>, Peter Conerly <pconerly@gmail.com>',
     author_email='ted.tieken@gmail.com',
-    packages=['convoy', 'convoy.templatetags'],
+    packages=['convoy', 'convoy.benchmarks', 'convoy.management', 'convoy.management.commands', 'convoy.templatetags'],
     scripts=[],
     url='',
     license='MIT',
@@ -37,5 +37,6 @@ setup(
         "django-s3-folder-storage >= 0.2",
         "cssmin >= 0.2.0",
         "rjsmin >= 1.0.9",
+        "Brotli >= 0.5.2",
     ],
 )